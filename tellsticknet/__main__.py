@@ -12,12 +12,34 @@ Usage:
   tellsticknet [-v|-vv] [options] send <name> <cmd> [<param>]
   tellsticknet [-v|-vv] [options] send <protocol> <model> <house> <unit> <cmd>
   tellsticknet [-v|-vv] [options] mqtt
+  tellsticknet [-v|-vv] [options] hub
+  tellsticknet [-v|-vv] [options] unknown
   tellsticknet [-v|-vv] [options] mock
+  tellsticknet [-v|-vv] [options] emulate
+  tellsticknet [-v|-vv] [options] replay <file> [mqtt]
   tellsticknet [-v|-vv] [options] parse
 
 Options:
   --ip <ip>             IP of Tellstick Net device
   --raw                 Print raw packets instead of parsed data
+  --workers <n>         Decode packets in a pool of n workers
+  --processes           Use worker processes instead of threads
+  --metrics <address>   Serve Prometheus metrics on [host:]port
+  --trace <file>        Write per packet stage timestamps to file
+  --rcvbuf <bytes>      Size of the socket receive buffer
+  --rediscover <secs>   Rediscover the controller address periodically
+  --table <file>        Share the latest values in a memory mapped file
+  --hub <path>          Unix socket of the hub sharing the controller
+  --api <address>       Serve the HTTP api on [host:]port
+  --aggregate <secs>    Aggregate sensor values over windows of secs
+  --with-raw            Publish the sensor values also when aggregating
+  --outliers            Drop glitchy sensor readings
+  --diagnostics         Publish the dropped readings on a diagnostics topic
+  --sensors <n>         Emulated sensors [default: 10]
+  --remotes <n>         Emulated remote controls [default: 5]
+  --rate <n>            Emulated packets per second [default: 1]
+  --burst <n>           Emulated packets sent back to back [default: 1]
+  --speed <factor>      Replay speed-up, 0 for no delays [default: 1]
   -h --help             Show this message
   -v,-vv                Increase verbosity
   -d                    Debug
@@ -28,19 +50,11 @@ import docopt
 import logging
 import re
 from datetime import datetime
-from sys import argv, stdout, stderr, stdin, version_info
-from os.path import join, dirname, expanduser
-from os import environ as env
-from itertools import product
-from yaml import safe_load_all as load_yaml
-
-import asyncio
+from sys import stdout, stderr, stdin, version_info
 
+# asyncio, yaml and the controller are imported by the commands needing
+# them, to start quickly e.g. when run from cron or a shell completion
 from tellsticknet import __version__, const
-from tellsticknet.protocol import decode_packet
-from tellsticknet.controller import discover
-
-from json import dumps as to_json
 
 LOGFMT = "%(asctime)s %(levelname)5s (%(threadName)s) [%(name)s] %(message)s"
 DATEFMT = "%y-%m-%d %H:%M.%S"
@@ -66,124 +80,279 @@ def parse_stdin():
     script/listen > /tmp/packets.log
     cat /tmp/packets.log  | ./script/parse | jq ".sensorId" | sort | uniq
     """
+    from json import dumps as to_json
+    from tellsticknet.protocol import decode_event, fast_path_ratio
+
     for line in stdin.readlines():
         line = line.strip()
         if " " in line:
             # assume we have date + raw data separated by space
             timestamp, line = line.split(" ", 1)
             timestamp = parse_isoformat(timestamp)
-            lastUpdated = int(timestamp.timestamp())
-            packet = decode_packet(line)
-            if packet is None:
+            event = decode_event(line)
+            if not event:
                 continue
-            packet.update(lastUpdated=lastUpdated, time=timestamp.isoformat())
-            print(to_json(packet))
+            event.lastUpdated = int(timestamp.timestamp())
+            print(to_json(dict(event.as_dict(), time=timestamp.isoformat())))
         else:
-            print(to_json(decode_packet(line)))
+            event = decode_event(line)
+            print(to_json(event.as_dict() if event else None))
+    _LOGGER.info(
+        "%.1f%% of sensor packets were decoded by the firmware",
+        100 * fast_path_ratio(),
+    )
+
 
+def prepend_timestamp(line, timestamp=None):
+    """Add ISO 8601 timestamp to line
 
-def prepend_timestamp(line):
-    """Add ISO 8601 timestamp to line"""
-    timestamp = datetime.now().replace(microsecond=0).isoformat()
-    return "{} {}".format(timestamp, line)
+    >>> prepend_timestamp("x", 1459502355.5)[-4:]
+    ':15 x'
+    """
+    timestamp = (
+        datetime.fromtimestamp(timestamp) if timestamp else datetime.now()
+    )
+    return "{} {}".format(timestamp.replace(microsecond=0).isoformat(), line)
 
 
-async def print_event_stream(controller, raw=False):
-    """Print event stream"""
+async def print_event_stream(
+    controller, raw=False, aggregate=None, with_raw=False, outliers=None
+):
+    """Print event stream, with the sensor values aggregated over windows
+    of aggregate seconds if given, see tellsticknet.aggregate, and the
+    readings rejected by the outliers.OutlierFilter dropped"""
+    from json import dumps as to_json
 
     if raw:
         stream = (
-            prepend_timestamp(packet) async for packet in controller.packets()
+            (prepend_timestamp(packet, timestamp), None)
+            async for packet, timestamp in controller.datagrams()
         )
     else:
-        stream = (to_json(event) async for event in controller.events())
+        events = controller.events()
+        if outliers:
+            from tellsticknet.outliers import filtered
+
+            events = filtered(events, outliers)
+        if aggregate:
+            from tellsticknet.aggregate import aggregated
 
-    async for packet in stream:
+            events = aggregated(events, aggregate, replace=not with_raw)
+        stream = (
+            (to_json(event.as_dict()), event.trace)
+            async for event in events
+            if event
+        )
+
+    async for packet, trace in stream:
         print(packet)
         try:
             stdout.flush()
         except IOError:
             # broken pipe
             pass
+        if trace:
+            trace.finish("published")
+
+
+def print_unknown():
+    """Print the transmitters not configured, as last written by the
+    gateway, the ones heard from most first"""
+    from json import dumps as to_json
+    from tellsticknet.catalog import read
+
+    def local_time(timestamp):
+        return datetime.fromtimestamp(timestamp).replace(microsecond=0)
+
+    for entry in read():
+        event = entry.pop("event")
+        print(
+            "{count:8d} {first} {last} {transmitter} {value}".format(
+                count=entry.pop("count"),
+                first=local_time(entry.pop("first")).isoformat(),
+                last=local_time(entry.pop("last")).isoformat(),
+                transmitter=to_json(entry),
+                value=to_json(event.get("data") or event.get("method")),
+            )
+        )
 
 
-CONFIG_DIRECTORIES = [
-    dirname(argv[0]),
-    expanduser("~"),
-    env.get("XDG_CONFIG_HOME", join(expanduser("~"), ".config")),
-]
+def read_config():
+    from tellsticknet.config import read_config
 
-CONFIG_FILES = ["tellsticknet.conf", ".tellsticknet.conf"]
+    try:
+        return read_config()
+    except ValueError as e:
+        exit(f"Invalid config: {e}")
 
 
-def read_config():
-    for directory, filename in product(CONFIG_DIRECTORIES, CONFIG_FILES):
-        try:
-            config = join(directory, filename)
-            _LOGGER.debug("checking for config file %s", config)
-            with open(config) as config:
-                return list(load_yaml(config))
-        except (IOError, OSError):
-            continue
-    return {}
+def make_executor(workers, processes=False):
+    """Worker pool for decoding packets, None to decode in the event loop"""
+    if not workers:
+        return None
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    _LOGGER.info(
+        "Decoding packets in %d worker %s",
+        workers,
+        "processes" if processes else "threads",
+    )
+    if processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def make_table(filename):
+    """Shared memory table of the latest values, see tellsticknet.table"""
+    if not filename:
+        return None
+    from tellsticknet.table import Table
+
+    return Table(filename)
 
 
 async def main(args):
+    import asyncio
+    from tellsticknet import monitor
+    from tellsticknet.controller import discover
 
     loop = asyncio.get_event_loop()
 
-    def poller(then=None):
-        interval = 5
-        now = loop.time()
-        if then:
-            _LOGGER.debug("Poller %f Took %f", interval, now - then)
-        loop.call_later(interval, poller, now)
-
-    if loop.get_debug():
-        poller()
+    workers = int(args["--workers"] or 0)
+    aggregate = args["--aggregate"] and float(args["--aggregate"])
+
+    if args["listen"] or args["mqtt"] or args["replay"] or args["hub"]:
+        if args["--trace"]:
+            monitor.start_trace(args["--trace"])
+        if args["--metrics"]:
+            from tellsticknet.metrics import serve
+
+            await serve(args["--metrics"])
+        monitor.install_dump_handler()
+        loop.create_task(
+            monitor.lag_monitor(
+                level=logging.INFO if workers else logging.DEBUG
+            )
+        )
 
-    if args["parse"] and not stdin.isatty():
-        parse_stdin()
-        exit()
-    elif args["mock"]:
+    if args["mock"]:
         from tellsticknet.discovery import mock
 
         await mock()
         exit()
-    elif args["devices"]:
-        for e in (e for e in read_config() if "sensorId" not in e):
-            print("-", e["name"])
-        exit()
-    elif args["sensors"]:
-        for e in (e for e in read_config() if "sensorId" in e):
-            print("-", e["name"])
+    elif args["emulate"]:
+        from tellsticknet.emulator import Emulator, ADDRESS
+
+        await Emulator(
+            address=args["--ip"] or ADDRESS,
+            sensors=int(args["--sensors"]),
+            remotes=int(args["--remotes"]),
+            rate=float(args["--rate"]),
+            burst=int(args["--burst"]),
+        ).run()
         exit()
 
+    api = None
+    if args["--api"]:
+        from tellsticknet.api import Api
+
+        api = Api()
+        await api.serve(args["--api"])
+
     ip = args["--ip"]
+    options = dict(
+        executor=make_executor(workers, args["--processes"]),
+        rcvbuf=args["--rcvbuf"] and int(args["--rcvbuf"]),
+        rediscover=args["--rediscover"] and float(args["--rediscover"]),
+        table=make_table(args["--table"]),
+        api=api,
+    )
 
     if args["discover"]:
-        async for c in await discover(ip=ip, discover_all=True):
+        async for c in await discover(ip=ip, discover_all=True, **options):
             print(c)
         exit()
 
     config = read_config()
+    if api:
+        api.reload(config)
 
     from functools import partial
 
-    if args["mqtt"]:
-        from tellsticknet.mqtt import run
+    if args["hub"]:
+        from tellsticknet.hub import Hub, SOCKET
 
-        await run(partial(discover, ip=ip), config)
+        controller = await discover(ip=ip, **options)
+        if not controller:
+            exit("No tellstick device found")
+        await Hub(controller, args["--hub"] or SOCKET).run()
         exit()
 
-    controller = await discover(ip=ip)
+    async def replay():
+        from tellsticknet.replay import Replay
+
+        return Replay(
+            args["<file>"],
+            float(args["--speed"]),
+            ip=ip or "replay",
+            **options,
+        )
+
+    if args["replay"]:
+        find_controller = replay
+    elif args["--hub"]:
+        from tellsticknet.hub import attach
+
+        find_controller = partial(attach, args["--hub"], **options)
+    else:
+        find_controller = partial(discover, ip=ip, **options)
+
+    if args["mqtt"]:
+        from tellsticknet.config import find, watch
+        from tellsticknet.catalog import CATALOG_FILE
+        from tellsticknet.mqtt import run, SNAPSHOT_FILE
+
+        async def updates(filename):
+            async for config in watch(filename):
+                if api:
+                    api.reload(config)
+                yield config
+
+        filename = find()
+        await run(
+            find_controller,
+            config,
+            updates=filename and updates(filename),
+            snapshot=None if args["replay"] else SNAPSHOT_FILE,
+            aggregate=aggregate,
+            with_raw=args["--with-raw"],
+            outliers=args["--outliers"],
+            diagnostics=args["--diagnostics"],
+            catalog=None if args["replay"] else CATALOG_FILE,
+        )
+        exit()
+
+    controller = await find_controller()
     if not controller:
         exit("No tellstick device found")
 
     _LOGGER.info("Found controller: %s", controller)
 
-    if args["listen"]:
-        await print_event_stream(controller, raw=args["--raw"])
+    if args["listen"] or args["replay"]:
+        outliers = None
+        if args["--outliers"]:
+            from tellsticknet import metrics
+            from tellsticknet.outliers import OutlierFilter
+
+            outliers = OutlierFilter(config)
+            metrics.COLLECTORS.append(outliers.collect_metrics)
+        await print_event_stream(
+            controller,
+            raw=args["--raw"],
+            aggregate=aggregate,
+            with_raw=args["--with-raw"],
+            outliers=outliers,
+        )
     elif args["send"]:
         cmd = args["<cmd>"]
         METHODS = dict(
@@ -211,7 +380,9 @@ async def main(args):
 
         if name:
             devices = [
-                e for e in config if e["name"].lower().startswith(name.lower())
+                (e, compiled)
+                for e, compiled in zip(config, config.compiled)
+                if e["name"].lower().startswith(name.lower())
             ]
             if not devices:
                 exit(f"Device with name {name} not found")
@@ -226,8 +397,13 @@ async def main(args):
         _LOGGER.debug("Waiting for tasks to finish")
         await asyncio.gather(
             *[
-                controller.execute(device, method, param=param)
-                for device in devices
+                controller.execute(
+                    device,
+                    method,
+                    param=param,
+                    frame=None if param else compiled.frames.get(method),
+                )
+                for device, compiled in devices
             ]
         )
 
@@ -259,6 +435,24 @@ def app_main():
     if debug:
         _LOGGER.info("Debug is on")
 
+    # commands without network access, not needing the event loop
+    if args["parse"] and not stdin.isatty():
+        parse_stdin()
+        exit()
+    elif args["unknown"]:
+        print_unknown()
+        exit()
+    elif args["devices"]:
+        for e in (e for e in read_config() if "sensorId" not in e):
+            print("-", e["name"])
+        exit()
+    elif args["sensors"]:
+        for e in (e for e in read_config() if "sensorId" in e):
+            print("-", e["name"])
+        exit()
+
+    import asyncio
+
     try:
         asyncio.run(main(args), debug=debug)  # pylint: disable=no-member
     except KeyboardInterrupt:
@@ -0,0 +1,216 @@
+"""
+min, max, mean and count of sensor values over tumbling windows
+
+Some sensors transmit every few seconds. The aggregation stage takes the
+events of Controller.events(), and yields one Aggregate per sensor and
+window instead of every reading. Windows are aligned to multiples of the
+interval, in the time of the events, so the windows of all sensors end
+at the same time. A window is yielded when the sensor sends in a later
+window, or when the clock of the events has passed its end by GRACE
+seconds. Events of devices, e.g. remote controls, are passed on at once.
+"""
+
+import asyncio
+import logging
+
+from .event import Event
+
+_LOGGER = logging.getLogger(__name__)
+
+# seconds after the end of a window until it is yielded, if the sensor has
+# not sent in the next window
+GRACE = 5
+
+# decimals of the mean
+DECIMALS = 2
+
+
+class Aggregate(Event):
+    """
+    An event with the mean of each quantity of a sensor over a window, and
+    the min, max and count in stats
+
+    >>> from .const import Quantity
+    >>> window = Window(Event.from_fields(dict(protocol="fineoffset", \
+sensorId=135)), 60)
+    >>> window.add(((Quantity.TEMPERATURE, 16.5),))
+    >>> window.add(((Quantity.TEMPERATURE, 17.0),))
+    >>> window.aggregate(True).as_dict()
+    {'protocol': 'fineoffset', 'sensorId': 135, 'data': [{'name': 'temp', \
+'value': 16.75, 'min': 16.5, 'max': 17.0, 'count': 2}], 'lastUpdated': 60, \
+'timestamp': 60, 'start': 0}
+    """
+
+    __slots__ = ("start", "stats", "replaces")
+
+    def as_dict(self):
+        res = super().as_dict()
+        res.update(
+            data=[
+                dict(name=quantity.value, value=value, **self.stats[quantity])
+                for quantity, value in self.data
+            ],
+            start=self.start,
+        )
+        return res
+
+
+class Window:
+    """The values of one sensor in one window, O(1) per quantity"""
+
+    __slots__ = ("event", "start", "end", "values")
+
+    def __init__(self, event, interval):
+        # the first event, for the properties identifying the sensor
+        self.event = event
+        self.start = (event.timestamp or 0) // interval * interval
+        self.end = self.start + interval
+        self.values = {}  # quantity -> [min, max, sum, count]
+
+    def add(self, data):
+        for quantity, value in data:
+            values = self.values.get(quantity)
+            if values is None:
+                self.values[quantity] = [value, value, value, 1]
+            else:
+                values[0] = min(values[0], value)
+                values[1] = max(values[1], value)
+                values[2] += value
+                values[3] += 1
+
+    def aggregate(self, replaces):
+        event = self.event
+        aggregate = Aggregate(
+            class_=event.class_,
+            protocol=event.protocol,
+            model=event.model,
+            sensorId=event.sensorId,
+            house=event.house,
+            unit=event.unit,
+            data=tuple(
+                (quantity, round(total / count, DECIMALS))
+                for quantity, (_, _, total, count) in self.values.items()
+            ),
+            lastUpdated=int(self.end),
+            timestamp=self.end,
+        )
+        aggregate.start = self.start
+        aggregate.stats = {
+            quantity: dict(min=low, max=high, count=count)
+            for quantity, (low, high, _, count) in self.values.items()
+        }
+        aggregate.replaces = replaces
+        return aggregate
+
+
+class Aggregator:
+    """
+    Windows of the sensors, the aggregates of the windows ended are
+    returned by add and expire
+
+    >>> from .const import Quantity
+    >>> aggregator = Aggregator(60)
+    >>> def reading(temp, timestamp):
+    ...     return Event.from_fields(dict(protocol="fineoffset", \
+sensorId=135, data=dict(temp=temp), timestamp=timestamp))
+    >>> aggregator.add(reading(10, 1000))
+    []
+    >>> aggregator.add(reading(12, 1010))
+    []
+    >>> [a.value(Quantity.TEMPERATURE) for a in aggregator.add(reading(20, \
+1030))]
+    [11.0]
+    >>> [a.start for a in aggregator.expire(1085)]
+    []
+    >>> [a.start for a in aggregator.expire(1086)]
+    [1020]
+    """
+
+    def __init__(self, interval, replace=True):
+        self.interval = interval
+        # whether the aggregates replace the readings, or are published
+        # besides them
+        self.replace = replace
+        self.windows = {}  # (protocol, model, sensorId) -> Window
+        # end of the window ending first
+        self.first_end = float("inf")
+
+    def add(self, event):
+        key = event.protocol, event.model, event.sensorId
+        window = self.windows.get(key)
+        ended = []
+        if window and (event.timestamp or 0) >= window.end:
+            ended.append(window.aggregate(self.replace))
+            window = None
+        if window is None:
+            window = self.windows[key] = Window(event, self.interval)
+            self.first_end = min(self.first_end, window.end)
+        window.add(event.data)
+        return ended
+
+    def expire(self, now):
+        """Aggregates of the windows ended more than GRACE seconds
+        before now"""
+        if self.first_end + GRACE >= now:
+            return []
+        expired = [
+            key
+            for key, window in self.windows.items()
+            if window.end + GRACE < now
+        ]
+        aggregates = [
+            self.windows.pop(key).aggregate(self.replace) for key in expired
+        ]
+        self.first_end = min(
+            (window.end for window in self.windows.values()),
+            default=float("inf"),
+        )
+        return aggregates
+
+
+async def aggregated(events, interval, replace=True):
+    """
+    Yield the events, with the readings of sensors aggregated over windows
+    of interval seconds. Unless replace, the readings are yielded too
+    """
+    aggregator = Aggregator(interval, replace)
+    loop = asyncio.get_event_loop()
+    # the clock of the events, e.g. of a replayed capture
+    clock = None
+    events = events.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = loop.create_task(events.__anext__())
+            done, _ = await asyncio.wait([pending], timeout=GRACE)
+            if clock:
+                timestamp, received = clock
+                for aggregate in aggregator.expire(
+                    timestamp + loop.time() - received
+                ):
+                    yield aggregate
+            if not done:
+                continue
+            pending = None
+            try:
+                event = done.pop().result()
+            except StopAsyncIteration:
+                break
+            if not event:
+                continue
+            if not event.data:
+                yield event
+                continue
+            if event.timestamp:
+                clock = event.timestamp, loop.time()
+            for aggregate in aggregator.add(event):
+                yield aggregate
+            if not replace:
+                yield event
+        # end of stream, e.g. a replayed capture
+        for aggregate in aggregator.expire(float("inf")):
+            yield aggregate
+    finally:
+        if pending:
+            pending.cancel()
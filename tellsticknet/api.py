@@ -0,0 +1,324 @@
+"""
+local HTTP api, for tools not speaking MQTT
+
+GET /state       latest state of each configured device and sensor
+POST /command    {"name": "Kitchen", "method": "turnon"}, or the device
+                 properties instead of the name, with an optional param
+GET /unknown     transmitters not in the configuration, see catalog
+WS /events       stream of decoded events, as JSON, optionally filtered
+                 with query parameters, e.g. ?protocol=fineoffset&sensorId=135
+
+The state document is kept serialized, only the entry of the device of an
+event is serialized again. Each websocket client has a bounded queue of
+QUEUE_SIZE events, the oldest are dropped when a client does not keep up.
+"""
+
+import asyncio
+import json
+import logging
+from collections import Counter
+
+from . import const
+from .catalog import Catalog
+from .config import DEVICE_PROPERTIES, Config, group_key, match_key
+from .event import Filter
+
+_LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/json"
+
+# events queued per websocket client
+QUEUE_SIZE = 100
+
+# query parameters of /events, with integer values
+INTEGER_CRITERIA = ("sensorId", "house", "unit")
+
+
+def method_constant(method):
+    """
+    >>> method_constant("turnon")
+    1
+    >>> method_constant("explode")
+    """
+    method = getattr(const, str(method).upper(), None)
+    return method if isinstance(method, int) else None
+
+
+def event_filter(query):
+    """
+    Filter from the query parameters of /events, None for all events
+
+    >>> event_filter(dict(protocol=["fineoffset"], sensorId=["135", "136"]))
+    Filter(protocol=['fineoffset'], sensorId=[135, 136])
+    >>> event_filter(dict(foo=["bar"]))
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown criterion foo
+    """
+    criteria = {}
+    for key, values in query.items():
+        name = "class_" if key == "class" else key
+        if name in INTEGER_CRITERIA:
+            values = [int(value) for value in values]
+        elif name not in ("protocol", "model", "class_"):
+            raise ValueError(f"Unknown criterion {key}")
+        criteria[name] = values
+    return Filter(**criteria) if criteria else None
+
+
+class State:
+    """
+    Latest state of the configured entities, serialized
+
+    >>> from .event import Event
+    >>> state = State(Config([dict(name="Outdoor", protocol="fineoffset", \
+sensorId=135)]))
+    >>> state.update(Event.from_fields(dict(protocol="fineoffset", \
+sensorId=135, data=dict(temp=16.7), timestamp=1000.0)))
+    ['Outdoor']
+    >>> state.body
+    b'{"Outdoor": {"data": {"temp": 16.7}, "time": 1000.0}}'
+    """
+
+    def __init__(self, config=()):
+        self._entries = {}  # name -> dict
+        self._serialized = {}  # name -> bytes
+        self._body = None
+        self.reload(config)
+
+    def reload(self, config):
+        if not isinstance(config, Config):
+            config = Config(config)
+        self._names = {}  # match key -> names
+        self._group_names = {}  # group key -> names
+        for entity, compiled in zip(config, config.compiled):
+            for key in compiled.keys:
+                self._names.setdefault(key, []).append(entity["name"])
+            for key in compiled.group_keys:
+                self._group_names.setdefault(key, []).append(entity["name"])
+        names = {entity["name"] for entity in config}
+        for name in list(self._entries):
+            if name not in names:
+                del self._entries[name]
+                del self._serialized[name]
+        self._body = None
+
+    def names(self, event):
+        """Names of the entities the event is from"""
+        key = match_key(event)
+        if event.group:
+            return self._group_names.get(group_key(key), ())
+        return self._names.get(key, ())
+
+    def set(self, name, timestamp, method=None, data=None):
+        entry = self._entries.setdefault(name, {})
+        if method is not None:
+            entry["method"] = method
+        if data:
+            entry.setdefault("data", {}).update(data)
+        entry["time"] = timestamp
+        self._serialized[name] = b"%s: %s" % (
+            json.dumps(name).encode(),
+            json.dumps(entry).encode(),
+        )
+        self._body = None
+
+    def update(self, event):
+        """Returns the names of the entities updated"""
+        names = self.names(event)
+        for name in names:
+            self.set(
+                name,
+                event.timestamp,
+                method=None if event.data else event.method,
+                data=event.data and {q.value: v for q, v in event.data},
+            )
+        return names
+
+    @property
+    def body(self):
+        """The JSON document of all entries, joined again only after a
+        change"""
+        if self._body is None:
+            self._body = b"{%s}" % b", ".join(self._serialized.values())
+        return self._body
+
+
+class Client:
+    __slots__ = ("filter", "queue", "dropped")
+
+    def __init__(self, filter_, size):
+        self.filter = filter_
+        self.queue = asyncio.Queue(maxsize=size)
+        self.dropped = 0
+
+    def offer(self, message):
+        """Queue the message, dropping the oldest if the queue is full"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+
+class Api:
+    """The api of a controller, updated with its events, see the api
+    option of Controller"""
+
+    def __init__(self, config=(), queue_size=QUEUE_SIZE):
+        self.controller = None
+        self.config = Config()
+        self.state = State()
+        self.queue_size = queue_size
+        self.clients = set()
+        # transmitters not configured, logged by the gateway
+        self.catalog = Catalog(log=False)
+        # events, commands, dropped
+        self.stats = Counter()
+        self.reload(config)
+
+    def reload(self, config):
+        """Use a new configuration, e.g. from config.watch"""
+        if not isinstance(config, Config):
+            config = Config(config)
+        self.config = config
+        self.state.reload(config)
+
+    def update(self, event):
+        """Receive an event from the controller"""
+        self.stats["events"] += 1
+        if not self.state.update(event):
+            self.catalog.add(event)
+        message = None
+        for client in self.clients:
+            if client.filter and not client.filter.accepts(event):
+                continue
+            if message is None:
+                message = json.dumps(event.as_dict())
+            if client.queue.full():
+                self.stats["dropped"] += 1
+            client.offer(message)
+
+    async def get_state(self, request):
+        return 200, self.state.body, CONTENT_TYPE
+
+    async def get_unknown(self, request):
+        return 200, json.dumps(self.catalog.dump()), CONTENT_TYPE
+
+    def _find(self, name):
+        """The entity of the name, and its compiled form"""
+        return next(
+            (
+                (entity, compiled)
+                for entity, compiled in zip(self.config, self.config.compiled)
+                if entity["name"] == name
+            ),
+            (None, None),
+        )
+
+    async def post_command(self, request):
+        from .protocol import encode
+
+        try:
+            command = json.loads(request.body)
+            method = method_constant(command.pop("method"))
+            param = command.pop("param", None)
+        except (ValueError, KeyError, AttributeError, TypeError):
+            return 400, "Expected an object with a method"
+        if not method:
+            return 400, "Unknown method"
+        frame = None
+        if "name" in command:
+            entity, compiled = self._find(command.pop("name"))
+            if not entity:
+                return 404, "Unknown device"
+            if not param:
+                frame = compiled.frames.get(method)
+            command.update((key, entity.get(key)) for key in DEVICE_PROPERTIES)
+        if set(command) - set(DEVICE_PROPERTIES):
+            return 400, "Unknown device properties"
+        command = {key: command.get(key) for key in DEVICE_PROPERTIES}
+        try:
+            frame = frame or encode(**command, method=method, param=param)
+        except (AttributeError, NotImplementedError, TypeError, ValueError):
+            return 400, "Can not encode the command"
+        if not self.controller:
+            return 503, "No controller found yet"
+        self.stats["commands"] += 1
+        self.controller.execute(command, method, param=param, frame=frame)
+        return 202, json.dumps(dict(command, method=method)), CONTENT_TYPE
+
+    async def events(self, request, websocket):
+        try:
+            client = Client(event_filter(request.query), self.queue_size)
+        except ValueError as e:
+            await websocket.send(json.dumps(dict(error=str(e))))
+            return
+
+        async def receive():
+            # only to notice the client closing the connection
+            while await websocket.receive() is not None:
+                pass
+            client.offer(None)
+
+        self.clients.add(client)
+        receiver = asyncio.get_event_loop().create_task(receive())
+        _LOGGER.info("Streaming events to a client, %s", client.filter)
+        try:
+            while True:
+                message = await client.queue.get()
+                if message is None:
+                    break
+                await websocket.send(message)
+        except ConnectionError:
+            pass
+        finally:
+            receiver.cancel()
+            self.clients.discard(client)
+            _LOGGER.info(
+                "Client left, %d events dropped for it", client.dropped
+            )
+
+    def routes(self):
+        return {
+            ("GET", "/state"): self.get_state,
+            ("GET", "/unknown"): self.get_unknown,
+            ("POST", "/command"): self.post_command,
+            ("WS", "/events"): self.events,
+        }
+
+    async def serve(self, address):
+        """Serve the api on http://address/, the metrics are collected
+        until the server is closed"""
+        from . import metrics
+        from .httpd import serve
+
+        server = await serve(self.routes(), address)
+        if self.collect_metrics not in metrics.COLLECTORS:
+            metrics.COLLECTORS.append(self.collect_metrics)
+            asyncio.ensure_future(self._unregister(server))
+        return server
+
+    async def _unregister(self, server):
+        from . import metrics
+
+        try:
+            await server.wait_closed()
+        finally:
+            metrics.COLLECTORS.remove(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Lines of metrics for the api, see tellsticknet.metrics"""
+        from .metrics import family
+
+        yield from family(
+            "api_clients",
+            "gauge",
+            "Connected websocket clients",
+            [({}, len(self.clients))],
+        )
+        yield from family(
+            "api_dropped_total",
+            "counter",
+            "Events dropped for websocket clients not keeping up",
+            [({}, self.stats["dropped"])],
+        )
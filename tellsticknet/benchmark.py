@@ -0,0 +1,337 @@
+"""
+benchmarks of the packet codec, the receive pipeline and the startup of
+the command line tool
+
+Usage:
+  python -m tellsticknet.benchmark run [<result.json>]
+  python -m tellsticknet.benchmark compare <baseline.json> <result.json>
+  python -m tellsticknet.benchmark startup
+
+run writes the results as JSON, to stdout by default. compare exits with
+status 1 if any benchmark is slower than the baseline by more than the
+tolerance. startup prints the startup time of the subcommands, with the
+import time per package.
+"""
+
+import asyncio
+import json
+import logging
+import platform
+import random
+import subprocess
+from collections import Counter
+from datetime import datetime
+from functools import partial
+from os import environ
+from os.path import dirname, join
+from statistics import median
+from sys import argv, executable, stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from timeit import Timer
+
+import yaml
+
+from . import __version__, const, emulator, testing
+from .protocol import encode_packet, decode_packet
+from .protocols import arctech
+
+_LOGGER = logging.getLogger(__name__)
+
+REPEAT = 5
+
+# packets per round of the pipeline benchmarks
+PIPELINE_PACKETS = 2000
+
+# slowdown flagged as a regression
+TOLERANCE = 0.2
+
+SEED = 4711
+
+# the subcommands are run with a config of the simulated devices, the ones
+# talking to a controller only as far as the imports before discovery
+STARTUP = dict(
+    help=["-m", "tellsticknet", "--help"],
+    devices=["-m", "tellsticknet", "devices"],
+    sensors=["-m", "tellsticknet", "sensors"],
+    parse=["-m", "tellsticknet", "parse"],
+    listen=["-c", "import tellsticknet.__main__, tellsticknet.controller"],
+    mqtt=[
+        "-c",
+        "import tellsticknet.__main__, tellsticknet.controller, "
+        "tellsticknet.mqtt, hbmqtt.client",
+    ],
+)
+
+# packages listed in the import time breakdown
+IMPORTS = 10
+
+SAMPLES = dict(
+    fineoffset_firmware=emulator.fineoffset(135, 16.7, 34),
+    fineoffset=dict(
+        (k, v)
+        for k, v in emulator.fineoffset(135, 16.7, 34).items()
+        if k not in ("id", "values")
+    ),
+    mandolyn=emulator.mandolyn(3, 2, 20.4, 29),
+    oregon=emulator.oregon(31, 24.2, 45),
+    arctech_selflearning=emulator.selflearning(1329110, 1, "turnon"),
+    arctech_codeswitch=emulator.codeswitch("A", 1, "turnon"),
+    everflourish=emulator.everflourish(4242, 3, "turnon"),
+)
+
+
+def measure(func, repeat=REPEAT):
+    """
+    Time func, in microseconds per call
+
+    >>> sorted(measure(lambda: None, repeat=1))
+    ['median_us', 'ops_per_sec', 'us_per_op']
+    """
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    rounds = [t / number for t in timer.repeat(repeat, number)]
+    return _result(rounds)
+
+
+def measure_pipeline(pipeline, count=PIPELINE_PACKETS, repeat=REPEAT):
+    """Time the coroutine function pipeline, in microseconds per packet"""
+    rounds = []
+    for _ in range(repeat):
+        packets = list(
+            testing.packets(
+                emulator.population(30, 10, random.Random(SEED)),
+                count,
+                random.Random(SEED),
+            )
+        )
+        then = perf_counter()
+        asyncio.run(pipeline(packets))  # pylint: disable=no-member
+        rounds.append((perf_counter() - then) / count)
+    return _result(rounds)
+
+
+def measure_startup(args, repeat=REPEAT):
+    """Time running python with args in a fresh interpreter, in microseconds,
+    with the import time breakdown of one more run with -X importtime"""
+    population = emulator.population(30, 10, random.Random(SEED))
+    packets = "\n".join(testing.packets(population, 100, random.Random(SEED)))
+    with TemporaryDirectory() as home:
+        with open(join(home, "tellsticknet.conf"), "w") as f:
+            yaml.safe_dump_all(testing.config(population), f)
+        run = partial(
+            subprocess.run,
+            input=packets,
+            env=dict(environ, HOME=home, XDG_CONFIG_HOME=home),
+            cwd=dirname(dirname(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        rounds = []
+        for _ in range(repeat):
+            then = perf_counter()
+            run([executable] + args)
+            rounds.append(perf_counter() - then)
+        report = run([executable, "-X", "importtime"] + args).stderr
+    return dict(_result(rounds), imports=import_times(report))
+
+
+def import_times(report, top=IMPORTS):
+    """
+    Import time in microseconds per top level package, of an -X importtime
+    report, slowest first
+
+    >>> import_times("import time: self [us] | cumulative | \
+imported package\\nimport time:   814 |   814 |   asyncio.events\\n\
+import time:  5581 |  6395 | asyncio\\nimport time:   100 |   100 | json")
+    {'asyncio': 6395, 'json': 100}
+    """
+    times = Counter()
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        us, _, package = line[len("import time:") :].split("|")
+        if us.strip().isdigit():
+            times[package.strip().split(".")[0]] += int(us)
+    return dict(times.most_common(top))
+
+
+def _last_line(output):
+    """
+    >>> _last_line("Traceback\\nImportError: x\\n")
+    'ImportError: x'
+    """
+    lines = output.strip().splitlines()
+    return lines[-1] if lines else ""
+
+
+def _result(rounds):
+    best = min(rounds)
+    return dict(
+        us_per_op=round(1e6 * best, 3),
+        median_us=round(1e6 * median(rounds), 3),
+        ops_per_sec=round(1 / best) if best else None,
+    )
+
+
+async def events_pipeline(packets):
+    """Receive and decode the packets with Controller.events()"""
+    controller = testing.PacketSource(packets)
+    async for event in controller.events():
+        bool(event)  # decode
+
+
+async def mqtt_pipeline(packets, configured=None):
+    """Route the events to the MQTT gateway devices, publishing to a
+    stand-in broker. With configured, only that many devices are
+    configured, the events of the others go to the catalog"""
+    from .catalog import Catalog
+    from .mqtt import Device, dispatch
+
+    mqtt = testing.MQTTClient()
+    await mqtt.connect()
+    controller = testing.PacketSource(packets)
+    devices = [
+        Device(entity, mqtt, controller)
+        for entity in testing.config(
+            emulator.population(30, 10, random.Random(SEED))
+        )[:configured]
+    ]
+    catalog = Catalog()
+    async for event in controller.events():
+        if event:
+            await dispatch(devices, event, catalog)
+
+
+def benchmarks():
+    """Yield (name, function returning the result) of all benchmarks"""
+    device = arctech.encode(
+        model="selflearning",
+        house=1329110,
+        unit=1,
+        method=const.TURNON,
+        param=None,
+    )
+    yield "encode_packet/send", partial(
+        measure, partial(encode_packet, "send", **device)
+    )
+    for name, args in SAMPLES.items():
+        packet = encode_packet("RawData", **args).decode("ascii")
+        yield f"decode_packet/{name}", partial(
+            measure, partial(decode_packet, packet)
+        )
+    for name, method, param in (
+        ("turnon", const.TURNON, None),
+        ("dim", const.DIM, 128),
+    ):
+        yield f"arctech.encode/{name}", partial(
+            measure,
+            partial(
+                arctech.encode,
+                model="selflearning",
+                house=1329110,
+                unit=1,
+                method=method,
+                param=param,
+            ),
+        )
+    yield "pipeline/events", partial(measure_pipeline, events_pipeline)
+    yield "pipeline/mqtt", partial(measure_pipeline, mqtt_pipeline)
+    yield "pipeline/unconfigured", partial(
+        measure_pipeline, partial(mqtt_pipeline, configured=10)
+    )
+    for name, args in STARTUP.items():
+        yield f"startup/{name}", partial(measure_startup, args)
+
+
+def run():
+    results = {}
+    for name, benchmark in benchmarks():
+        try:
+            results[name] = benchmark()
+        except ImportError as e:  # e.g. hbmqtt not installed
+            _LOGGER.warning("Skipping %s: %s", name, e)
+            continue
+        except subprocess.CalledProcessError as e:
+            _LOGGER.warning("Skipping %s: %s", name, _last_line(e.stderr))
+            continue
+        _LOGGER.info("%-40s %10.3f us", name, results[name]["us_per_op"])
+    return dict(
+        version=__version__,
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        machine=platform.machine(),
+        time=datetime.now().replace(microsecond=0).isoformat(),
+        results=results,
+    )
+
+
+def compare(baseline, result, tolerance=TOLERANCE):
+    """
+    Compare results to the baseline, returns rows of
+    (name, baseline us, result us, relative change, regression)
+
+    >>> compare(dict(results=dict(a=dict(us_per_op=2.0))), \
+dict(results=dict(a=dict(us_per_op=3.0), b=dict(us_per_op=1.0))))
+    [('a', 2.0, 3.0, 0.5, True)]
+    """
+    rows = []
+    for name, current in sorted(result["results"].items()):
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        before, after = base["us_per_op"], current["us_per_op"]
+        change = round(after / before - 1, 3)
+        rows.append((name, before, after, change, change > tolerance))
+    return rows
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    # the pipelines log skipped and dropped packets
+    logging.getLogger("tellsticknet.mqtt").setLevel(logging.ERROR)
+    logging.getLogger("tellsticknet.event").setLevel(logging.ERROR)
+
+    if args[:1] == ["run"] and len(args) <= 2:
+        result = json.dumps(run(), indent=2)
+        if len(args) == 2:
+            with open(args[1], "w") as f:
+                f.write(result + "\n")
+        else:
+            stdout.write(result + "\n")
+    elif args[:1] == ["compare"] and len(args) == 3:
+        with open(args[1]) as f:
+            baseline = json.load(f)
+        with open(args[2]) as f:
+            result = json.load(f)
+        rows = compare(baseline, result)
+        for name, before, after, change, regression in rows:
+            print(
+                "%-40s %10.3f %10.3f %+7.1f%%%s"
+                % (
+                    name,
+                    before,
+                    after,
+                    100 * change,
+                    "  REGRESSION" if regression else "",
+                )
+            )
+        if any(row[-1] for row in rows):
+            exit(1)
+    elif args == ["startup"]:
+        for name, args in STARTUP.items():
+            try:
+                result = measure_startup(args)
+            except subprocess.CalledProcessError as e:
+                _LOGGER.warning("Skipping %s: %s", name, _last_line(e.stderr))
+                continue
+            print("%-10s %8.1f ms" % (name, result["us_per_op"] / 1000))
+            for package, us in result["imports"].items():
+                print("  %-30s %8.1f ms" % (package, us / 1000))
+    else:
+        exit(__doc__)
+
+
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,149 @@
+"""
+catalog of the transmitters not in the configuration
+
+In a dense neighbourhood most packets are from the sensors and remotes of
+others. Instead of logging every one of them, the gateway counts them per
+transmitter, with the time first and last heard and the last event. A new
+transmitter is logged once, the others in a summary at most every
+LOG_INTERVAL seconds. The catalog is written to CATALOG_FILE, printed by
+the unknown command, and served by the api on /unknown, to adopt new
+sensors in the configuration.
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from os import environ as env, makedirs, replace
+from os.path import join, dirname, expanduser
+from time import time, monotonic
+
+from .config import DEVICE_PROPERTIES, match_key
+
+_LOGGER = logging.getLogger(__name__)
+
+CATALOG_FILE = join(
+    env.get("XDG_CACHE_HOME", join(expanduser("~"), ".cache")),
+    "tellsticknet",
+    "unknown.json",
+)
+
+# transmitters kept, the ones not heard from for the longest are dropped
+CAPACITY = 1000
+
+# seconds between the summaries of skipped packets
+LOG_INTERVAL = 600
+
+# seconds between writes of the catalog, when changed
+WRITE_INTERVAL = 60
+
+
+class Entry:
+    __slots__ = ("count", "first", "last", "event")
+
+    def __init__(self, event, now):
+        self.count = 0
+        self.first = now
+        self.last = now
+        self.event = event
+
+    def as_dict(self):
+        event = self.event.as_dict()
+        return dict(
+            {
+                prop: event[prop]
+                for prop in ("class", *DEVICE_PROPERTIES)
+                if prop in event
+            },
+            count=self.count,
+            first=round(self.first, 3),
+            last=round(self.last, 3),
+            event=event,
+        )
+
+
+class Catalog:
+    """
+    Transmitters of the events not matching any configured entity
+
+    >>> from .event import Event
+    >>> catalog = Catalog()
+    >>> for temp in (16.7, 16.8):
+    ...     catalog.add(Event.from_fields(dict(protocol="fineoffset", \
+model="temperature", sensorId=135, data=dict(temp=temp))))
+    >>> [(e["sensorId"], e["count"], e["event"]["data"]) for e in \
+catalog.dump()]
+    [(135, 2, [{'name': 'temp', 'value': 16.8}])]
+    """
+
+    def __init__(self, capacity=CAPACITY, log=True):
+        self.capacity = capacity
+        # whether to log the transmitters, one catalog per process does
+        self.log = log
+        self.entries = OrderedDict()  # match key -> Entry, last heard last
+        self.changed = False
+        self._skipped = 0
+        self._next_log = monotonic() + LOG_INTERVAL
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, event):
+        now = event.timestamp or time()
+        key = match_key(event)
+        entry = self.entries.get(key)
+        if entry is None:
+            if self.log:
+                _LOGGER.info("New unconfigured transmitter %s", event)
+            entry = self.entries[key] = Entry(event, now)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+            entry.event = event
+            entry.last = now
+        entry.count += 1
+        self.changed = True
+        self._skipped += 1
+        if self.log and monotonic() >= self._next_log:
+            _LOGGER.info(
+                "Skipped %d packets of unconfigured transmitters, %d known",
+                self._skipped,
+                len(self.entries),
+            )
+            self._skipped = 0
+            self._next_log = monotonic() + LOG_INTERVAL
+
+    def dump(self):
+        """The entries, most packets first"""
+        return sorted(
+            (entry.as_dict() for entry in self.entries.values()),
+            key=lambda entry: -entry["count"],
+        )
+
+    def write(self, filename=CATALOG_FILE):
+        try:
+            makedirs(dirname(filename), exist_ok=True)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(self.dump(), f)
+            replace(filename + ".tmp", filename)
+            self.changed = False
+        except OSError as e:
+            _LOGGER.warning("Could not write catalog %s: %s", filename, e)
+
+
+def read(filename=CATALOG_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+async def write_task(catalog, filename=CATALOG_FILE, interval=WRITE_INTERVAL):
+    """Write the catalog periodically, when changed"""
+    import asyncio
+
+    while True:
+        await asyncio.sleep(interval)
+        if catalog.changed:
+            catalog.write(filename)
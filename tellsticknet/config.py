@@ -0,0 +1,267 @@
+"""
+the configuration file of devices and sensors
+
+The YAML documents are compiled once, with the keys matching the events of
+each entity and the encoded command frames, and cached with pickle. The
+cache is keyed by the path, modification time and hash of the file, and
+the file is parsed again when any of them changes.
+"""
+
+import logging
+import pickle
+from collections import namedtuple
+from hashlib import sha256
+from itertools import product
+from os import environ as env, fstat, makedirs, replace, stat
+from os.path import join, dirname, expanduser
+from sys import argv
+
+from . import __version__, const
+
+_LOGGER = logging.getLogger(__name__)
+
+CONFIG_DIRECTORIES = [
+    dirname(argv[0]),
+    expanduser("~"),
+    env.get("XDG_CONFIG_HOME", join(expanduser("~"), ".config")),
+]
+
+CONFIG_FILES = ["tellsticknet.conf", ".tellsticknet.conf"]
+
+CACHE_FILE = join(
+    env.get("XDG_CACHE_HOME", join(expanduser("~"), ".cache")),
+    "tellsticknet",
+    "config.pickle",
+)
+
+# seconds between checks of the configuration file for changes
+WATCH_INTERVAL = 5
+
+# bump when the compiled format changes
+CACHE_VERSION = 1
+
+# properties of an event identifying the device or sensor sending it
+DEVICE_PROPERTIES = ["protocol", "model", "unit", "house", "sensorId"]
+
+# index of the unit, ignored for group commands
+UNIT = DEVICE_PROPERTIES.index("unit")
+
+# methods without parameter, encoded in advance for commands
+FRAME_METHODS = [const.TURNON, const.TURNOFF]
+
+# components of the entities sending commands, see mqtt.Device
+COMMAND_COMPONENTS = ["switch", "light", "lock"]
+
+Compiled = namedtuple("Compiled", "keys group_keys frames")
+
+
+def match_key(device):
+    """
+    Key matching an event from the device, a dict or an event
+
+    >>> match_key(dict(protocol="arctech", house=1, unit=2))
+    ('arctech', None, 2, 1, None)
+    """
+    if isinstance(device, dict):
+        return tuple(device.get(prop) for prop in DEVICE_PROPERTIES)
+    return tuple(getattr(device, prop) for prop in DEVICE_PROPERTIES)
+
+
+def group_key(key):
+    """
+    The key without the unit
+
+    >>> group_key(('arctech', None, 2, 1, None))
+    ('arctech', None, 1, None)
+    """
+    return key[:UNIT] + key[UNIT + 1 :]
+
+
+def command_frames(entity):
+    """
+    Packets for the methods in FRAME_METHODS of the command components,
+    none for protocols that can not be encoded
+
+    >>> frames = command_frames(dict(component="switch", protocol="arctech", \
+model="selflearning", house=2399406, unit=1))
+    >>> frames[const.TURNOFF]["method"] == const.TURNOFF
+    True
+    >>> command_frames(dict(protocol="fineoffset", sensorId=135))
+    {}
+    >>> command_frames(dict(component="switch", protocol="hasta", house=1))
+    {}
+    """
+    if entity.get("component") not in COMMAND_COMPONENTS:
+        return {}
+    from .protocol import encode
+
+    command = dict((k, entity.get(k)) for k in DEVICE_PROPERTIES)
+    frames = {}
+    for method in FRAME_METHODS:
+        try:
+            frames[method] = encode(**command, method=method, param=None)
+        except (
+            AttributeError,
+            ImportError,
+            NotImplementedError,
+            TypeError,
+            ValueError,
+        ):
+            _LOGGER.debug("Can not encode commands for %s", entity)
+            return {}
+    return frames
+
+
+def compile_entity(entity):
+    """Match keys of the entity and its aliases, and the command frames"""
+    if not isinstance(entity, dict) or not entity.get("name"):
+        raise ValueError(f"Name is missing for entity {entity}")
+    keys = frozenset(
+        match_key(command)
+        for command in [entity] + list(entity.get("aliases", []))
+    )
+    return Compiled(
+        keys=keys,
+        group_keys=frozenset(group_key(key) for key in keys),
+        frames=command_frames(entity),
+    )
+
+
+class Config(list):
+    """
+    The entities of the configuration, with the compiled entities in
+    compiled
+
+    >>> config = Config([dict(name="Kitchen", component="light", \
+protocol="arctech", model="selflearning", house=2399406, unit=1)])
+    >>> config.compiled[0].keys
+    frozenset({('arctech', 'selflearning', 1, 2399406, None)})
+    >>> sorted(config.compiled[0].frames)
+    [1, 2]
+    """
+
+    def __init__(self, entities=()):
+        super().__init__(entities)
+        self.compiled = [compile_entity(entity) for entity in self]
+
+
+def find():
+    """Path of the first configuration file found, None if there is none"""
+    for directory, filename in product(CONFIG_DIRECTORIES, CONFIG_FILES):
+        config = join(directory, filename)
+        _LOGGER.debug("checking for config file %s", config)
+        try:
+            with open(config):
+                return config
+        except OSError:
+            continue
+    return None
+
+
+def load(data):
+    """
+    Parse the YAML documents
+
+    >>> load("name: [")
+    Traceback (most recent call last):
+        ...
+    ValueError: while parsing a flow node...
+    """
+    from yaml import safe_load_all as load_yaml, YAMLError
+
+    try:
+        return Config(entity for entity in load_yaml(data) if entity)
+    except YAMLError as e:
+        raise ValueError(e) from e
+
+
+def _read_cache(key, filename):
+    try:
+        with open(filename, "rb") as f:
+            cached = pickle.load(f)
+    except Exception as e:  # pylint: disable=broad-except
+        # a corrupt cache can raise about anything when unpickled
+        _LOGGER.debug("Could not read config cache %s: %s", filename, e)
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        _LOGGER.debug("Config cache %s is stale", filename)
+        return None
+    return cached["config"]
+
+
+def _write_cache(key, config, filename):
+    try:
+        makedirs(dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump(dict(key=key, config=config), f)
+        replace(filename + ".tmp", filename)
+    except OSError as e:
+        _LOGGER.debug("Could not write config cache %s: %s", filename, e)
+
+
+def read_config(filename=None, cache=CACHE_FILE):
+    """
+    Read the configuration file, by default the first one found, from the
+    cache if it is up to date
+
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as d:
+    ...     filename = join(d, "tellsticknet.conf")
+    ...     with open(filename, "w") as f:
+    ...         _ = f.write("name: Door\\nprotocol: arctech\\n---\\n")
+    ...     cache = join(d, "config.pickle")
+    ...     read_config(filename, cache) == read_config(filename, cache)
+    True
+    """
+    filename = filename or find()
+    if not filename:
+        return Config()
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+            mtime = fstat(f.fileno()).st_mtime_ns
+    except OSError as e:
+        _LOGGER.warning("Could not read config file %s: %s", filename, e)
+        return Config()
+    key = (
+        CACHE_VERSION,
+        __version__,
+        filename,
+        mtime,
+        sha256(data).hexdigest(),
+    )
+    config = _read_cache(key, cache) if cache else None
+    if config is not None:
+        _LOGGER.debug("Read %d entities from %s", len(config), cache)
+        return config
+    config = load(data)
+    _LOGGER.debug("Parsed %d entities from %s", len(config), filename)
+    if cache:
+        _write_cache(key, config, cache)
+    return config
+
+
+async def watch(filename, interval=WATCH_INTERVAL, cache=CACHE_FILE):
+    """Yield the configuration again each time the file is modified,
+    invalid configurations are logged and skipped"""
+    import asyncio
+
+    def modified():
+        try:
+            info = stat(filename)
+            return info.st_mtime_ns, info.st_size
+        except OSError:
+            return None
+
+    last = modified()
+    while True:
+        await asyncio.sleep(interval)
+        current = modified()
+        if current is None or current == last:
+            continue
+        last = current
+        _LOGGER.info("Config file %s modified", filename)
+        try:
+            yield read_config(filename, cache)
+        except ValueError as e:
+            _LOGGER.error("Invalid config, keeping the previous: %s", e)
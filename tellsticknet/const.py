@@ -1,3 +1,5 @@
+from enum import Enum
+
 # Commands/methods
 TURNON = 1
 TURNOFF = 2
@@ -25,7 +27,42 @@ LUMINANCE = "lum"
 DEW_POINT = "dewp"
 BAROMETRIC_PRESSURE = "barpress"
 
+
+class Quantity(str, Enum):
+    """Sensor quantity, compares equal to the plain sensor type strings"""
+
+    TEMPERATURE = TEMPERATURE
+    HUMIDITY = HUMIDITY
+    RAINRATE = RAINRATE
+    RAINTOTAL = RAINTOTAL
+    WINDDIRECTION = WINDDIRECTION
+    WINDAVERAGE = WINDAVERAGE
+    WINDGUST = WINDGUST
+    UV = UV
+    POWER = POWER
+    LUMINANCE = LUMINANCE
+    DEW_POINT = DEW_POINT
+    BAROMETRIC_PRESSURE = BAROMETRIC_PRESSURE
+
+
 # Battery status
 BATTERY_LOW = 255
 BATTERY_UNKNOWN = 254
 BATTERY_OK = 253
+
+# Sensor type ids as reported by newer firmware in the RawData "values" list
+# https://github.com/telldus/telldus/blob/master/telldus-core/client/telldus-core.h
+SENSOR_TYPES = {
+    1: TEMPERATURE,
+    2: HUMIDITY,
+    4: RAINRATE,
+    8: RAINTOTAL,
+    16: WINDDIRECTION,
+    32: WINDAVERAGE,
+    64: WINDGUST,
+    128: UV,
+    256: POWER,
+    512: LUMINANCE,
+    1024: DEW_POINT,
+    2048: BAROMETRIC_PRESSURE,
+}
@@ -1,11 +1,31 @@
 import socket
 import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
-from time import time
-from . import discovery
-from .protocol import encode_packet, decode_packet, encode
+from time import time, monotonic
+from weakref import WeakSet
+from . import discovery, monitor
+from .protocol import (
+    encode_packet,
+    decode_event,
+    decode_eagerly,
+    decode_counted,
+    merge_counted,
+    encode,
+)
 import asyncio
-from .util import sock_recvfrom, sock_sendto
+from .event import Filter
+from .util import (
+    sock_recvmsgs,
+    sock_sendto,
+    enable_timestamps,
+    enable_drop_counter,
+    set_receive_buffer,
+    kernel_timestamp,
+    dropped_count,
+    ANCILLARY_SIZE,
+)
 
 COMMAND_PORT = 42314
 TIMEOUT = timedelta(seconds=30)
@@ -18,16 +38,27 @@ REGISTRATION_INTERVAL = timedelta(minutes=10)
 COMMAND_REPEAT_TIMES = 2
 COMMAND_REPEAT_DELAY = timedelta(seconds=1)
 
+# max number of packets waiting to be decoded in the worker pool
+DECODE_QUEUE_SIZE = 1000
+
 _LOGGER = logging.getLogger(__name__)
 
 
-async def discover(ip=None, discover_all=False):
+async def discover(ip=None, discover_all=False, **options):
     """
     Return all found controllers on the local network
+    options are passed on to the Controller
     """
 
     def make_controller(discovery_data):
-        return Controller(*discovery_data[:2])
+        monitor.milestone("discovered")
+        return Controller(*discovery_data[:2], **options)
+
+    if not discover_all:
+        cached = await discovery.discover_cached(ip=ip)
+        if cached:
+            _LOGGER.info("Using cached controller at %s", cached[0])
+            return make_controller(cached)
 
     discoverer = discovery.discover(
         ip=ip, discover_all=discover_all
@@ -46,11 +77,44 @@ async def discover(ip=None, discover_all=False):
 
 
 class Controller:
-    def __init__(self, ip, mac):
+
+    # all controllers created, for metrics
+    instances = WeakSet()
+
+    def __init__(
+        self,
+        ip,
+        mac,
+        executor=None,
+        rcvbuf=None,
+        rediscover=None,
+        table=None,
+        hub=None,
+        api=None,
+    ):
         self._address = (ip, COMMAND_PORT)
         self._mac = mac
         self._last_registration = None
         self._commands = None
+        # optional concurrent.futures executor to decode packets in
+        self._executor = executor
+        # worker processes do not share the decoder counters
+        self._processes = isinstance(executor, ProcessPoolExecutor)
+        # SO_RCVBUF for the listener socket, None for the system default
+        self._rcvbuf = rcvbuf
+        # seconds between rediscovery of the address, None to never
+        self._rediscover = rediscover
+        self._address_changed = None
+        # optional table.Table and api.Api, updated with the events
+        self._observers = [o for o in (table, api) if o is not None]
+        if api is not None:
+            api.controller = self
+        # path of a hub.Hub to receive the datagrams from, instead of
+        # listening and registering at the controller
+        self._hub = hub
+        # datagrams, unknown_sender, receive_errors, commands, kernel_drops
+        self.stats = Counter()
+        Controller.instances.add(self)
         _LOGGER.debug("Created controller: %s", self)
 
     @property
@@ -64,6 +128,28 @@ class Controller:
     def __repr__(self):
         return f"Controller@{self.ip_address} ({self.mac_address})"
 
+    def update_address(self, ip):
+        """Use a new IP address, e.g. after a DHCP lease changed"""
+        if ip == self.ip_address:
+            return
+        _LOGGER.warning(
+            "Controller %s moved from %s to %s",
+            self.mac_address,
+            self.ip_address,
+            ip,
+        )
+        self._address = (ip, COMMAND_PORT)
+        if self._address_changed:
+            self._address_changed.set()
+
+    async def _rediscover_task(self):
+        while True:
+            await asyncio.sleep(self._rediscover)
+            _LOGGER.debug("Rediscovering %s", self)
+            async for ip, mac, *_ in discovery.discover(discover_all=True):
+                if mac.lower() == self.mac_address:
+                    self.update_address(ip)
+
     async def _send(self, sock, command, **args):
         """Send a command to the controller
         Available commands documented in
@@ -77,8 +163,16 @@ class Controller:
         if res != len(packet):
             raise OSError("Could not send all of packet")
 
-    async def packets(self):
-        """Listen forever for network events, yield stream of packets"""
+    async def datagrams(self):
+        """Listen forever for network events, yield stream of
+        (packet, receive timestamp from the kernel)"""
+
+        if self._hub:
+            from . import hub
+
+            async for datagram in hub.datagrams(self._hub, self):
+                yield datagram
+            return
 
         async def registrator_task(sock):
             while True:
@@ -92,60 +186,216 @@ class Controller:
                     # just retry
                     _LOGGER.warning("Could not send registration packet")
                     pass
-                await asyncio.sleep(REGISTRATION_INTERVAL.seconds)
+                try:
+                    # register at once if the address changes
+                    await asyncio.wait_for(
+                        self._address_changed.wait(),
+                        REGISTRATION_INTERVAL.total_seconds(),
+                    )
+                    self._address_changed.clear()
+                except asyncio.TimeoutError:
+                    pass
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if not enable_timestamps(sock):
+                _LOGGER.debug("No kernel receive timestamps available")
+            if not enable_drop_counter(sock):
+                _LOGGER.debug("No kernel drop counter available")
+            _LOGGER.debug(
+                "Receive buffer size is %d bytes",
+                set_receive_buffer(sock, self._rcvbuf),
+            )
             sock.bind(("", COMMAND_PORT))
             sock.setblocking(0)
             loop = asyncio.get_event_loop()
-            loop.create_task(registrator_task(sock))
-            while True:
-                try:
-                    response, address = await sock_recvfrom(sock, 1024)
-                    _LOGGER.debug("Got packet from %s", address)
-                    if address == self._address:
-                        yield response.decode("ascii")
-                    else:
-                        _LOGGER.warning(
-                            "Got unknown response from %s: %s",
-                            address,
-                            response,
-                        )
-                except OSError as e:
-                    _LOGGER.warning("Could not receive from socket: %s", e)
-
-    async def events(self):
-        async for packet in self.packets():  # pylint: disable=not-an-iterable
+            self._address_changed = asyncio.Event()
+            tasks = [loop.create_task(registrator_task(sock))]
+            if self._rediscover:
+                tasks.append(loop.create_task(self._rediscover_task()))
+            try:
+                async for datagram in self._receive(sock):
+                    yield datagram
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def _receive(self, sock):
+        dropped = 0
+        while True:
+            try:
+                batch = await sock_recvmsgs(sock, 1024, ANCILLARY_SIZE)
+            except OSError as e:
+                self.stats["receive_errors"] += 1
+                _LOGGER.warning("Could not receive from socket: %s", e)
+                continue
+            for response, ancdata, _, address in batch:
+                count = dropped_count(ancdata)
+                if count is not None and count != dropped:
+                    # the counter is an uint32 that may wrap around
+                    lost = (count - dropped) % (1 << 32)
+                    self.stats["kernel_drops"] += lost
+                    _LOGGER.warning(
+                        "Kernel dropped %d datagrams, %d in total",
+                        lost,
+                        count,
+                    )
+                    dropped = count
+                _LOGGER.debug("Got packet from %s", address)
+                if address == self._address:
+                    if not self.stats["datagrams"]:
+                        monitor.milestone("first_packet")
+                    self.stats["datagrams"] += 1
+                    yield response.decode("ascii"), kernel_timestamp(ancdata)
+                else:
+                    self.stats["unknown_sender"] += 1
+                    _LOGGER.warning(
+                        "Got unknown response from %s: %s",
+                        address,
+                        response,
+                    )
+
+    async def packets(self):
+        """Listen forever for network events, yield stream of packets"""
+        async for packet, _ in self.datagrams():  # pylint: disable=E1133
+            yield packet
+
+    @staticmethod
+    def _stamp(event, packet, timestamp, received):
+        """Set the receive time of the event, start tracing it"""
+        delay = max(time() - timestamp, 0)
+        monitor.observe("receive", delay)
+        event.timestamp = timestamp
+        event.lastUpdated = int(timestamp)
+        if monitor.tracing():
+            event.trace = monitor.Trace(
+                packet, timestamp, received - delay, received
+            )
+
+    async def events(self, *filters):
+        """Yield stream of events, decoded on first access
+
+        If any event.Filter is given, only packets accepted by one of them
+        are yielded. Criteria on the packet header (protocol, model,
+        class_) are checked before the packet is decoded.
+
+        If the controller has an executor, packets are instead decoded up
+        front in the worker pool, and yielded in arrival order.
+
+        If the controller has a table or an api, they are updated with the
+        event when the consumer asks for the next event."""
+        if self._executor:
+            async for event in self._decoded_in_pool(filters):
+                yield event
+                self._observe(event)
+            return
+
+        datagrams = self.datagrams()
+        async for packet, timestamp in datagrams:  # pylint: disable=E1133
+            received = monotonic()
 
             if not packet:
                 yield None
                 continue
 
             try:
-                packet = decode_packet(packet)
+                event = decode_event(packet, filters)
             except NotImplementedError:
                 _LOGGER.warning(
                     "failed to decode packet, skipping: %s", packet
                 )
                 continue
 
-            if not packet:
-                yield None
+            if event is None:
                 continue
 
-            packet.update(lastUpdated=int(time()))
+            self._stamp(event, packet, timestamp, received)
             _LOGGER.debug("Got packet %s", packet)
 
-            yield packet
+            yield event
+            self._observe(event)
+
+    def _observe(self, event):
+        # checking the event decodes it, only if there is anyone to update
+        if self._observers and event:
+            for observer in self._observers:
+                observer.update(event)
 
-    async def _execute(self, device, method, param):
+    async def _decoded_in_pool(self, filters):
+        loop = asyncio.get_event_loop()
+        pending = asyncio.Queue(maxsize=DECODE_QUEUE_SIZE)
+
+        async def receiver_task():
+            datagrams = self.datagrams()
+            try:
+                # pylint: disable=E1133
+                async for packet, timestamp in datagrams:
+                    received = monotonic()
+                    if not packet:
+                        continue
+                    decoded = loop.run_in_executor(
+                        self._executor,
+                        decode_counted if self._processes else decode_eagerly,
+                        packet,
+                        filters,
+                    )
+                    await pending.put((packet, timestamp, received, decoded))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                # raised by the consumer, after the packets before it
+                await pending.put(e)
+                return
+            # end of stream, e.g. a replayed capture
+            await pending.put(None)
+
+        receiver = loop.create_task(receiver_task())
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                packet, timestamp, received, decoded = item
+                try:
+                    event = await decoded
+                except NotImplementedError:
+                    _LOGGER.warning(
+                        "failed to decode packet, skipping: %s", packet
+                    )
+                    continue
+
+                if self._processes:
+                    event, counts = event
+                    merge_counted(counts)
+
+                if not event:
+                    continue
+
+                self._stamp(event, packet, timestamp, received)
+                if event.trace:
+                    event.trace.mark("decoded")
+                _LOGGER.debug("Got packet %s", packet)
+
+                yield event
+        finally:
+            receiver.cancel()
+
+    def subscribe(self, **criteria):
+        """Yield stream of events matching the criteria, e.g.
+        subscribe(protocol="fineoffset", sensorId=[135, 136])"""
+        return self.events(Filter(**criteria))
+
+    async def _execute(self, device, method, param, frame=None):
         """arctech on/off implemented in firmware here:
          https://github.com/telldus/tellstick-net/blob/master/firmware/tellsticknet.c#L58
          https://github.com/telldus/tellstick-net/blob/master/firmware/transmit_arctech.c
+
+        frame is the packet already encoded, e.g. from the compiled config
         """
 
-        packet = encode(**device, method=method, param=param)
+        packet = frame or encode(**device, method=method, param=param)
 
         if isinstance(packet, bytes):
             packet = dict(S=packet)
@@ -158,18 +408,32 @@ class Controller:
             except OSError as e:
                 _LOGGER.warning("Could not send to socket: %s", e)
 
-    def execute(self, device, method, param=None, repeat=COMMAND_REPEAT_TIMES):
-        # FIXME: encode packet once
+    def execute(
+        self,
+        device,
+        method,
+        param=None,
+        repeat=COMMAND_REPEAT_TIMES,
+        frame=None,
+    ):
+        # FIXME: encode packet once, when not given a frame
         # FIXME: Don't create new socket, reuse
+        queued = monotonic()
+        self.stats["commands"] += 1
+
         async def task():
             for i in range(0, repeat):
                 _LOGGER.debug("Sending time %d of %d", i + 1, repeat)
-                await self._execute(device, method, param)
+                if not i:
+                    monitor.since("transmit_wait", queued)
+                await self._execute(device, method, param, frame)
+                if not i:
+                    monitor.milestone("first_command")
                 if i < repeat - 1:
                     _LOGGER.debug(
                         "Waiting %d seconds", COMMAND_REPEAT_DELAY.seconds
                     )
-                await asyncio.sleep(COMMAND_REPEAT_DELAY.seconds if i else 0)
+                    await asyncio.sleep(COMMAND_REPEAT_DELAY.total_seconds())
 
         loop = asyncio.get_event_loop()
         return loop.create_task(task())
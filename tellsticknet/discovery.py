@@ -1,6 +1,10 @@
 import socket
 import logging
+import json
+import struct
 from datetime import timedelta
+from os import environ as env, makedirs, replace
+from os.path import join, expanduser, dirname
 from pprint import pprint
 import asyncio
 
@@ -10,6 +14,8 @@ DISCOVERY_PORT = 30303
 DISCOVERY_ADDRESS = "<broadcast>"
 DISCOVERY_PAYLOAD = b"D"
 DISCOVERY_TIMEOUT = timedelta(seconds=5)
+# timeout for the unicast probe of a cached controller address
+PROBE_TIMEOUT = timedelta(milliseconds=500)
 SUPPORTED_PRODUCTS = ["TellStickNet", "TellstickNetV2", "TellstickZnet"]
 
 MIN_TELLSTICKNET_FIRMWARE_VERSION = 17
@@ -77,34 +83,87 @@ def parse_discovery_packet(data):
         return mac, product, firmware
 
 
+# from linux/sockios.h and net/if.h
+SIOCGIFFLAGS = 0x8913
+SIOCGIFBRDADDR = 0x8919
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+
+
+def broadcast_addresses():
+    """Return the IPv4 broadcast address of every local interface that is up,
+    always including the limited broadcast address on the default interface"""
+    addresses = []
+    try:
+        import fcntl
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for _, name in socket.if_nameindex():
+                request = struct.pack("256s", name.encode()[:15])
+                try:
+                    flags = struct.unpack_from(
+                        "H", fcntl.ioctl(sock, SIOCGIFFLAGS, request), 16
+                    )[0]
+                    if not (flags & IFF_UP and flags & IFF_BROADCAST):
+                        continue
+                    # struct sockaddr_in starts at offset 16
+                    address = socket.inet_ntoa(
+                        fcntl.ioctl(sock, SIOCGIFBRDADDR, request)[20:24]
+                    )
+                except OSError:  # e.g. no IPv4 address on interface
+                    continue
+                if address not in addresses:
+                    _LOGGER.debug("Broadcast address %s on %s", address, name)
+                    addresses.append(address)
+    except (ImportError, AttributeError, OSError):
+        _LOGGER.debug("Could not list network interfaces")
+    return addresses + [DISCOVERY_ADDRESS]
+
+
 async def discover(
     ip=DISCOVERY_ADDRESS, timeout=DISCOVERY_TIMEOUT, discover_all=False
 ):
-    """Scan network for Tellstick Net devices"""
+    """Scan network for Tellstick Net devices
+
+    Without ip, all local broadcast domains are probed at once and the
+    replies are merged by MAC address"""
     _LOGGER.info("Discovering tellstick devices ...")
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.setblocking(0)
-            ip = ip or DISCOVERY_ADDRESS
-            address = (ip, DISCOVERY_PORT)
-            await sock_sendto(sock, DISCOVERY_PAYLOAD, address)
+            if not ip or ip == DISCOVERY_ADDRESS:
+                addresses = broadcast_addresses()
+            else:
+                addresses = [ip]
+            for ip in addresses:
+                try:
+                    await sock_sendto(
+                        sock, DISCOVERY_PAYLOAD, (ip, DISCOVERY_PORT)
+                    )
+                except OSError as e:
+                    _LOGGER.debug("Could not send to %s: %s", ip, e)
 
+            found = set()
             while True:
                 try:
                     data, (address, port) = await asyncio.wait_for(
-                        sock_recvfrom(sock, 1024), timeout.seconds
+                        sock_recvfrom(sock, 1024), timeout.total_seconds()
                     )
                     _LOGGER.debug("Got %s from %s:%d", data, address, port)
                     mac, product, firmware = parse_discovery_packet(data)
+                    if mac in found:
+                        continue
+                    found.add(mac)
                     _LOGGER.info(
                         "Found %s device with firmware %s at %s",
                         product,
                         firmware,
                         address,
                     )
-                    yield (address, mac)
+                    update_cache(address, mac, product, firmware)
+                    yield (address, mac, product, firmware)
                     if not discover_all:
                         return
                 except asyncio.TimeoutError:
@@ -116,6 +175,74 @@ async def discover(
         return
 
 
+CACHE_FILE = join(
+    env.get("XDG_CACHE_HOME", join(expanduser("~"), ".cache")),
+    "tellsticknet",
+    "controllers.json",
+)
+
+
+def read_cache(filename=CACHE_FILE):
+    """Return list of previously discovered controllers, as dicts with
+    ip, mac, product and firmware"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def update_cache(ip, mac, product, firmware, filename=CACHE_FILE):
+    """Remember a discovered controller
+
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as d:
+    ...     cache = join(d, "controllers.json")
+    ...     update_cache("10.0.0.2", "mac", "TellStickNet", "17", cache)
+    ...     update_cache("10.0.0.3", "mac", "TellStickNet", "17", cache)
+    ...     read_cache(cache)
+    [{'ip': '10.0.0.3', 'mac': 'mac', 'product': 'TellStickNet', \
+'firmware': '17'}]
+    """
+    entry = dict(ip=ip, mac=mac, product=product, firmware=firmware)
+    cached = read_cache(filename)
+    if entry in cached:
+        return
+    cached = [e for e in cached if e.get("mac") != mac] + [entry]
+    try:
+        makedirs(dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(cached, f)
+        replace(filename + ".tmp", filename)
+    except OSError as e:
+        _LOGGER.debug("Could not write cache %s: %s", filename, e)
+
+
+async def probe(ip, timeout=PROBE_TIMEOUT):
+    """Discover the controller at ip, if it answers within the timeout"""
+    async for found in discover(ip=ip, timeout=timeout):
+        return found
+    return None
+
+
+async def discover_cached(ip=None, timeout=PROBE_TIMEOUT):
+    """Probe the cached controller addresses, return the discovery data of
+    the first one still answering with the same MAC address"""
+    cached = [e for e in read_cache() if not ip or e.get("ip") == ip]
+    if not cached:
+        return None
+    _LOGGER.debug("Probing %d cached controllers", len(cached))
+    found = await asyncio.gather(*(probe(e["ip"], timeout) for e in cached))
+    return next(
+        (
+            data
+            for entry, data in zip(cached, found)
+            if data and data[1] == entry["mac"]
+        ),
+        None,
+    )
+
+
 async def mock():
     """Mock a Tellstick Net device listening for discovery requests."""
     _LOGGER.info("Mocking a Tellstick device")
@@ -0,0 +1,346 @@
+"""
+emulate a Tellstick Net device, for load testing without hardware
+
+The emulator answers discovery requests, accepts listener registrations
+and streams RawData packets from a population of simulated sensors and
+remotes to the registered listeners. Received send frames are logged.
+
+Run it on a loopback address of its own, so it does not collide with the
+listener socket of the gateway, and point the gateway at it:
+
+  tellsticknet emulate --ip 127.0.0.2 --rate 500
+  tellsticknet listen --ip 127.0.0.2
+"""
+
+import asyncio
+import logging
+import random
+import socket
+from collections import Counter
+
+from .controller import COMMAND_PORT
+from .discovery import (
+    DISCOVERY_PAYLOAD,
+    DISCOVERY_PORT,
+    MIN_TELLSTICKNET_FIRMWARE_VERSION,
+)
+from .protocol import encode_packet, _decode_any
+from .util import sock_recvfrom, sock_sendto
+
+_LOGGER = logging.getLogger(__name__)
+
+ADDRESS = "127.0.0.2"
+MAC = "ACCA54000001"
+CODE = "EMULATED"
+
+# packets per second and packets sent back to back
+RATE = 1.0
+BURST = 1
+
+
+def fineoffset(sensor_id, temp, humidity):
+    """
+    RawData of a fineoffset sensor, with the values decoded by the firmware
+
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", **fineoffset(135, -1.5, 34)))
+    {'class': 'sensor', 'protocol': 'fineoffset', 'model': \
+'temperaturehumidity', 'id': 135, 'values': [{'type': 1, 'scale': 0, \
+'value': '-1.5'}, {'type': 2, 'scale': 0, 'value': '34'}], \
+'sensorId': 135, 'data': [{'name': 'temp', 'value': -1.5}, \
+{'name': 'humidity', 'value': 34}]}
+    """
+    temp = round(temp * 10)
+    value = (abs(temp) & 0x7FF) | (0x800 if temp < 0 else 0)
+    return {
+        "class": "sensor",
+        "protocol": "fineoffset",
+        "model": "temperaturehumidity",
+        "id": sensor_id,
+        "values": [
+            dict(type=1, scale=0, value=str(temp / 10)),
+            dict(type=2, scale=0, value=str(humidity)),
+        ],
+        "data": (
+            (0x400 | sensor_id) << 28 | value << 16 | humidity << 8 | 0xFF
+        ),
+    }
+
+
+def mandolyn(house, channel, temp, humidity):
+    """
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", **mandolyn(3, 2, 20.4, 29)))
+    {'class': 'sensor', 'protocol': 'mandolyn', 'model': \
+'temperaturehumidity', 'sensorId': 32, 'data': [{'name': 'temp', \
+'value': 20.4}, {'name': 'humidity', 'value': 29}]}
+    """
+    value = house << 27 | (channel - 1) << 25 | humidity << 15
+    value |= round(temp * 128) + 6400
+    return {
+        "class": "sensor",
+        "protocol": "mandolyn",
+        "model": "temperaturehumidity",
+        "data": value << 1,
+    }
+
+
+def oregon(address, temp, humidity):
+    """
+    RawData of an Oregon 6701 temperature and humidity sensor
+
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", **oregon(31, 24.2, 45)))
+    {'class': 'sensor', 'protocol': 'oregon', 'model': 6701, \
+'sensorId': 31, 'data': [{'name': 'temp', 'value': 24.2}, \
+{'name': 'humidity', 'value': 45.0}]}
+    """
+    digits = "%03d" % round(abs(temp) * 10)
+    temp1, temp2, temp3 = (int(d) for d in digits[-3:])
+    nibbles = (
+        (0x2, 0x0),
+        (address >> 4, address & 0xF),
+        (temp3, 0x0),
+        (temp1, temp2),
+        (humidity % 10, 0x8 if temp < 0 else 0x0),
+        (0x0, humidity // 10 % 10),
+    )
+    checksum = sum(n for pair in nibbles for n in pair) + 0x10
+    value = 0
+    for high, low in nibbles:
+        value = value << 8 | high << 4 | low
+    return {
+        "class": "sensor",
+        "protocol": "oregon",
+        "model": 6701,
+        "data": (value << 8 | checksum & 0xFF) << 8,
+    }
+
+
+def selflearning(house, unit, method, group=0):
+    """
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", \
+**selflearning(1329110, 1, "turnon")))
+    {'class': 'command', 'protocol': 'arctech', 'model': 'selflearning', \
+'house': 1329110, 'unit': 1, 'group': 0, 'method': 'turnon'}
+    """
+    return {
+        "class": "command",
+        "protocol": "arctech",
+        "model": "selflearning",
+        "data": (
+            house << 6 | group << 5 | (method == "turnon") << 4 | (unit - 1)
+        ),
+    }
+
+
+def codeswitch(house, unit, method):
+    """
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", **codeswitch("A", 1, "turnon")))
+    {'class': 'command', 'protocol': 'arctech', 'model': 'codeswitch', \
+'house': 'A', 'unit': 1, 'method': 'turnon'}
+    """
+    return {
+        "class": "command",
+        "protocol": "arctech",
+        "model": "codeswitch",
+        "data": (
+            (14 if method == "turnon" else 6) << 8
+            | (unit - 1) << 4
+            | ord(house) - ord("A")
+        ),
+    }
+
+
+def everflourish(house, unit, method):
+    """
+    >>> from .protocol import decode_packet
+    >>> decode_packet(encode_packet("RawData", \
+**everflourish(4242, 3, "turnon")))
+    {'protocol': 'everflourish', 'class': 'command', 'model': \
+'selflearning', 'house': 4242, 'unit': 3, 'method': 'turnon'}
+    """
+    return {
+        "protocol": "everflourish",
+        "data": house << 10
+        | (unit - 1) << 8
+        | (15 if method == "turnon" else 0),
+    }
+
+
+class Sensor:
+    """Simulated sensor, with a random walk of temperature and humidity"""
+
+    def __init__(self, encoder, *ident, rng=random):
+        self._encoder = encoder
+        self._ident = ident
+        self._rng = rng
+        self.temp = round(rng.uniform(-10, 30), 1)
+        self.humidity = rng.randrange(20, 90)
+
+    def frame(self):
+        rng = self._rng
+        self.temp = round(min(max(self.temp + rng.gauss(0, 0.3), -40), 60), 1)
+        self.humidity = min(max(self.humidity + rng.randint(-1, 1), 0), 99)
+        return self._encoder(*self._ident, self.temp, self.humidity)
+
+
+class Remote:
+    """Simulated remote control, pressing random buttons"""
+
+    def __init__(self, encoder, house, rng=random):
+        self._encoder = encoder
+        self._house = house
+        self._rng = rng
+
+    UNITS = range(1, 5)
+
+    def frame(self, unit=None, method=None):
+        return self._encoder(
+            self._house,
+            unit or self._rng.choice(self.UNITS),
+            method or self._rng.choice(("turnon", "turnoff")),
+        )
+
+
+def population(sensors, remotes, rng=random):
+    """Simulated devices, spread over all the supported protocols
+
+    >>> [type(d).__name__ for d in population(3, 2)]
+    ['Sensor', 'Sensor', 'Sensor', 'Remote', 'Remote']
+    """
+    devices = []
+    for i in range(sensors):
+        if i % 3 == 0:
+            devices.append(Sensor(fineoffset, i % 256, rng=rng))
+        elif i % 3 == 1:
+            devices.append(Sensor(mandolyn, i // 4 % 16, i % 4 + 1, rng=rng))
+        else:
+            devices.append(Sensor(oregon, i % 256, rng=rng))
+    for i in range(remotes):
+        if i % 3 == 0:
+            devices.append(Remote(selflearning, 1 + i, rng=rng))
+        elif i % 3 == 1:
+            devices.append(Remote(codeswitch, chr(ord("A") + i % 16), rng=rng))
+        else:
+            devices.append(Remote(everflourish, i % 16384, rng=rng))
+    return devices
+
+
+def _decode_frame(packet):
+    """
+    decode a frame received from a client, e.g. a send command followed
+    by the repeat options
+
+    >>> _decode_frame(encode_packet("send", protocol="arctech"))
+    ('send', {'protocol': 'arctech'}, {'P': 10, 'R': 4})
+    """
+    command, rest = _decode_any(packet)
+    args, rest = _decode_any(rest) if rest else ({}, b"")
+    options = {}
+    while rest:
+        key, rest = _decode_any(rest)
+        options[key], rest = _decode_any(rest)
+    return command, args, options
+
+
+class Emulator:
+    """Emulated Tellstick Net device"""
+
+    def __init__(
+        self,
+        address=ADDRESS,
+        sensors=10,
+        remotes=5,
+        rate=RATE,
+        burst=BURST,
+        seed=None,
+    ):
+        self.address = address
+        self.rate = rate
+        self.burst = burst
+        self._rng = random.Random(seed)
+        self.devices = population(sensors, remotes, self._rng)
+        self.listeners = set()
+        # packets, registrations, commands, errors
+        self.stats = Counter()
+
+    async def _answer_discovery(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.address, DISCOVERY_PORT))
+            sock.setblocking(0)
+            response = "TellStickNet:%s:%s:%d" % (
+                MAC,
+                CODE,
+                MIN_TELLSTICKNET_FIRMWARE_VERSION,
+            )
+            while True:
+                data, address = await sock_recvfrom(sock, 1024)
+                if data == DISCOVERY_PAYLOAD:
+                    _LOGGER.info("Got discovery request from %s", address)
+                    await sock_sendto(sock, response.encode("ascii"), address)
+
+    async def _handle_commands(self, sock):
+        while True:
+            data, address = await sock_recvfrom(sock, 1024)
+            try:
+                command, args, options = _decode_frame(data)
+            except (ValueError, IndexError):
+                self.stats["errors"] += 1
+                _LOGGER.warning("Malformed frame from %s: %s", address, data)
+                continue
+            if command == "reglistener":
+                self.stats["registrations"] += 1
+                if address not in self.listeners:
+                    _LOGGER.info("Registered listener %s", address)
+                self.listeners.add(address)
+            elif command == "send":
+                self.stats["commands"] += 1
+                _LOGGER.info(
+                    "Got send frame from %s: %s %s", address, args, options
+                )
+            else:
+                _LOGGER.info("Got %s from %s: %s", command, address, args)
+
+    async def _stream(self, sock):
+        loop = asyncio.get_event_loop()
+        interval = self.burst / self.rate
+        deadline = loop.time()
+        while True:
+            deadline += interval
+            await asyncio.sleep(max(deadline - loop.time(), 0))
+            if not self.listeners or not self.devices:
+                continue
+            for _ in range(self.burst):
+                device = self._rng.choice(self.devices)
+                packet = encode_packet("RawData", **device.frame())
+                for listener in list(self.listeners):
+                    try:
+                        await sock_sendto(sock, packet, listener)
+                        self.stats["packets"] += 1
+                    except OSError as e:
+                        self.stats["errors"] += 1
+                        _LOGGER.warning(
+                            "Could not send to %s: %s", listener, e
+                        )
+
+    async def run(self):
+        """Emulate the device until cancelled"""
+        _LOGGER.info(
+            "Emulating a Tellstick Net at %s with %d devices, %g packets/s",
+            self.address,
+            len(self.devices),
+            self.rate,
+        )
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.address, COMMAND_PORT))
+            sock.setblocking(0)
+            await asyncio.gather(
+                self._answer_discovery(),
+                self._handle_commands(sock),
+                self._stream(sock),
+            )
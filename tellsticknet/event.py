@@ -0,0 +1,317 @@
+"""
+compact representation of a decoded packet
+"""
+
+import logging
+from time import monotonic
+
+from . import monitor
+from .const import Quantity
+
+_LOGGER = logging.getLogger(__name__)
+
+# order of the keys in the dict representation
+FIELDS = (
+    "class",
+    "protocol",
+    "model",
+    "sensorId",
+    "house",
+    "unit",
+    "group",
+    "code",
+    "method",
+)
+
+
+class Event:
+    """A decoded packet
+
+    Sensor readings are kept as a tuple of (Quantity, value) pairs in data.
+    The key 'class' is available as the attribute class_
+
+    >>> event = Event.from_fields(dict(protocol="fineoffset", \
+sensorId=135, data=dict(temp=16.7, humidity=34)))
+    >>> event.value(Quantity.HUMIDITY)
+    34
+    >>> event.value(Quantity.UV)
+
+    >>> event.as_dict()["data"]
+    [{'name': 'temp', 'value': 16.7}, {'name': 'humidity', 'value': 34}]
+
+    Events created from the raw packet are decoded on first access
+
+    >>> event = Event.lazy(dict(protocol="fineoffset", data=0x48801AFF05))
+    >>> event.sensorId
+    136
+    >>> bool(Event.lazy(dict(protocol="everflourish", data=0x1)))
+    False
+    """
+
+    __slots__ = (
+        "class_",
+        "protocol",
+        "model",
+        "sensorId",
+        "house",
+        "unit",
+        "group",
+        "code",
+        "method",
+        "data",
+        "id",
+        "values",
+        "lastUpdated",
+        "timestamp",
+        "trace",
+        "_raw",
+    )
+
+    def __init__(
+        self,
+        class_=None,
+        protocol=None,
+        model=None,
+        sensorId=None,
+        house=None,
+        unit=None,
+        group=None,
+        code=None,
+        method=None,
+        data=None,
+        id=None,
+        values=None,
+        lastUpdated=None,
+        timestamp=None,
+    ):
+        self.class_ = class_
+        self.protocol = protocol
+        self.model = model
+        self.sensorId = sensorId
+        self.house = house
+        self.unit = unit
+        self.group = group
+        self.code = code
+        self.method = method
+        self.data = data
+        self.id = id
+        self.values = values
+        self.lastUpdated = lastUpdated
+        self.timestamp = timestamp
+        self.trace = None
+        self._raw = None
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Create from the dict returned by a protocol implementation"""
+        event = cls.__new__(cls)
+        event._raw = None
+        event._assign(fields)
+        return event
+
+    @classmethod
+    def lazy(cls, raw):
+        """Create from the RawData arguments, decoded on first access"""
+        event = cls.__new__(cls)
+        event._raw = raw
+        return event
+
+    def _assign(self, fields):
+        data = fields.get("data")
+        self.class_ = fields.get("class")
+        self.protocol = fields.get("protocol")
+        self.model = fields.get("model")
+        self.sensorId = fields.get("sensorId")
+        self.house = fields.get("house")
+        self.unit = fields.get("unit")
+        self.group = fields.get("group")
+        self.code = fields.get("code")
+        self.method = fields.get("method")
+        self.data = (
+            tuple((Quantity(name), value) for name, value in data.items())
+            if data
+            else None
+        )
+        # the sensor id and values as decoded by the firmware, if any
+        self.id = fields.get("id")
+        self.values = fields.get("values")
+        # set when received, possibly before decoding
+        for name in ("lastUpdated", "timestamp", "trace"):
+            try:
+                object.__getattribute__(self, name)
+            except AttributeError:
+                setattr(self, name, fields.get(name))
+
+    def _decode(self):
+        from .protocol import _decode_fields
+
+        then = monotonic()
+        raw, self._raw = self._raw, None
+        try:
+            fields = _decode_fields(raw)
+        except (NotImplementedError, ValueError, ImportError):
+            _LOGGER.warning("failed to decode packet, skipping: %s", raw)
+            fields = {}
+        self._assign(fields)
+        monitor.since("decode", then)
+        if self.trace:
+            self.trace.mark("decoded")
+
+    def __getattr__(self, name):
+        # only called for fields not assigned yet, i.e. before decoding
+        if name.startswith("_") or self._raw is None:
+            raise AttributeError(name)
+        self._decode()
+        return object.__getattribute__(self, name)
+
+    @property
+    def raw(self):
+        """The RawData arguments, None once decoded"""
+        return self._raw
+
+    def __bool__(self):
+        """False if the packet could not be decoded"""
+        return self.protocol is not None
+
+    @property
+    def is_sensor(self):
+        return self.data is not None
+
+    def value(self, quantity):
+        """Return the value of the quantity, None if not present"""
+        return next((v for q, v in self.data or () if q == quantity), None)
+
+    def as_dict(self):
+        """Dict representation, as returned by decode_packet"""
+        res = {
+            key: value
+            for key, value in zip(
+                FIELDS,
+                (
+                    self.class_,
+                    self.protocol,
+                    self.model,
+                    self.sensorId,
+                    self.house,
+                    self.unit,
+                    self.group,
+                    self.code,
+                    self.method,
+                ),
+            )
+            if value is not None
+        }
+        if self.data is not None:
+            res.update(
+                data=[dict(name=q.value, value=v) for q, v in self.data]
+            )
+        if self.id is not None:
+            res.update(id=self.id, values=self.values)
+        if self.lastUpdated is not None:
+            res.update(lastUpdated=self.lastUpdated)
+        if self.timestamp is not None:
+            res.update(timestamp=round(self.timestamp, 6))
+        return res
+
+    def __repr__(self):
+        return "Event(%s)" % ", ".join(
+            f"{k}={v!r}" for k, v in self.as_dict().items()
+        )
+
+
+# protocols that are decoded from raw packets of another protocol
+RAW_PROTOCOLS = {"sartano": "arctech", "waveman": "arctech"}
+
+# protocols that are only known once the packet is decoded
+DECODED_PROTOCOLS = frozenset(RAW_PROTOCOLS) | frozenset(
+    RAW_PROTOCOLS.values()
+)
+
+# criteria that can be decided before the packet is decoded, the model of
+# the header is not always the decoded one
+HEADER_CRITERIA = ("protocol", "class_")
+
+
+def _accepted(value):
+    """
+    >>> sorted(_accepted(["a", "b"]))
+    ['a', 'b']
+    >>> _accepted("abc")
+    frozenset({'abc'})
+    """
+    if isinstance(value, (str, int)):
+        return frozenset((value,))
+    return frozenset(value)
+
+
+class Filter:
+    """Match events on protocol, model, class_, sensorId, house and unit
+
+    Each criterion is a single value or a collection of accepted values.
+    protocol, model and class_ are checked against the raw packet header,
+    before the packet is decoded. Only protocol and class_ can be decided
+    by the header alone, and not for the protocols decoded from the raw
+    packets of another protocol.
+
+    >>> f = Filter(protocol="sartano")
+    >>> f.accepts_header(dict(protocol="arctech", model="codeswitch"))
+    True
+    >>> f.decided_by_header(dict(protocol="arctech", model="codeswitch"))
+    False
+    >>> f.accepts_header(dict(protocol="fineoffset"))
+    False
+    >>> Filter(protocol="fineoffset").decided_by_header(\
+dict(protocol="fineoffset"))
+    True
+    >>> Filter(model="temperaturehumidity").needs_decode
+    True
+    >>> f = Filter(protocol="fineoffset", sensorId=[135, 136])
+    >>> f.accepts(Event.lazy(dict(protocol="fineoffset", data=0x48801AFF05)))
+    True
+    """
+
+    __slots__ = ("criteria", "needs_decode")
+
+    def __init__(self, **criteria):
+        self.criteria = {
+            key: _accepted(value)
+            for key, value in criteria.items()
+            if value is not None
+        }
+        self.needs_decode = any(
+            key not in HEADER_CRITERIA for key in self.criteria
+        ) or bool(self.criteria.get("protocol", set()) & DECODED_PROTOCOLS)
+
+    def accepts_header(self, raw):
+        """Check the criteria that are known before decoding"""
+        protocols = self.criteria.get("protocol")
+        if protocols and not any(
+            raw.get("protocol") == RAW_PROTOCOLS.get(p, p) for p in protocols
+        ):
+            return False
+        models = self.criteria.get("model")
+        if models and "model" in raw and raw["model"] not in models:
+            return False
+        classes = self.criteria.get("class_")
+        if classes and "class" in raw and raw["class"] not in classes:
+            return False
+        return True
+
+    def decided_by_header(self, raw):
+        """Whether accepts_header is final, i.e. the packet does not have to
+        be decoded to check the criteria"""
+        return not self.needs_decode and (
+            "class_" not in self.criteria or "class" in raw
+        )
+
+    def accepts(self, event):
+        """Check all criteria against the decoded event"""
+        return all(
+            getattr(event, key) in accepted
+            for key, accepted in self.criteria.items()
+        )
+
+    def __repr__(self):
+        return "Filter(%s)" % ", ".join(
+            f"{k}={sorted(v)!r}" for k, v in self.criteria.items()
+        )
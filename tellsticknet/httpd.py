@@ -0,0 +1,286 @@
+"""
+minimal embedded HTTP server, for local metrics and api endpoints
+
+WebSocket connections (RFC 6455) are upgraded from GET requests to the
+paths routed with the method "WS". Only unfragmented text messages are
+supported, which is all the api needs.
+"""
+
+import asyncio
+import logging
+import struct
+from base64 import b64encode
+from hashlib import sha1
+from urllib.parse import urlsplit, parse_qs
+
+_LOGGER = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 64 * 1024
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# opcodes of websocket frames
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# status of a close frame, e.g. for an unmasked client frame
+PROTOCOL_ERROR = 1002
+
+REASONS = {
+    101: "Switching Protocols",
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+def parse_address(address, default_host="127.0.0.1"):
+    """
+    >>> parse_address("9100")
+    ('127.0.0.1', 9100)
+    >>> parse_address("0.0.0.0:9100")
+    ('0.0.0.0', 9100)
+    """
+    host, _, port = address.rpartition(":")
+    return host or default_host, int(port)
+
+
+def parse_request_head(head):
+    """
+    parse request line and headers
+
+    >>> r = parse_request_head(b"GET /metrics?a=1 HTTP/1.1\\r\\nHost: x\\r\\n")
+    >>> r.method, r.path, r.query, r.headers
+    ('GET', '/metrics', {'a': ['1']}, {'host': 'x'})
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    url = urlsplit(target)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return Request(method, url.path, parse_qs(url.query), headers, b"")
+
+
+def response(status, body=b"", content_type="text/plain; charset=utf-8"):
+    """
+    >>> response(404)
+    b'HTTP/1.1 404 Not Found\\r\\nContent-Type: text/plain; \
+charset=utf-8\\r\\nContent-Length: 0\\r\\nConnection: close\\r\\n\\r\\n'
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return (
+        b"HTTP/1.1 %d %s\r\n"
+        b"Content-Type: %s\r\n"
+        b"Content-Length: %d\r\n"
+        b"Connection: close\r\n\r\n"
+        % (
+            status,
+            REASONS.get(status, "").encode(),
+            content_type.encode(),
+            len(body),
+        )
+        + body
+    )
+
+
+def accept_key(key):
+    """
+    Sec-WebSocket-Accept for the Sec-WebSocket-Key of the request
+
+    >>> accept_key("dGhlIHNhbXBsZSBub25jZQ==")
+    's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+    """
+    return b64encode(sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def encode_frame(opcode, payload):
+    """
+    A final, unmasked frame, as sent by a server
+
+    >>> encode_frame(TEXT, b"Hello")
+    b'\\x81\\x05Hello'
+    >>> len(encode_frame(TEXT, bytes(300)))
+    304
+    """
+    length = len(payload)
+    if length < 126:
+        head = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return head + payload
+
+
+def unmask(mask, payload):
+    """
+    >>> unmask(b"\\x37\\xfa\\x21\\x3d", b"\\x7f\\x9f\\x4d\\x51\\x58")
+    b'Hello'
+    """
+    repeated = (mask * (len(payload) // 4 + 1))[: len(payload)]
+    return (
+        int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")
+    ).to_bytes(len(payload), "big")
+
+
+class WebSocket:
+    """Server side of an upgraded connection"""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self.closed = False
+
+    async def _send(self, opcode, payload):
+        self._writer.write(encode_frame(opcode, payload))
+        await self._writer.drain()
+
+    async def send(self, text):
+        await self._send(TEXT, text.encode("utf-8"))
+
+    async def receive(self):
+        """The next text message, None when the client closed the
+        connection. Pings are answered in passing"""
+        while not self.closed:
+            try:
+                head = await self._reader.readexactly(2)
+                if not head[1] & 0x80:
+                    # the frames of a client must be masked, RFC 6455 5.1
+                    await self.close(PROTOCOL_ERROR)
+                    return None
+                length = head[1] & 0x7F
+                if length == 126:
+                    (length,) = struct.unpack(
+                        "!H", await self._reader.readexactly(2)
+                    )
+                elif length == 127:
+                    (length,) = struct.unpack(
+                        "!Q", await self._reader.readexactly(8)
+                    )
+                if length > MAX_BODY_SIZE:
+                    raise ValueError("Message too large")
+                mask = await self._reader.readexactly(4)
+                payload = unmask(mask, await self._reader.readexactly(length))
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                self.closed = True
+                return None
+            opcode = head[0] & 0x0F
+            if opcode == CLOSE:
+                await self.close()
+            elif opcode == PING:
+                await self._send(PONG, payload)
+            elif opcode == TEXT:
+                return payload.decode("utf-8", "replace")
+        return None
+
+    async def close(self, status=None):
+        if not self.closed:
+            self.closed = True
+            try:
+                await self._send(
+                    CLOSE, b"" if status is None else struct.pack("!H", status)
+                )
+            except ConnectionError:
+                pass
+
+
+def upgrade(request):
+    """Response accepting the upgrade to a websocket, None if the request
+    is not a valid upgrade"""
+    key = request.headers.get("sec-websocket-key")
+    if (
+        request.method != "GET"
+        or request.headers.get("upgrade", "").lower() != "websocket"
+        or not key
+    ):
+        return None
+    return (
+        b"HTTP/1.1 101 Switching Protocols\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: %s\r\n\r\n" % accept_key(key).encode()
+    )
+
+
+async def serve(routes, address):
+    """Serve the routes, a dict of (method, path) to a coroutine function
+    taking the request and returning (status, body[, content type]).
+    Routes with the method "WS" are websockets, taking the request and a
+    WebSocket, and returning when done"""
+
+    async def read_request(reader):
+        """The request, or the response to an invalid request"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request = parse_request_head(head[:-4])
+            length = int(request.headers.get("content-length", 0))
+        except (asyncio.LimitOverrunError, ValueError):
+            return response(400)
+        if length > MAX_BODY_SIZE:
+            return response(413)
+        if length:
+            request.body = await reader.readexactly(length)
+        return request
+
+    async def dispatch(request):
+        handler = routes.get((request.method, request.path))
+        if not handler:
+            if any(path == request.path for _, path in routes):
+                return response(405)
+            return response(404)
+        try:
+            return response(*await handler(request))
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Failed to handle %s", request.path)
+            return response(500)
+
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if isinstance(request, bytes):
+                writer.write(request)
+            elif ("WS", request.path) in routes:
+                accepted = upgrade(request)
+                if not accepted:
+                    writer.write(response(400))
+                else:
+                    writer.write(accepted)
+                    await writer.drain()
+                    websocket = WebSocket(reader, writer)
+                    await routes[("WS", request.path)](request, websocket)
+                    await websocket.close()
+            else:
+                writer.write(await dispatch(request))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    host, port = parse_address(address)
+    server = await asyncio.start_server(handle, host, port)
+    _LOGGER.info("Serving HTTP on %s:%d", host, port)
+    return server
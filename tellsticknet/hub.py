@@ -0,0 +1,248 @@
+"""
+local fan-out of the datagrams of one controller
+
+Only one process on the host can listen on the command port and register
+with the controller. The hub does that, and relays the datagrams to any
+number of local subscribers over a Unix datagram socket, so e.g. the MQTT
+gateway and an archiving listen --raw can run at the same time.
+
+Subscribers send "subscribe" from a bound socket, again every KEEPALIVE
+seconds, and are answered with the address of the controller. Every
+datagram is relayed as "D", the receive timestamp and the packet. Each
+subscriber has a buffer of BUFFER datagrams, for when its socket is full,
+the oldest are dropped when a subscriber does not keep up. Subscribers not
+heard from in three keepalive intervals are dropped.
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import struct
+from collections import Counter, deque
+from os import environ as env, unlink
+from os.path import join
+from tempfile import gettempdir
+from time import monotonic
+
+from .controller import Controller
+from .util import sock_recvfrom
+
+_LOGGER = logging.getLogger(__name__)
+
+SOCKET = join(env.get("XDG_RUNTIME_DIR", gettempdir()), "tellsticknet.sock")
+
+SUBSCRIBE = b"subscribe"
+UNSUBSCRIBE = b"unsubscribe"
+
+# message types from the hub
+CONTROLLER = b"C"
+DATA = b"D"
+
+TIMESTAMP = struct.Struct("<d")
+
+# datagrams buffered per subscriber
+BUFFER = 1000
+
+# seconds between subscriptions of a subscriber
+KEEPALIVE = 10
+
+# seconds between sends to subscribers with full sockets
+FLUSH_INTERVAL = 0.01
+
+# seconds to wait for the hub to answer
+ATTACH_TIMEOUT = 2
+
+
+class Subscriber:
+    def __init__(self, buffer):
+        self.queue = deque(maxlen=buffer)
+        self.seen = monotonic()
+        self.dropped = 0
+
+
+class Hub:
+    """Relay the datagrams of the controller to the subscribers"""
+
+    def __init__(self, controller, path=SOCKET, buffer=BUFFER):
+        self.controller = controller
+        self.path = path
+        self.buffer = buffer
+        self.subscribers = {}  # address -> Subscriber
+        # relayed, dropped, subscribed, unsubscribed, expired, gone
+        self.stats = Counter()
+        self._sock = None
+        self._blocked = None
+
+    def __repr__(self):
+        return f"Hub@{self.path}"
+
+    async def run(self):
+        try:
+            unlink(self.path)
+        except FileNotFoundError:
+            pass
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.bind(self.path)
+            sock.setblocking(0)
+            self._sock = sock
+            self._blocked = asyncio.Event()
+            loop = asyncio.get_event_loop()
+            tasks = [
+                loop.create_task(self._subscription_task()),
+                loop.create_task(self._flush_task()),
+            ]
+            _LOGGER.info("Relaying %s on %s", self.controller, self.path)
+            try:
+                async for packet, timestamp in self.controller.datagrams():
+                    self.relay(
+                        DATA + TIMESTAMP.pack(timestamp) + packet.encode()
+                    )
+            finally:
+                for task in tasks:
+                    task.cancel()
+                unlink(self.path)
+
+    def relay(self, data):
+        self.stats["relayed"] += 1
+        for address, subscriber in list(self.subscribers.items()):
+            self._queue(address, subscriber, data)
+
+    def _queue(self, address, subscriber, data):
+        if len(subscriber.queue) == subscriber.queue.maxlen:
+            if not subscriber.dropped:
+                _LOGGER.warning("Subscriber %s does not keep up", address)
+            subscriber.dropped += 1
+            self.stats["dropped"] += 1
+        subscriber.queue.append(data)
+        self._flush(address, subscriber)
+
+    def _flush(self, address, subscriber):
+        while subscriber.queue:
+            try:
+                self._sock.sendto(subscriber.queue[0], address)
+            except BlockingIOError:
+                # its socket is full, retried by the flush task
+                self._blocked.set()
+                return
+            except OSError as e:
+                _LOGGER.info("Subscriber %s is gone: %s", address, e)
+                self.stats["gone"] += 1
+                self.subscribers.pop(address, None)
+                return
+            subscriber.queue.popleft()
+
+    async def _subscription_task(self):
+        while True:
+            data, address = await sock_recvfrom(self._sock, 1024)
+            if not address:
+                _LOGGER.debug("Ignoring request from unbound socket")
+            elif data == SUBSCRIBE:
+                subscriber = self.subscribers.get(address)
+                if not subscriber:
+                    _LOGGER.info("New subscriber %s", address)
+                    self.stats["subscribed"] += 1
+                    subscriber = self.subscribers[address] = Subscriber(
+                        self.buffer
+                    )
+                subscriber.seen = monotonic()
+                self._queue(
+                    address,
+                    subscriber,
+                    CONTROLLER
+                    + json.dumps(
+                        [
+                            self.controller.ip_address,
+                            self.controller.mac_address,
+                        ]
+                    ).encode(),
+                )
+            elif data == UNSUBSCRIBE:
+                if self.subscribers.pop(address, None):
+                    _LOGGER.info("Subscriber %s left", address)
+                    self.stats["unsubscribed"] += 1
+
+    async def _flush_task(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._blocked.wait(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                pass
+            self._blocked.clear()
+            deadline = monotonic() - 3 * KEEPALIVE
+            for address, subscriber in list(self.subscribers.items()):
+                if subscriber.seen < deadline:
+                    _LOGGER.info("Subscriber %s expired", address)
+                    self.stats["expired"] += 1
+                    del self.subscribers[address]
+            while any(s.queue for s in self.subscribers.values()):
+                await asyncio.sleep(FLUSH_INTERVAL)
+                for address, subscriber in list(self.subscribers.items()):
+                    self._flush(address, subscriber)
+            self._blocked.clear()
+
+
+def _socket():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # an autobound abstract address on Linux
+    sock.bind("")
+    sock.setblocking(0)
+    return sock
+
+
+def _send(sock, data, path):
+    try:
+        sock.sendto(data, path)
+        return True
+    except OSError as e:
+        _LOGGER.warning("Could not reach the hub at %s: %s", path, e)
+        return False
+
+
+async def attach(path=SOCKET, timeout=ATTACH_TIMEOUT, **options):
+    """Controller receiving its datagrams from the hub, None if the hub does
+    not answer. options are passed on to the Controller"""
+    with _socket() as sock:
+        if not _send(sock, SUBSCRIBE, path):
+            return None
+        try:
+            while True:
+                data, _ = await asyncio.wait_for(
+                    sock_recvfrom(sock, 2048), timeout
+                )
+                if data[:1] == CONTROLLER:
+                    break
+        except asyncio.TimeoutError:
+            _LOGGER.warning("No answer from the hub at %s", path)
+            return None
+        finally:
+            _send(sock, UNSUBSCRIBE, path)
+    ip, mac = json.loads(data[1:])
+    _LOGGER.info("Attached to hub at %s, relaying %s", path, ip)
+    return Controller(ip, mac, hub=path, **options)
+
+
+async def datagrams(path, controller):
+    """Yield (packet, receive timestamp) relayed by the hub"""
+
+    async def keepalive_task(sock):
+        while True:
+            _send(sock, SUBSCRIBE, path)
+            await asyncio.sleep(KEEPALIVE)
+
+    with _socket() as sock:
+        task = asyncio.get_event_loop().create_task(keepalive_task(sock))
+        try:
+            while True:
+                data, _ = await sock_recvfrom(sock, 2048)
+                if data[:1] == DATA:
+                    controller.stats["datagrams"] += 1
+                    (timestamp,) = TIMESTAMP.unpack_from(data, 1)
+                    yield data[1 + TIMESTAMP.size :].decode(), timestamp
+                elif data[:1] == CONTROLLER:
+                    ip, _ = json.loads(data[1:])
+                    if ip != controller.ip_address:
+                        controller.update_address(ip)
+        finally:
+            task.cancel()
+            _send(sock, UNSUBSCRIBE, path)
@@ -0,0 +1,182 @@
+"""
+metrics in the Prometheus text exposition format
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+The counters are kept in Controller, protocol and mqtt.Device, this
+module only renders them. Other modules can add a collector, a function
+returning an iterable of text lines, to COLLECTORS.
+"""
+
+import logging
+from time import time
+
+from . import monitor, protocol
+from .controller import Controller
+from .monitor import BUCKETS
+
+_LOGGER = logging.getLogger(__name__)
+
+PREFIX = "tellsticknet"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COLLECTORS = []
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def _labels(labels):
+    """
+    >>> _labels(dict(protocol="arctech", model=None))
+    '{protocol="arctech",model=""}'
+    >>> _labels({})
+    ''
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, _escape("" if value is None else value))
+        for key, value in labels.items()
+    )
+
+
+def family(name, kind, doc, samples):
+    """
+    render a metric family, samples is an iterable of (labels, value)
+
+    >>> print("\\n".join(family("x_total", "counter", "Doc", [({}, 3)])))
+    # HELP tellsticknet_x_total Doc
+    # TYPE tellsticknet_x_total counter
+    tellsticknet_x_total 3
+    """
+    name = f"{PREFIX}_{name}"
+    yield f"# HELP {name} {doc}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in samples:
+        yield f"{name}{_labels(labels)} {value}"
+
+
+def histogram(name, doc, histograms):
+    """render a dict of label value to monitor.Histogram"""
+    name = f"{PREFIX}_{name}"
+    yield f"# HELP {name} {doc}"
+    yield f"# TYPE {name} histogram"
+    for stage, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, h.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}'
+        yield f'{name}_sum{{stage="{stage}"}} {h.total}'
+        yield f'{name}_count{{stage="{stage}"}} {h.count}'
+
+
+def _controller_metrics():
+    controllers = list(Controller.instances)
+    for key, doc in (
+        ("datagrams", "Datagrams received from the controller"),
+        ("unknown_sender", "Datagrams received from other hosts"),
+        ("receive_errors", "Errors receiving from the socket"),
+        ("kernel_drops", "Datagrams dropped by the kernel, SO_RXQ_OVFL"),
+        ("commands", "Commands queued for transmission"),
+    ):
+        yield from family(
+            f"{key}_total",
+            "counter",
+            doc,
+            (
+                (dict(controller=c.mac_address), c.stats[key])
+                for c in controllers
+            ),
+        )
+
+
+def _protocol_metrics():
+    yield from family(
+        "decodes_total",
+        "counter",
+        "Decoded packets per protocol and model",
+        (
+            (dict(protocol=p, model=m, result=result), count)
+            for (p, m, result), count in sorted(
+                protocol.DECODES.items(), key=str
+            )
+        ),
+    )
+    yield from family(
+        "sensor_decodes_total",
+        "counter",
+        "Sensor packets decoded by the firmware or in python",
+        (
+            (dict(decoder=decoder), protocol.STATS[decoder])
+            for decoder in ("firmware", "python")
+        ),
+    )
+
+
+def _monitor_metrics():
+    yield from family(
+        "startup_seconds",
+        "gauge",
+        "Seconds from start until the first discovery, packet and command",
+        (
+            (dict(milestone=name), round(seconds, 6))
+            for name, seconds in sorted(monitor.MILESTONES.items())
+        ),
+    )
+    yield from histogram(
+        "stage_seconds",
+        "Event loop lag and packet pipeline stage latencies",
+        monitor.HISTOGRAMS,
+    )
+
+
+def render():
+    """
+    >>> "tellsticknet_decodes_total" in render()
+    True
+    """
+    lines = []
+    for collector in (
+        _controller_metrics,
+        _protocol_metrics,
+        _monitor_metrics,
+        *COLLECTORS,
+    ):
+        try:
+            lines.extend(collector())
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Metrics collector %s failed", collector)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def seconds_since(timestamps):
+    """
+    samples of seconds since each timestamp, for a dict of name to time
+
+    >>> list(seconds_since({}))
+    []
+    """
+    now = time()
+    return (
+        (dict(name=name), round(now - then, 3))
+        for name, then in sorted(timestamps.items())
+    )
+
+
+async def serve(address):
+    """Serve the metrics on http://address/metrics"""
+    from .httpd import serve
+
+    async def metrics(request):
+        return 200, render(), CONTENT_TYPE
+
+    return await serve({("GET", "/metrics"): metrics}, address)
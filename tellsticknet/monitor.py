@@ -0,0 +1,234 @@
+"""
+event loop lag and per stage latency histograms for the packet pipeline
+
+stages:
+  loop_lag  how late the event loop runs a scheduled callback
+  decode    decoding a packet into an event
+  route     routing an event through the configured devices
+  publish   publishing a message until acked by the MQTT client
+  receive   from the kernel receive timestamp until read by the gateway
+
+In trace mode, the monotonic time of each stage of every packet is
+written as a line of JSON to the trace file.
+"""
+
+import logging
+from json import dumps as to_json
+from bisect import bisect_left
+from sys import stderr
+from time import monotonic
+
+_LOGGER = logging.getLogger(__name__)
+
+# approximately the start of the process
+STARTED = monotonic()
+
+# seconds from start until e.g. discovered, first_packet, first_command
+MILESTONES = {}
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1,
+    2,
+    5,
+    float("inf"),
+)
+
+LAG_INTERVAL = 0.5
+REPORT_INTERVAL = 60
+
+
+class Histogram:
+    """Latency histogram with fixed buckets
+
+    >>> h = Histogram()
+    >>> for value in (0.0015, 0.003, 0.004, 0.3):
+    ...     h.observe(value)
+    >>> h.count, h.max
+    (4, 0.3)
+    >>> h.quantile(0.5)
+    0.005
+    >>> str(h)
+    'n=4 mean=77.1ms p50<=5.0ms p99<=500.0ms max=300.0ms'
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n=%d mean=%.1fms p50<=%.1fms p99<=%.1fms max=%.1fms" % (
+            self.count,
+            1000 * self.total / self.count,
+            1000 * self.quantile(0.5),
+            1000 * self.quantile(0.99),
+            1000 * self.max,
+        )
+
+
+HISTOGRAMS = {}
+
+
+def histogram(stage):
+    """Return the histogram for the stage, created on first use"""
+    try:
+        return HISTOGRAMS[stage]
+    except KeyError:
+        return HISTOGRAMS.setdefault(stage, Histogram())
+
+
+def observe(stage, seconds):
+    histogram(stage).observe(seconds)
+
+
+def since(stage, then):
+    """Record the time elapsed since the monotonic timestamp then"""
+    histogram(stage).observe(monotonic() - then)
+
+
+def report():
+    """
+    >>> HISTOGRAMS.clear()
+    >>> observe("decode", 0.001)
+    >>> print(report())
+    decode    n=1 mean=1.0ms p50<=1.0ms p99<=1.0ms max=1.0ms
+    >>> HISTOGRAMS.clear()
+    """
+    return "\n".join(
+        "%-9s %s" % (stage, HISTOGRAMS[stage]) for stage in sorted(HISTOGRAMS)
+    )
+
+
+def milestone(name):
+    """Record and log the time since start, the first time it happens"""
+    if name in MILESTONES:
+        return
+    MILESTONES[name] = elapsed = monotonic() - STARTED
+    _LOGGER.info("Startup: %s after %.3f s", name.replace("_", " "), elapsed)
+
+
+def dump(*_):
+    """Print the histograms to stderr"""
+    print(report(), file=stderr)
+    stderr.flush()
+
+
+def install_dump_handler(signum=None):
+    """Dump the histograms on SIGUSR1"""
+    import asyncio
+    import signal
+
+    signum = signum or getattr(signal, "SIGUSR1", None)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.add_signal_handler(signum, dump)
+    except (NotImplementedError, TypeError, ValueError):
+        _LOGGER.debug("No signal handler for dumping histograms")
+
+
+async def lag_monitor(
+    interval=LAG_INTERVAL, report_interval=REPORT_INTERVAL, level=logging.DEBUG
+):
+    """Measure how late the event loop wakes up, log it now and then"""
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    lag = histogram("loop_lag")
+    last_report = loop.time()
+    while True:
+        then = loop.time()
+        await asyncio.sleep(interval)
+        now = loop.time()
+        lag.observe(max(now - then - interval, 0))
+        if now - last_report >= report_interval:
+            last_report = now
+            _LOGGER.log(level, "Event loop lag %s", lag)
+
+
+_trace_file = None
+
+
+def start_trace(filename):
+    """Write per packet stage timestamps to filename"""
+    global _trace_file
+    _trace_file = open(filename, "a", buffering=1)
+    _LOGGER.info("Tracing packets to %s", filename)
+
+
+def tracing():
+    return _trace_file is not None
+
+
+class Trace:
+    """Monotonic timestamps of the stages of a packet
+
+    >>> trace = Trace("packet", 1459502928.5, 100.0, 100.001)
+    >>> trace.mark("decoded", 100.003)
+    >>> trace.as_dict()
+    {'packet': 'packet', 'kernel_rx': 1459502928.5, 'stages_ms': \
+{'userspace_rx': 1.0, 'decoded': 3.0}}
+    """
+
+    __slots__ = ("packet", "kernel_rx", "stages")
+
+    def __init__(self, packet, kernel_rx, kernel_rx_monotonic, userspace_rx):
+        self.packet = packet
+        self.kernel_rx = kernel_rx
+        self.stages = [
+            ("kernel_rx", kernel_rx_monotonic),
+            ("userspace_rx", userspace_rx),
+        ]
+
+    def mark(self, stage, now=None):
+        self.stages.append((stage, monotonic() if now is None else now))
+
+    def as_dict(self):
+        start = self.stages[0][1]
+        return dict(
+            packet=self.packet,
+            kernel_rx=self.kernel_rx,
+            stages_ms={
+                stage: round(1000 * (then - start), 3)
+                for stage, then in self.stages[1:]
+            },
+        )
+
+    def finish(self, stage):
+        """Mark the last stage and write the trace"""
+        self.mark(stage)
+        if _trace_file:
+            _trace_file.write(to_json(self.as_dict()) + "\n")
@@ -2,14 +2,23 @@
 # -*- mode: python; coding: utf-8 -*-
 
 import logging
+from collections import Counter
+import json
 from json import dumps as dump_json
-from os import environ as env
-from os.path import join, expanduser
-from time import time
+from os import environ as env, makedirs, replace
+from os.path import join, expanduser, dirname
+from time import time, monotonic
 import tellsticknet.const as const
+from tellsticknet import monitor
+from tellsticknet.config import (
+    DEVICE_PROPERTIES,
+    Config,
+    compile_entity,
+    group_key,
+    match_key,
+)
 from platform import node as hostname
 import string
-from hbmqtt.client import MQTTClient, ConnectException, ClientException
 import asyncio
 
 
@@ -39,6 +48,19 @@ STATES = {
 STATE_ON = STATES[const.TURNON]
 STATE_OFF = STATES[const.TURNOFF]
 
+# last known states, republished when the gateway starts
+SNAPSHOT_FILE = join(
+    env.get("XDG_CACHE_HOME", join(expanduser("~"), ".cache")),
+    "tellsticknet",
+    "state.json",
+)
+
+# seconds between writes of the snapshot, when changed
+SNAPSHOT_INTERVAL = 60
+
+# seconds until a state in the snapshot is too old to republish
+SNAPSHOT_MAX_AGE = 6 * 3600
+
 SENSOR_ICONS = {
     const.TEMPERATURE: "mdi:thermometer",
     const.HUMIDITY: "mdi:water",
@@ -77,8 +99,6 @@ SENSOR_UNITS = {
     const.BAROMETRIC_PRESSURE: "kPa",
 }
 
-DEVICE_PROPERTIES = ["protocol", "model", "unit", "house", "sensorId"]
-
 
 def method_for_str(s):
     """Map 'turnon' -> TURNON=1 etc.
@@ -152,17 +172,35 @@ class Device:
 
     subscriptions = {}
 
-    def __init__(self, entity, mqtt, controller, sensor=None):
-        self.entity = entity
+    # for metrics
+    published = Counter()  # per topic class, e.g. state, avail, config
+    in_flight = 0  # publishes not yet acked
+    last_heard = {}  # visible name -> time of last received packet
+
+    # state topic -> last published state, see SNAPSHOT_FILE
+    snapshot = {}
+
+    # whether sensor values are aggregated, see tellsticknet.aggregate
+    aggregating = False
+
+    def __init__(self, entity, mqtt, controller, sensor=None, compiled=None):
+        # copied, the class is added below
+        self.entity = dict(entity)
         self.controller = controller
         self.mqtt = mqtt
         self.sensors = None  # dict containing sub-items
-        self.sensor = sensor  # str for sensor item
+        self.sensor = sensor  # const.Quantity for sensor item
 
         if not self.name:
             _LOGGER.error("Name is missing for entity %s", entity)
             exit()
 
+        # match keys and command frames, see config.Config
+        self.compiled = compiled or compile_entity(entity)
+        # identifies the entity as configured, when the config is reloaded
+        self.key = entity_key(entity)
+        self.discovered = False
+
         if "class" not in self.entity:
             # optional in config file, since it can be
             # derrived from presence of the sensorId property
@@ -183,17 +221,11 @@ class Device:
     def command(self):
         return dict((k, self.entity.get(k)) for k in DEVICE_PROPERTIES)
 
-    def is_recipient(self, packet, entity=None):
-        def is_recipient(cmd):
-            properties = DEVICE_PROPERTIES
-            if packet.get("group"):
-                properties = (prop for prop in properties if prop != "unit")
-
-            return all(
-                cmd.get(prop) == packet.get(prop) for prop in properties
-            )
-
-        return any(is_recipient(command) for command in self.commands)
+    def is_recipient(self, event, entity=None):
+        key = match_key(event)
+        if event.group:
+            return group_key(key) in self.compiled.group_keys
+        return key in self.compiled.keys
 
     @classmethod
     async def route_message(cls, topic, payload):
@@ -221,16 +253,18 @@ class Device:
         else:
             _LOGGER.warning("Unknown topic: %s", topic)
 
-    async def receive_local(self, packet):
-        """Receive a packet form the controller / local network / UDP."""
-        if not self.is_recipient(packet):
+    async def receive_local(self, event):
+        """Receive an event form the controller / local network / UDP."""
+        if not self.is_recipient(event):
             return False
 
+        Device.last_heard[self.name] = time()
+
         if self.is_binary_sensor or self.sensor is not None:
             await self.publish_discovery()
 
         if self.is_command or self.is_binary_sensor:
-            method = method_for_str(packet["method"])
+            method = method_for_str(event.method)
             state = STATES[method]
             await self.publish_availability()
             await self.publish_state(state)
@@ -241,26 +275,45 @@ class Device:
                 await self.publish_state(STATE_OFF)
 
         elif self.sensor is not None:
-            state = next(
-                item["value"]
-                for item in packet["data"]
-                if item["name"] == self.sensor
-            )
+            stats = getattr(event, "stats", None)
+            if stats is not None:
+                # an aggregate.Aggregate
+                await self.publish(
+                    self.aggregate_topic,
+                    dict(
+                        stats[self.sensor],
+                        mean=event.value(self.sensor),
+                        start=event.start,
+                        end=event.timestamp,
+                    ),
+                )
+                if not event.replaces:
+                    return True
+            state = event.value(self.sensor)
             await self.publish_state(state)
         else:
             # Delegate to aggregate of sensors
-            if not self.sensors:
-                self.sensors = {
-                    item["name"]: Device(
-                        self.entity, self.mqtt, self.controller, item["name"]
-                    )
-                    for item in packet["data"]
-                }
-            for sensor in self.sensors.values():
-                await sensor.receive_local(packet)
+            for quantity, _ in event.data:
+                await self.sensor_device(quantity).receive_local(event)
 
         return True
 
+    def sensor_device(self, quantity):
+        """The device of one quantity of the sensor, created when first
+        needed"""
+        if self.sensors is None:
+            self.sensors = {}
+        if quantity not in self.sensors:
+            self.sensors[quantity] = Device(
+                self.entity,
+                self.mqtt,
+                self.controller,
+                quantity,
+                self.compiled,
+            )
+            self.sensors[quantity].key = self.key
+        return self.sensors[quantity]
+
     @property
     def component(self):
         return self.entity.get("component", "sensor")
@@ -318,8 +371,8 @@ class Device:
 
     @property
     def is_dimmer(self):
-        return self.entity.get("dimmer", False) or "dimmer" in self.entity.get(
-            "model", ""
+        return self.entity.get("dimmer", False) or "dimmer" in str(
+            self.entity.get("model", "")
         )
 
     @property
@@ -377,6 +430,10 @@ class Device:
     def command_topic(self):
         return self.make_topic("set")
 
+    @property
+    def aggregate_topic(self):
+        return self.make_topic("aggregate")
+
     @property
     def brightness_command_topic(self):
         return self.make_topic("brightness", "set")
@@ -402,6 +459,8 @@ class Device:
             res.update(icon=self.icon)
         if self.is_sensor:
             res.update(unit_of_measurement=self.unit)
+            if Device.aggregating:
+                res.update(json_attributes_topic=self.aggregate_topic)
         if self.is_command:
             res.update(optimistic=self.optimistic, retain=True)
         if self.is_binary:
@@ -422,7 +481,16 @@ class Device:
             dump_json(payload) if isinstance(payload, dict) else str(payload)
         )
         _LOGGER.debug(f"Publishing on {topic}: {payload}")
-        await self.mqtt.publish(topic, payload.encode("utf-8"), retain=retain)
+        then = monotonic()
+        Device.in_flight += 1
+        try:
+            await self.mqtt.publish(
+                topic, payload.encode("utf-8"), retain=retain
+            )
+        finally:
+            Device.in_flight -= 1
+        Device.published[topic.rsplit("/", 1)[-1]] += 1
+        monitor.since("publish", then)
         _LOGGER.debug(f"Published on {topic}: {payload}")
 
     async def subscribe_to(self, topic):
@@ -440,15 +508,40 @@ class Device:
             await self.subscribe_to(self.brightness_command_topic)
 
     def execute(self, command, param=None):
-        self.controller.execute(self.command, command, param=param)
+        self.controller.execute(
+            self.command,
+            command,
+            param=param,
+            frame=None if param else self.compiled.frames.get(command),
+        )
 
     async def publish_discovery(self, items=None):
         await self.publish(
             self.discovery_topic, self.discovery_payload, retain=True
         )
+        self.discovered = True
         await self.publish_availability()
         await self.subscribe()
 
+    async def remove(self, keep=()):
+        """Clear the discovery topics and drop the subscriptions of the device
+        and its sensors, except the topics in keep that are taken over by
+        another device"""
+        for device in [self, *(self.sensors or {}).values()]:
+            if device.discovered and device.discovery_topic not in keep:
+                await device.publish(device.discovery_topic, "", retain=True)
+            if not device.is_sensor or device.sensor is not None:
+                Device.snapshot.pop(device.state_topic, None)
+        topics = [
+            topic
+            for topic, device in Device.subscriptions.items()
+            if device is self and topic not in keep
+        ]
+        for topic in topics:
+            del Device.subscriptions[topic]
+        if topics:
+            await self.mqtt.unsubscribe(topics)
+
     async def publish_availability(self):
         await self.publish(
             self.availability_topic, STATE_ONLINE, retain=self.is_command
@@ -471,6 +564,22 @@ class Device:
             return
         _LOGGER.debug(f"Publishing state for {self}: {state}")
         await self.publish(self.state_topic, state, retain=self.is_command)
+        Device.snapshot[self.state_topic] = dict(
+            entity=self.key,
+            sensor=self.sensor and self.sensor.value,
+            state=state,
+            time=time(),
+        )
+
+    async def restore(self, entry):
+        """Publish the state of a snapshot entry, with the discovery and
+        availability not yet published"""
+        if not self.discovered:
+            await self.publish_discovery()
+        await self.publish(
+            self.state_topic, entry["state"], retain=self.is_command
+        )
+        Device.snapshot[self.state_topic] = entry
 
     @property
     def unit(self):
@@ -485,9 +594,224 @@ class Device:
         return SENSOR_NAMES.get(self.sensor)
 
 
-async def run(discover, config):
+def collect_metrics(mqtt):
+    """Lines of metrics for the MQTT gateway, see tellsticknet.metrics"""
+    from tellsticknet.metrics import family, seconds_since
+
+    yield from family(
+        "mqtt_publishes_total",
+        "counter",
+        "Messages published per topic class",
+        (
+            (dict(topic_class=topic_class), count)
+            for topic_class, count in sorted(Device.published.items())
+        ),
+    )
+    yield from family(
+        "mqtt_in_flight",
+        "gauge",
+        "Publishes waiting to be acked",
+        [({}, Device.in_flight)],
+    )
+    queue = getattr(
+        getattr(mqtt, "session", None), "delivered_message_queue", None
+    )
+    yield from family(
+        "mqtt_queue_depth",
+        "gauge",
+        "Received MQTT messages waiting to be handled",
+        [({}, queue.qsize() if queue else 0)],
+    )
+    yield from family(
+        "seconds_since_heard",
+        "gauge",
+        "Seconds since a packet was last received for the device",
+        seconds_since(Device.last_heard),
+    )
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_snapshot(filename, snapshot):
+    try:
+        makedirs(dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        replace(filename + ".tmp", filename)
+    except OSError as e:
+        _LOGGER.warning("Could not write snapshot %s: %s", filename, e)
+
+
+async def restore_snapshot(devices, snapshot, max_age=SNAPSHOT_MAX_AGE):
+    """Republish the states of the snapshot in one batch, the ones of
+    unknown devices or too old are dropped. Returns the number of
+    republished states"""
+    now = time()
+    entries = {}
+    for entry in snapshot.values():
+        if now - entry.get("time", 0) < max_age:
+            entries.setdefault(entry.get("entity"), []).append(entry)
+    restored = []
+    for device in devices:
+        for entry in entries.get(device.key, []):
+            if device.is_sensor and entry.get("sensor"):
+                quantity = const.Quantity(entry["sensor"])
+                restored.append((device.sensor_device(quantity), entry))
+            elif not device.is_sensor:
+                restored.append((device, entry))
+    await asyncio.gather(
+        *[device.restore(entry) for device, entry in restored]
+    )
+    return len(restored)
+
+
+async def snapshot_task(filename, interval=SNAPSHOT_INTERVAL):
+    """Write the snapshot periodically, when changed"""
+    written = None
+    while True:
+        await asyncio.sleep(interval)
+        if Device.snapshot != written:
+            written = dict(Device.snapshot)
+            write_snapshot(filename, written)
+
+
+def entity_key(entity):
+    """
+    >>> entity_key(dict(name="Kitchen", house=1))
+    '{"house": 1, "name": "Kitchen"}'
+    """
+    return dump_json(entity, sort_keys=True, default=str)
+
+
+async def update_devices(devices, config, mqtt, controller):
+    """Apply the config to the devices, in place: create the devices of new
+    entities and remove the ones of entities no longer configured, a
+    changed entity is replaced. Discovery is published for the new
+    commands and for the sensors already discovered of the replaced
+    entities, and cleared for the removed devices. Returns the number of
+    removed and created devices"""
+    if not isinstance(config, Config):
+        config = Config(config)
+    wanted = {
+        entity_key(entity): (entity, compiled)
+        for entity, compiled in zip(config, config.compiled)
+        if entity.get("controller", controller.mac_address).lower()
+        in (controller.ip_address, controller.mac_address)
+    }
+    current = {device.key for device in devices}
+    removed = [device for device in devices if device.key not in wanted]
+    added = [
+        Device(entity, mqtt, controller, compiled=compiled)
+        for key, (entity, compiled) in wanted.items()
+        if key not in current
+    ]
+    devices[:] = [device for device in devices if device.key in wanted]
+    devices.extend(added)
+
+    # Commands are visible directly,
+    # sensors only when data becomes available
+    commands = [device for device in added if device.is_command]
+    keep = set()
+    for device in commands:
+        keep.update((device.discovery_topic, device.command_topic))
+        if device.is_dimmer:
+            keep.add(device.brightness_command_topic)
+    # a replaced sensor stays discovered, instead of until the next packet
+    replaced = []
+    # names are unique within a component
+    replacements = {
+        (device.name, device.component): device for device in added
+    }
+    for device in removed:
+        replacement = replacements.get((device.name, device.component))
+        if replacement is None or replacement.is_command:
+            continue
+        if device.discovered:
+            replaced.append(replacement)
+        for quantity, sensor in (device.sensors or {}).items():
+            if sensor.discovered:
+                replaced.append(replacement.sensor_device(quantity))
+    keep.update(device.discovery_topic for device in replaced)
+    for device in removed:
+        await device.remove(keep)
+    await asyncio.gather(
+        *[device.publish_discovery() for device in commands + replaced]
+    )
+    return len(removed), len(added)
+
+
+def match_event(event):
+    """The properties of the event identifying the device or sensor"""
+    return {
+        prop: getattr(event, prop)
+        for prop in DEVICE_PROPERTIES
+        if getattr(event, prop) is not None
+    }
+
+
+def diagnostics_topic(controller, name):
+    """e.g. tellsticknet/ABC123/diagnostics/outliers"""
+    return make_topic(STATE_PREFIX, controller._mac, "diagnostics", name)
+
+
+async def dispatch(devices, event, catalog=None):
+    """Route an event from the controller to the configured devices, the
+    events of no device are added to the catalog.Catalog"""
+    then = monotonic()
+    recipients = [d for d in devices if d.is_recipient(event)]
+    monitor.since("route", then)
+    if event.trace:
+        event.trace.mark("routed")
+    for device in recipients:
+        await device.receive_local(event)
+    if event.trace:
+        event.trace.finish("published")
+    if not recipients:
+        if catalog is not None:
+            catalog.add(event)
+        else:
+            _LOGGER.debug("Skipped packet %s", event)
+
+
+async def run(
+    discover,
+    config,
+    client_factory=None,
+    updates=None,
+    snapshot=None,
+    aggregate=None,
+    with_raw=False,
+    outliers=False,
+    diagnostics=False,
+    catalog=None,
+):
+    """Run the gateway, updates is an async iterator of the config as it
+    changes, see config.watch. The states are restored from and saved to
+    the snapshot file, if given. With aggregate, the sensor values are
+    aggregated over windows of that many seconds, the mean published as
+    state and the min, max and count as attributes. With with_raw, the
+    readings are published as state, and the aggregates only as
+    attributes. With outliers, glitchy sensor readings are dropped, see
+    tellsticknet.outliers, and with diagnostics also published on the
+    diagnostics topic. The transmitters not configured are written to the
+    catalog file, if given, see tellsticknet.catalog"""
+    from tellsticknet.catalog import Catalog, write_task
+
+    # hbmqtt loads its plugins when imported
+    from hbmqtt.client import MQTTClient, ConnectException, ClientException
+
+    client_factory = client_factory or MQTTClient
+
     _LOGGER.debug("Found %d devices in config", len(config))
 
+    Device.aggregating = bool(aggregate)
+
     logging.getLogger("hbmqtt.client.plugins.packet_logger_plugin").setLevel(
         logging.WARNING
     )
@@ -498,7 +822,9 @@ async def run(discover, config):
 
     _LOGGER.debug("Client id is %s", client_id)
 
-    mqtt = MQTTClient(client_id=client_id)
+    mqtt = client_factory(client_id=client_id)
+
+    from tellsticknet import metrics
 
     mqtt_url = get_mqtt_url()
 
@@ -542,31 +868,88 @@ async def run(discover, config):
     # type but different device_class_etc
 
     _LOGGER.debug("Setting up devices")
-    devices = [
-        Device(e, mqtt, controller)
-        for e in config
-        if e.get("controller", controller.mac_address).lower()
-        in (controller.ip_address, controller.mac_address)
-    ]
+    devices = []
+    await update_devices(devices, config, mqtt, controller)
     _LOGGER.debug("Configured %d devices", len(devices))
     devices_setup.set()
 
-    # Commands are visible directly,
-    # sensors only when data becomes available
-    await asyncio.gather(
-        *[
-            device.publish_discovery()
-            for device in devices
-            if device.is_command
-        ]
-    )
+    outlier_filter = None
+    if outliers:
+        from tellsticknet.outliers import OutlierFilter
+
+        def publish_outlier(event, quantity, value, reason):
+            payload = dict(
+                match_event(event),
+                names=[d.name for d in devices if d.is_recipient(event)],
+                quantity=quantity.value,
+                value=value,
+                reason=reason,
+                time=event.timestamp,
+            )
+            loop.create_task(
+                mqtt.publish(
+                    diagnostics_topic(controller, "outliers"),
+                    dump_json(payload).encode("utf-8"),
+                )
+            )
 
-    _LOGGER.info("Waiting for packets")
-    async for packet in controller.events():
-        if not packet:  # timeout
-            continue
-        received = [await d.receive_local(packet) for d in devices]
-        if not any(received):
-            _LOGGER.warning("Skipped packet %s", packet)
-        # FIXME: Mark as unavailable if not heard from in time t (24 hours?)
-        # FIXME: Use config expire in config (like 6 hours?)
+        outlier_filter = OutlierFilter(
+            config, on_reject=publish_outlier if diagnostics else None
+        )
+
+    async def reload_task():
+        async for config in updates:
+            if outlier_filter:
+                outlier_filter.reload(config)
+            removed, added = await update_devices(
+                devices, config, mqtt, controller
+            )
+            _LOGGER.info(
+                "Reloaded config, removed %d and created %d devices",
+                removed,
+                added,
+            )
+
+    if updates:
+        loop.create_task(reload_task())
+
+    if snapshot:
+        Device.snapshot.clear()
+        restored = await restore_snapshot(devices, read_snapshot(snapshot))
+        _LOGGER.info("Republished %d states from %s", restored, snapshot)
+        loop.create_task(snapshot_task(snapshot))
+
+    unknown = Catalog()
+    if catalog:
+        loop.create_task(write_task(unknown, catalog))
+
+    events = controller.events()
+    if outlier_filter:
+        from tellsticknet.outliers import filtered
+
+        events = filtered(events, outlier_filter)
+    if aggregate:
+        from tellsticknet.aggregate import aggregated
+
+        events = aggregated(events, aggregate, replace=not with_raw)
+
+    # removed when done, run may be called again in the same process
+    collectors = [lambda: collect_metrics(mqtt)]
+    if outlier_filter:
+        collectors.append(outlier_filter.collect_metrics)
+    metrics.COLLECTORS.extend(collectors)
+    try:
+        _LOGGER.info("Waiting for packets")
+        async for event in events:
+            if not event:  # timeout or not decodable
+                continue
+            await dispatch(devices, event, unknown)
+            # FIXME: Mark as unavailable if not heard from in time t (24 h?)
+            # FIXME: Use config expire in config (like 6 hours?)
+    finally:
+        for collector in collectors:
+            metrics.COLLECTORS.remove(collector)
+        if snapshot:
+            write_snapshot(snapshot, Device.snapshot)
+        if catalog:
+            unknown.write(catalog)
@@ -0,0 +1,202 @@
+"""
+filter of glitchy sensor readings
+
+Cheap sensors sometimes decode to garbage, e.g. -204 °C or a humidity of
+127 %. A reading is rejected when it is outside the physical range of the
+quantity, or when it differs from the median of the last HISTORY readings
+of the sensor by more than delta, plus rate per second since the previous
+reading. The median follows a real change after a few readings, a single
+spike never moves it.
+
+The limits of a quantity can be set per sensor in the config file, e.g.
+
+    name: Freezer
+    protocol: fineoffset
+    sensorId: 135
+    limits:
+      temp: {min: -30, max: 10, delta: 1, rate: 0.01}
+"""
+
+import logging
+from collections import Counter, OrderedDict, deque, namedtuple
+from statistics import median
+
+from .config import Config, match_key
+from .const import Quantity
+
+_LOGGER = logging.getLogger(__name__)
+
+# readings of a sensor quantity kept for the median
+HISTORY = 5
+
+# readings needed before the median is used
+MIN_HISTORY = 3
+
+# sensor quantities with a history, e.g. also of the sensors of the
+# neighbours, the ones not heard from for the longest are dropped
+CAPACITY = 2000
+
+Limits = namedtuple("Limits", "min max delta rate")
+
+DEFAULT_LIMITS = {
+    Quantity.TEMPERATURE: Limits(-60, 70, 3, 0.05),
+    Quantity.DEW_POINT: Limits(-60, 70, 3, 0.05),
+    Quantity.HUMIDITY: Limits(0, 100, 15, 0.2),
+    Quantity.RAINRATE: Limits(0, 500, None, None),
+    Quantity.RAINTOTAL: Limits(0, None, None, None),
+    Quantity.WINDDIRECTION: Limits(0, 360, None, None),
+    Quantity.WINDAVERAGE: Limits(0, 100, None, None),
+    Quantity.WINDGUST: Limits(0, 100, None, None),
+    Quantity.UV: Limits(0, 20, None, None),
+}
+
+# reasons of rejection
+RANGE = "range"
+SPIKE = "spike"
+
+
+def parse_limits(limits):
+    """
+    Limits of the config file merged with the defaults
+
+    >>> parse_limits(dict(temp=dict(min=-30, max=10)))[Quantity.TEMPERATURE]
+    Limits(min=-30, max=10, delta=3, rate=0.05)
+    """
+    parsed = dict(DEFAULT_LIMITS)
+    for name, overrides in (limits or {}).items():
+        quantity = Quantity(name)
+        default = DEFAULT_LIMITS.get(quantity, Limits(None, None, None, None))
+        parsed[quantity] = default._replace(**overrides)
+    return parsed
+
+
+class History:
+    __slots__ = ("values", "time")
+
+    def __init__(self):
+        self.values = deque(maxlen=HISTORY)
+        self.time = None
+
+
+class OutlierFilter:
+    """
+    Filter of the readings of all sensors, on_reject is called with the
+    event, quantity, value and reason of each rejected reading
+
+    >>> from .event import Event
+    >>> outliers = OutlierFilter()
+    >>> def reading(temp, timestamp):
+    ...     return Event.from_fields(dict(protocol="fineoffset", \
+sensorId=135, data=dict(temp=temp), timestamp=timestamp))
+    >>> [outliers.check(reading(t, 45 * i)) for i, t in enumerate(\
+[20.1, -204.0, 20.3, 20.2, 35.6, 20.4])]
+    [True, False, True, True, False, True]
+    >>> sorted(outliers.stats.items())
+    [(('temp', 'range'), 1), (('temp', 'spike'), 1)]
+    """
+
+    def __init__(self, config=(), on_reject=None, capacity=CAPACITY):
+        self.on_reject = on_reject
+        self.capacity = capacity
+        # (match key, quantity) -> History, last heard last
+        self._history = OrderedDict()
+        # (quantity, reason) -> rejected readings
+        self.stats = Counter()
+        self.reload(config)
+
+    def reload(self, config):
+        """Use the limits of a new configuration"""
+        if not isinstance(config, Config):
+            config = Config(config)
+        self._limits = {}  # match key -> quantity -> Limits
+        for entity, compiled in zip(config, config.compiled):
+            if "limits" not in entity:
+                continue
+            try:
+                limits = parse_limits(entity["limits"])
+            except (AttributeError, TypeError, ValueError) as e:
+                _LOGGER.error("Invalid limits of %s: %s", entity["name"], e)
+                continue
+            for key in compiled.keys:
+                self._limits[key] = limits
+
+    def reason(self, key, quantity, value, timestamp):
+        """Why the reading is rejected, None if it is accepted"""
+        limits = self._limits.get(key, DEFAULT_LIMITS).get(quantity)
+        if not limits:
+            return None
+        if (limits.min is not None and value < limits.min) or (
+            limits.max is not None and value > limits.max
+        ):
+            return RANGE
+        if limits.delta is None:
+            return None
+        history = self._history.get((key, quantity))
+        if history is None:
+            history = self._history[key, quantity] = History()
+            if len(self._history) > self.capacity:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end((key, quantity))
+        values = history.values
+        elapsed = max((timestamp or 0) - (history.time or 0), 0)
+        history.time = timestamp
+        # rejected readings are kept too, so that the median follows a
+        # real change
+        reference = median(values) if len(values) >= MIN_HISTORY else None
+        values.append(value)
+        if reference is None:
+            return None
+        allowed = limits.delta + (limits.rate or 0) * elapsed
+        if abs(value - reference) > allowed:
+            return SPIKE
+        return None
+
+    def check(self, event):
+        """Remove the rejected readings from the event, returns False if
+        none is left"""
+        key = match_key(event)
+        accepted = []
+        for quantity, value in event.data:
+            reason = self.reason(key, quantity, value, event.timestamp)
+            if reason is None:
+                accepted.append((quantity, value))
+                continue
+            self.stats[quantity.value, reason] += 1
+            _LOGGER.info(
+                "Rejected %s %s of %s/%s/%s (%s)",
+                quantity.value,
+                value,
+                event.protocol,
+                event.model,
+                event.sensorId,
+                reason,
+            )
+            if self.on_reject:
+                self.on_reject(event, quantity, value, reason)
+        if len(accepted) < len(event.data):
+            event.data = tuple(accepted)
+        return bool(accepted)
+
+    def collect_metrics(self):
+        """Lines of metrics, see tellsticknet.metrics"""
+        from .metrics import family
+
+        yield from family(
+            "outliers_total",
+            "counter",
+            "Sensor readings rejected as outliers",
+            (
+                (dict(quantity=quantity, reason=reason), count)
+                for (quantity, reason), count in sorted(self.stats.items())
+            ),
+        )
+
+
+async def filtered(events, outliers):
+    """Yield the events, with the rejected readings removed, see
+    OutlierFilter"""
+    async for event in events:
+        if event and event.data and not outliers.check(event):
+            continue
+        yield event
@@ -4,6 +4,11 @@ https://developer.telldus.com/doxygen/html/TellStickNet.html
 """
 
 import logging
+from collections import Counter
+from time import monotonic
+
+from . import const, monitor
+from .event import Event
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -118,8 +123,18 @@ def _encode_dict(d):
 
 
 def _encode_list(l):
-    """https://developer.telldus.com/doxygen/html/TellStickNet.html"""
-    raise NotImplementedError("Encode for List type missing")
+    """
+    encode a list
+    https://developer.telldus.com/doxygen/html/TellStickNet.html
+
+    >>> _encode_list(['foo', 42])
+    b'l3:fooi2ass'
+    """
+    return b"%c%s%c" % (
+        TAG_LIST,
+        b"".join(_encode_any(x) for x in l),
+        TAG_END,
+    )
 
 
 def _encode_any(t):
@@ -288,11 +303,88 @@ def _fixup(d):
     )
 
 
-def _decode(**packet):
+# number of packets decoded by the firmware (fast path) vs in python
+STATS = Counter()
+
+# number of decoded packets per (protocol, model, "ok" or "error")
+DECODES = Counter()
+
+
+def fast_path_ratio():
+    """
+    fraction of sensor traffic where the firmware supplied decoded values
+
+    >>> STATS.clear()
+    >>> fast_path_ratio()
+    0.0
+    >>> STATS.update(firmware=3, python=1)
+    >>> fast_path_ratio()
+    0.75
+    >>> STATS.clear()
+    """
+    total = STATS["firmware"] + STATS["python"]
+    return STATS["firmware"] / total if total else 0.0
+
+
+def _number(s):
+    """
+    convert a firmware value string to a number
+
+    >>> _number("16.6")
+    16.6
+    >>> _number("45")
+    45
+    >>> _number(-3)
+    -3
+    """
+    if isinstance(s, str):
+        return float(s) if "." in s else int(s)
+    return s
+
+
+def _decode_values(packet):
+    """
+    map the sensor values already decoded by the firmware into the data dict
+    returns None if any value is of a type or scale we do not know about
+
+    >>> _decode_values(dict(protocol="fineoffset", id=152, \
+values=[dict(scale=0, type=1, value="16.6")]))["data"]
+    {'temp': 16.6}
+
+    >>> _decode_values(dict(protocol="fineoffset", id=152, \
+values=[dict(scale=0, type=4711, value="16.6")]))
+    """
+    data = {}
+    for item in packet["values"]:
+        name = const.SENSOR_TYPES.get(item.get("type"))
+        if name is None or item.get("scale", 0) != 0:
+            return None
+        data[name] = _number(item["value"])
+    return dict(packet, sensorId=packet["id"], data=data)
+
+
+def _decode_fields(packet):
     """
     dynamic lookup of the protocol implementation
+    returns the decoded fields, with any sensor values as a dict in "data"
     """
 
+    try:
+        decoded = _decode_protocol(packet)
+    except (NotImplementedError, ValueError):
+        DECODES[packet.get("protocol"), packet.get("model"), "error"] += 1
+        raise
+    DECODES[decoded.get("protocol"), decoded.get("model"), "ok"] += 1
+    return decoded
+
+
+def _decode_protocol(packet):
+    if "values" in packet and "id" in packet:
+        decoded = _decode_values(packet)
+        if decoded:
+            STATS["firmware"] += 1
+            return decoded
+
     protocol = packet["protocol"]
     try:
         modname = "tellsticknet.protocols.%s" % protocol
@@ -307,12 +399,8 @@ def _decode(**packet):
         if packet:
             data = packet.pop("data")
             if isinstance(data, dict):
-                # convert data={temp=42, humidity=38} to
-                # data=[{name=temp, value=42},{name=humidity, valye=38}]
-                packet["data"] = [
-                    dict(name=name, value=value)
-                    for name, value in data.items()
-                ]
+                STATS["python"] += 1
+                packet["data"] = data
             return packet
         raise NotImplementedError
     except ImportError:
@@ -332,6 +420,21 @@ def _decode(**packet):
         raise
 
 
+def _decode(**packet):
+    """
+    decode the packet into a dict
+    """
+    packet = _decode_fields(packet)
+    data = packet.pop("data", None)
+    if data is not None:
+        # convert data={temp=42, humidity=38} to
+        # data=[{name=temp, value=42},{name=humidity, valye=38}]
+        packet["data"] = [
+            dict(name=name, value=value) for name, value in data.items()
+        ]
+    return packet
+
+
 def encode(**device):
     protocol = device.pop("protocol")
     _LOGGER.debug("Encoding for protocol %s", protocol)
@@ -372,9 +475,123 @@ A:fineoffset4:datai488029FF9Ass"
 4:datai4980A6FFBBs5:class6:sensors"
     >>> decode_packet(packet)["values"][0]["value"]
     '16.6'
+    >>> decode_packet(packet)["data"]
+    [{'name': 'temp', 'value': 16.6}]
+    >>> decode_packet(packet)["sensorId"]
+    152
+
+    """
+    args = _decode_rawdata(packet)
+    return _decode(**args) if args else None
+
+
+def decode_event(packet, filters=None):
+    """
+    decode a packet into a compact Event
+
+    The event is decoded on first access to its fields. If filters are
+    given, None is returned unless the packet is accepted by any of them,
+    checking the raw packet header before the packet is decoded.
+
+    >>> packet = "7:RawDatah5:class6:sensor8:protocol\
+8:mandolyn5:model13:temperaturehumidity4:dataiAF1D466Bss"
+    >>> event = decode_event(packet)
+    >>> event.sensorId, event.value(const.Quantity.TEMPERATURE)
+    (104, 20.4)
+
+    >>> decode_event(packet).as_dict() == decode_packet(packet)
+    True
+
+    >>> from .event import Filter
+    >>> decode_event(packet, [Filter(protocol="fineoffset")])
+
+    >>> decode_event(packet, [Filter(protocol="mandolyn", sensorId=11)])
+
+    >>> decode_event(packet, [Filter(sensorId=11), Filter(sensorId=104)])
+    Event(class='sensor', protocol='mandolyn', model='temperaturehumidity', \
+sensorId=104, data=[{'name': 'temp', 'value': 20.4}, \
+{'name': 'humidity', 'value': 29}])
 
+    The model is only known once decoded, the header has none here
+
+    >>> packet = "7:RawDatah5:class6:sensor8:protocol\
+A:fineoffset4:datai488029FF9Ass"
+    >>> decode_event(packet, [Filter(model="temperaturehumidity")])
+
+    >>> decode_event(packet, [Filter(model="temperature")]).model
+    'temperature'
+
+    >>> packet = "7:RawDatah8:protocolA:fineoffset2:idi98s6:valueslh\
+5:scalei0s4:typei1s5:value4:16.6ss5:modelB:temperature\
+4:datai4980A6FFBBs5:class6:sensors"
+    >>> decode_event(packet).data
+    ((<Quantity.TEMPERATURE: 'temp'>, 16.6),)
+    >>> decode_event(packet).as_dict() == decode_packet(packet)
+    True
     """
+    args = _decode_rawdata(packet)
+    if not args:
+        return None
+    event = Event.lazy(args)
+    if not filters:
+        return event
+    filters = [f for f in filters if f.accepts_header(args)]
+    if any(f.decided_by_header(args) or f.accepts(event) for f in filters):
+        return event
+    return None
 
+
+def decode_eagerly(packet, filters=None):
+    """
+    decode_event, with the fields decoded up front
+    for use in a worker pool, the returned event can be pickled
+
+    >>> import pickle
+    >>> packet = "7:RawDatah5:class6:sensor8:protocol\
+A:fineoffset4:datai488029FF9Ass"
+    >>> pickle.loads(pickle.dumps(decode_eagerly(packet))).sensorId
+    136
+    """
+    event = decode_event(packet, filters)
+    if event is not None:
+        bool(event)  # access a field to decode it
+    return event
+
+
+def decode_counted(packet, filters=None):
+    """
+    decode_eagerly, for a worker process, returns the event with the
+    decoder counts and the decode time, to be added to the counters of the
+    parent process with merge_counted
+
+    >>> packet = "7:RawDatah5:class6:sensor8:protocol\
+A:fineoffset4:datai488029FF9Ass"
+    >>> event, (decodes, stats, elapsed) = decode_counted(packet)
+    >>> decodes, stats
+    ({('fineoffset', 'temperature', 'ok'): 1}, {'python': 1})
+    """
+    decodes, stats = Counter(DECODES), Counter(STATS)
+    then = monotonic()
+    event = decode_eagerly(packet, filters)
+    elapsed = monotonic() - then
+    decodes = dict(DECODES - decodes)
+    return event, (decodes, dict(STATS - stats), elapsed if decodes else None)
+
+
+def merge_counted(counts):
+    """Add the counts returned by decode_counted in a worker process"""
+    decodes, stats, elapsed = counts
+    DECODES.update(decodes)
+    STATS.update(stats)
+    if elapsed is not None:
+        monitor.observe("decode", elapsed)
+
+
+def _decode_rawdata(packet):
+    """
+    parse the packet envelope
+    returns the arguments of a RawData packet, None for anything else
+    """
     if isinstance(packet, str):
         packet = packet.encode()
 
@@ -388,7 +605,7 @@ A:fineoffset4:datai488029FF9Ass"
         _LOGGER.info("Got Z-Wave info packet")
         _LOGGER.debug("%s %s", command, args)
     elif command == "RawData":
-        return _decode(**args)
+        return args
     else:
         raise NotImplementedError("Unknown command type")
 
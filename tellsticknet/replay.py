@@ -0,0 +1,114 @@
+"""
+replay packets captured with listen --raw, through the same pipeline as
+packets received from a controller
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from time import time, monotonic
+
+from .controller import Controller
+
+_LOGGER = logging.getLogger(__name__)
+
+# replay packets in real time
+SPEED = 1.0
+
+
+def parse_line(line):
+    """
+    Return (timestamp, packet) of a captured line, timestamp is None if the
+    line has no timestamp
+
+    >>> parse_line("2016-04-01T11:39:15 7:RawDatas\\n")
+    (datetime.datetime(2016, 4, 1, 11, 39, 15), '7:RawDatas')
+    >>> parse_line("7:RawDatas")
+    (None, '7:RawDatas')
+    >>> parse_line("")
+    (None, '')
+    """
+    line = line.strip()
+    if " " in line:
+        timestamp, packet = line.split(" ", 1)
+        return datetime.fromisoformat(timestamp), packet
+    return None, line
+
+
+class Replay(Controller):
+    """Controller reading datagrams from a capture file
+
+    speed is the speed-up factor of the original inter-arrival times,
+    0 to replay as fast as possible. The events have the time of the
+    capture, if the lines have one. Commands are only logged.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> with NamedTemporaryFile("w", suffix=".log") as f:
+    ...     _ = f.write("2016-04-01T11:39:15 7:RawDatah5:class6:sensor\
+8:protocolA:fineoffset4:datai488029FF9Ass\\n")
+    ...     f.flush()
+    ...     async def replay():
+    ...         return [e async for e in Replay(f.name, 0).events()]
+    ...     (event,) = asyncio.run(replay())
+    >>> datetime.fromtimestamp(event.lastUpdated)
+    datetime.datetime(2016, 4, 1, 11, 39, 15)
+    """
+
+    def __init__(
+        self, filename, speed=SPEED, ip="replay", mac="replay", **options
+    ):
+        super().__init__(ip, mac, **options)
+        self._filename = filename
+        self._speed = speed
+
+    def __repr__(self):
+        return f"Replay@{self._filename}"
+
+    async def datagrams(self):
+        started = monotonic()
+        first = None
+        count = 0
+        with open(self._filename) as f:
+            for line in f:
+                try:
+                    timestamp, packet = parse_line(line)
+                except ValueError:
+                    _LOGGER.warning("Skipping malformed line: %s", line)
+                    continue
+                if not packet:
+                    continue
+                if timestamp:
+                    timestamp = timestamp.timestamp()
+                if self._speed and timestamp:
+                    if first is None:
+                        first = timestamp
+                    delay = (
+                        started
+                        + (timestamp - first) / self._speed
+                        - monotonic()
+                    )
+                    await asyncio.sleep(max(delay, 0))
+                else:
+                    # let the consumers run
+                    await asyncio.sleep(0)
+                count += 1
+                self.stats["datagrams"] += 1
+                yield packet, timestamp or time()
+
+        elapsed = monotonic() - started
+        _LOGGER.info(
+            "Replayed %d packets in %.3f s, %.0f packets/s",
+            count,
+            elapsed,
+            count / elapsed if elapsed else 0,
+        )
+
+    @staticmethod
+    def _stamp(event, packet, timestamp, received):
+        # the time since the capture is no receive delay
+        Controller._stamp(event, packet, time(), received)
+        event.timestamp = timestamp
+        event.lastUpdated = int(timestamp)
+
+    async def _execute(self, device, method, param, frame=None):
+        _LOGGER.info("Replay, not sending %s to %s", method, device)
@@ -0,0 +1,216 @@
+"""
+soak test of the MQTT gateway
+
+Drives mqtt.run with simulated traffic, as fast as possible, against a
+stand-in broker. Commands are sent from the broker now and then. The
+traced memory, RSS and number of tasks are sampled along the way, and the
+test fails if memory grows by more than the threshold per packet after
+the warm-up. Run it with python -m tellsticknet.soak
+
+Usage:
+  soak [options]
+
+Options:
+  --hours <h>           Simulated hours of traffic [default: 24]
+  --rate <n>            Simulated packets per second [default: 1]
+  --sensors <n>         Simulated sensors [default: 30]
+  --remotes <n>         Simulated remote controls [default: 10]
+  --samples <n>         Number of samples [default: 20]
+  --threshold <bytes>   Max memory growth per packet [default: 1.0]
+  --seed <n>            Seed of the simulation [default: 4711]
+"""
+
+import asyncio
+import logging
+import random
+import tracemalloc
+from functools import partial
+from os import path, sysconf
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from . import emulator, testing
+
+_LOGGER = logging.getLogger(__name__)
+
+# least fraction of the packets before memory growth is measured, while
+# e.g. the sensor children of the devices are created. The warm-up also
+# lasts until every sensor and unit of the remotes has been heard
+WARMUP = 0.2
+
+# packets between commands sent from the broker
+COMMAND_INTERVAL = 100
+
+
+def rss():
+    """
+    Resident set size in bytes, None if not available
+
+    >>> rss() is None or rss() > 0
+    True
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def sample(packets):
+    return dict(
+        packets=packets,
+        traced=tracemalloc.get_traced_memory()[0],
+        rss=rss(),
+        tasks=len(asyncio.all_tasks()),
+    )
+
+
+def growth(samples):
+    """
+    Growth of traced memory in bytes per packet, the least squares slope
+    over the samples
+
+    >>> growth([dict(packets=0, traced=1000), dict(packets=100, traced=1100), \
+dict(packets=200, traced=1400)])
+    2.0
+    >>> growth([dict(packets=0, traced=1000)])
+    0.0
+    """
+    n = len(samples)
+    if n < 2:
+        return 0.0
+    x = [s["packets"] for s in samples]
+    y = [s["traced"] for s in samples]
+    mean_x, mean_y = sum(x) / n, sum(y) / n
+    variance = sum((xi - mean_x) ** 2 for xi in x)
+    covariance = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y))
+    return covariance / variance if variance else 0.0
+
+
+async def soak(count, sensors, remotes, samples, seed):
+    """Run the gateway on count simulated packets, return the samples, the
+    number of packets of the warm-up (None if the whole population was
+    never heard) and the tracemalloc snapshots at the end of the warm-up
+    and at the end"""
+    from .mqtt import Device, run
+    from .protocol import encode_packet
+
+    # the warm-up snapshot is kept on disk until the end, not to be counted
+    # as growth of the traced memory
+    directory = TemporaryDirectory()
+    filename = path.join(directory.name, "warmup")
+
+    rng = random.Random(seed)
+    devices = emulator.population(sensors, remotes, rng)
+    broker = testing.Broker()
+    interval = max(count // samples, 1)
+    transmitters = sum(
+        len(d.UNITS) if isinstance(d, emulator.Remote) else 1 for d in devices
+    )
+    result = []
+    final = None
+    warmup = None
+
+    def traffic():
+        nonlocal final, warmup
+        heard = set()
+        for i in range(count):
+            # as testing.packets, keeping track of the units of the remotes
+            device = rng.choice(devices)
+            if isinstance(device, emulator.Remote):
+                unit = rng.choice(device.UNITS)
+                frame = device.frame(unit)
+            else:
+                unit = None
+                frame = device.frame()
+            heard.add((id(device), unit))
+            packet = encode_packet("RawData", **frame).decode("ascii")
+            warm = (
+                warmup is None
+                and i >= count * WARMUP
+                and len(heard) == transmitters
+            )
+            if warm:
+                warmup = i
+                result.append(sample(i))
+                tracemalloc.take_snapshot().dump(filename)
+                _LOGGER.info("%s, end of warm-up", result[-1])
+            elif i % interval == 0:
+                result.append(sample(i))
+                _LOGGER.info("%s", result[-1])
+            if i % COMMAND_INTERVAL == 0 and Device.subscriptions:
+                broker.deliver(
+                    rng.choice(sorted(Device.subscriptions)),
+                    rng.choice(("turnon", "turnoff")),
+                )
+            yield packet
+        result.append(sample(count))
+        final = tracemalloc.take_snapshot()
+
+    async def discover():
+        return testing.PacketSource(traffic())
+
+    with directory:
+        await run(
+            discover,
+            testing.config(devices, component="switch"),
+            client_factory=partial(testing.MQTTClient, broker=broker),
+        )
+        if warmup is None:
+            return result, None, None
+        return result, warmup, (tracemalloc.Snapshot.load(filename), final)
+
+
+def main():
+    import docopt
+
+    args = docopt.docopt(__doc__)
+    logging.basicConfig(level=logging.INFO)
+    # the gateway logs skipped and dropped packets
+    logging.getLogger("tellsticknet.mqtt").setLevel(logging.ERROR)
+    logging.getLogger("tellsticknet.event").setLevel(logging.ERROR)
+
+    count = int(float(args["--hours"]) * 3600 * float(args["--rate"]))
+    threshold = float(args["--threshold"])
+    _LOGGER.info("Soaking the gateway with %d packets", count)
+
+    tracemalloc.start()
+    then = monotonic()
+    samples, warmup, snapshots = asyncio.run(  # pylint: disable=no-member
+        soak(
+            count,
+            int(args["--sensors"]),
+            int(args["--remotes"]),
+            int(args["--samples"]),
+            int(args["--seed"]),
+        )
+    )
+    elapsed = monotonic() - then
+    if warmup is None:
+        exit("Not every simulated device was heard, soak for longer")
+
+    # without the traces of taking the snapshots
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    warm, final = (s.filter_traces(own) for s in snapshots)
+    for stat in final.compare_to(warm, "lineno")[:10]:
+        _LOGGER.info("%s", stat)
+
+    per_packet = growth([s for s in samples if s["packets"] >= warmup])
+    _LOGGER.info(
+        "%d packets in %.1f s, %.0f packets/s, "
+        "memory growth %.3f bytes/packet after warm-up, max %d tasks",
+        count,
+        elapsed,
+        count / elapsed,
+        per_packet,
+        max(s["tasks"] for s in samples),
+    )
+    if per_packet > threshold:
+        exit(
+            "Memory grows by %.3f bytes per packet, more than %.3f"
+            % (per_packet, threshold)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+latest value of every sensor and device, in shared memory
+
+The controller writes the values of the received events to a memory mapped
+file, by default in /dev/shm, and other processes on the host read them
+without any round-trip to the gateway. Each quantity of a sensor, and the
+method of each device, has a fixed size slot with the value and the
+receive time, protected by a sequence lock: the writer makes the sequence
+number odd while writing, and a reader retries until it reads the same
+even number before and after the slot.
+
+Slots are allocated as new keys are seen, e.g.
+fineoffset/temperature/135/temp for a sensor and
+arctech/selflearning/1329110/1/method for a device. The value of a device
+is the method constant, e.g. const.TURNON.
+
+Run python -m tellsticknet.table [<file>] to print the table.
+"""
+
+import logging
+import mmap
+import struct
+from os import fstat, replace, stat
+from time import time, sleep, monotonic
+
+from . import const
+
+_LOGGER = logging.getLogger(__name__)
+
+FILENAME = "/dev/shm/tellsticknet"
+
+# maximum number of slots
+CAPACITY = 1024
+
+MAGIC = b"TSNT"
+VERSION = 1
+
+# magic, version, capacity, slots in use
+HEADER = struct.Struct("<4sHxxII")
+
+# sequence number, receive time, value, key
+SLOT = struct.Struct("<I4xdd72s")
+SEQUENCE = struct.Struct("<I")
+VALUE = struct.Struct("<dd")
+KEY_OFFSET = SEQUENCE.size + 4 + VALUE.size
+
+# reads of a slot being written, yielding to the writer in between, before
+# backing off
+RETRIES = 1000
+
+# seconds of the first back-off, doubled up to MAX_BACKOFF
+BACKOFF = 0.0001
+MAX_BACKOFF = 0.01
+
+# seconds a slot may be written before the writer is considered stuck
+STUCK = 1.0
+
+
+class WriterStuck(Exception):
+    """A slot has been written for longer than STUCK seconds"""
+
+
+def _offset(index):
+    return HEADER.size + index * SLOT.size
+
+
+def event_values(event):
+    """
+    Yield (key, value) for the quantities or the method of an event
+
+    >>> from .event import Event
+    >>> list(event_values(Event.from_fields(dict(protocol="fineoffset", \
+model="temperature", sensorId=135, data=dict(temp=16.7)))))
+    [('fineoffset/temperature/135/temp', 16.7)]
+    >>> list(event_values(Event.from_fields(dict(protocol="arctech", \
+model="selflearning", house=1329110, unit=1, method="turnoff"))))
+    [('arctech/selflearning/1329110/1/method', 2)]
+    """
+    if event.data:
+        for quantity, value in event.data:
+            key = f"{event.protocol}/{event.model}/{event.sensorId}"
+            yield f"{key}/{quantity.value}", value
+    elif event.method:
+        method = getattr(const, str(event.method).upper(), None)
+        if isinstance(method, int):
+            key = f"{event.protocol}/{event.model}/{event.house}/{event.unit}"
+            yield f"{key}/method", method
+
+
+class Table:
+    """Writer of the table, there is one per file
+
+    >>> from tempfile import TemporaryDirectory
+    >>> from os.path import join
+    >>> with TemporaryDirectory() as d:
+    ...     with Table(join(d, "table"), capacity=2) as table:
+    ...         table.set("a", 1.5, 1000.0)
+    ...         table.set("b", 2.5, 1000.0)
+    ...         table.set("c", 3.5, 1000.0)
+    ...         table.set("a", 4.5, 1001.0)
+    ...         with Reader(join(d, "table")) as reader:
+    ...             reader.items()
+    {'a': (4.5, 1001.0), 'b': (2.5, 1000.0)}
+    """
+
+    def __init__(self, filename=FILENAME, capacity=CAPACITY):
+        self.filename = filename
+        self.capacity = capacity
+        self._slots = {}  # key -> index
+        self._full = False
+        # a new file, readers of the previous one see it replaced
+        with open(filename + ".tmp", "wb") as f:
+            f.truncate(_offset(capacity))
+        with open(filename + ".tmp", "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, capacity, 0)
+        replace(filename + ".tmp", filename)
+        _LOGGER.info("Sharing latest values in %s", filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def _allocate(self, key):
+        encoded = key.encode("utf-8")
+        if len(encoded) > SLOT.size - KEY_OFFSET:
+            _LOGGER.debug("Key too long for the table: %s", key)
+            return None
+        if len(self._slots) >= self.capacity:
+            if not self._full:
+                _LOGGER.warning("Table %s is full", self.filename)
+                self._full = True
+            return None
+        index = self._slots[key] = len(self._slots)
+        start = _offset(index) + KEY_OFFSET
+        self._mm[start : start + len(encoded)] = encoded
+        # the key is written before the slot is counted as used
+        HEADER.pack_into(
+            self._mm, 0, MAGIC, VERSION, self.capacity, len(self._slots)
+        )
+        return index
+
+    def set(self, key, value, timestamp=None):
+        index = self._slots.get(key)
+        if index is None:
+            index = self._allocate(key)
+            if index is None:
+                return
+        offset = _offset(index)
+        (sequence,) = SEQUENCE.unpack_from(self._mm, offset)
+        SEQUENCE.pack_into(self._mm, offset, sequence + 1)
+        VALUE.pack_into(
+            self._mm, offset + 8, timestamp or time(), float(value)
+        )
+        SEQUENCE.pack_into(self._mm, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def update(self, event):
+        """Write the values of a received event"""
+        for key, value in event_values(event):
+            self.set(key, value, event.timestamp)
+
+
+class Reader:
+    """Reader of the table, in any process"""
+
+    def __init__(self, filename=FILENAME):
+        self.filename = filename
+        self._mm = None
+        self._slots = {}  # key -> index
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+
+    def _open(self):
+        self.close()
+        with open(self.filename, "rb") as f:
+            self._inode = fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, _ = HEADER.unpack_from(self._mm, 0)
+        if (magic, version) != (MAGIC, VERSION):
+            raise ValueError(f"{self.filename} is not a table")
+        self._slots = {}
+
+    def _refresh(self):
+        """Index the keys allocated since last time, reopen the file if
+        the writer has been restarted"""
+        try:
+            if stat(self.filename).st_ino != self._inode:
+                self._open()
+        except OSError:
+            pass
+        _, _, _, used = HEADER.unpack_from(self._mm, 0)
+        for index in range(len(self._slots), used):
+            key = self._mm[_offset(index) + KEY_OFFSET : _offset(index + 1)]
+            self._slots[key.rstrip(b"\0").decode("utf-8")] = index
+
+    def keys(self):
+        self._refresh()
+        return list(self._slots)
+
+    def get(self, key):
+        """(value, time) of the key, None if unknown. Raises WriterStuck if
+        the slot is never consistent"""
+        if key not in self._slots:
+            self._refresh()
+        index = self._slots.get(key)
+        return None if index is None else self._read(index)
+
+    def items(self):
+        """Dict of key -> (value, time), see get"""
+        self._refresh()
+        return {key: self._read(index) for key, index in self._slots.items()}
+
+    def _read(self, index):
+        offset = _offset(index)
+        attempts = 0
+        backoff = BACKOFF
+        deadline = None
+        while True:
+            (sequence,) = SEQUENCE.unpack_from(self._mm, offset)
+            if not sequence & 1:
+                timestamp, value = VALUE.unpack_from(self._mm, offset + 8)
+                if SEQUENCE.unpack_from(self._mm, offset)[0] == sequence:
+                    return value, timestamp
+            attempts += 1
+            if attempts < RETRIES:
+                sleep(0)
+                continue
+            # e.g. a writer thread waiting for the interpreter lock
+            now = monotonic()
+            if deadline is None:
+                deadline = now + STUCK
+            elif now > deadline:
+                raise WriterStuck(f"Slot {index} of {self.filename}")
+            sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+if __name__ == "__main__":
+    from datetime import datetime
+    from sys import argv
+
+    if len(argv) > 2:
+        raise SystemExit("Usage: python3 -m tellsticknet.table [<file>]")
+    with Reader(argv[1] if len(argv) == 2 else FILENAME) as reader:
+        for key, (value, timestamp) in sorted(reader.items().items()):
+            print(
+                datetime.fromtimestamp(timestamp).replace(microsecond=0),
+                key,
+                value,
+            )
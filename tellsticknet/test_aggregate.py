@@ -0,0 +1,67 @@
+import asyncio
+import random
+
+from . import emulator, testing
+from .aggregate import Aggregate, aggregated
+from .protocol import decode_event
+
+INTERVAL = 60
+
+
+class TimedSource(testing.PacketSource):
+    """Controller receiving a packet every 7 seconds"""
+
+    async def datagrams(self):
+        for i, packet in enumerate(self._packets):
+            yield packet, 1000.0 + 7 * i
+            await asyncio.sleep(0)
+
+
+def _aggregate(packets, replace=True):
+    async def main():
+        events = TimedSource(packets).events()
+        return [e async for e in aggregated(events, INTERVAL, replace)]
+
+    return asyncio.run(main())
+
+
+def test_windows():
+    devices = emulator.population(3, 1, random.Random(1))
+    packets = list(testing.packets(devices, 300, random.Random(1)))
+    expected = {}
+    commands = 0
+    for i, packet in enumerate(packets):
+        event = decode_event(packet)
+        if not event.data:
+            commands += 1
+            continue
+        start = (1000 + 7 * i) // INTERVAL * INTERVAL
+        key = event.protocol, event.model, event.sensorId, start
+        for quantity, value in event.data:
+            expected.setdefault(key + (quantity,), []).append(value)
+
+    events = _aggregate(packets)
+    aggregates = [e for e in events if isinstance(e, Aggregate)]
+    assert len(events) - len(aggregates) == commands
+    assert all(a.timestamp - a.start == INTERVAL for a in aggregates)
+    found = {}
+    for a in aggregates:
+        key = a.protocol, a.model, a.sensorId, a.start
+        for quantity, mean in a.data:
+            found[key + (quantity,)] = (mean, a.stats[quantity])
+    assert set(found) == set(expected)
+    for key, values in expected.items():
+        mean, stats = found[key]
+        assert stats == dict(
+            min=min(values), max=max(values), count=len(values)
+        )
+        assert abs(mean - sum(values) / len(values)) < 0.01
+
+
+def test_with_raw():
+    devices = emulator.population(2, 0, random.Random(2))
+    packets = list(testing.packets(devices, 100, random.Random(2)))
+    events = _aggregate(packets, replace=False)
+    raw = [e for e in events if not isinstance(e, Aggregate)]
+    assert len(raw) == len(packets)
+    assert not any(e.replaces for e in events if isinstance(e, Aggregate))
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import random
+import struct
+from base64 import b64encode
+
+from . import emulator, httpd, metrics, testing
+from .api import Api, Client
+from .protocol import decode_event
+
+POPULATION = emulator.population(3, 2, random.Random(1))
+
+
+async def _serve(api):
+    server = await api.serve("127.0.0.1:0")
+    return server.sockets[0].getsockname()[:2]
+
+
+async def _request(address, method, path, body=b""):
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(
+        b"%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+        % (method.encode(), path.encode(), len(body), body)
+    )
+    head = await reader.readuntil(b"\r\n\r\n")
+    body = await reader.read()
+    writer.close()
+    return int(head.split()[1]), body
+
+
+async def _websocket(address, path):
+    reader, writer = await asyncio.open_connection(*address)
+    key = b64encode(b"0123456789abcdef").decode()
+    writer.write(
+        (
+            f"GET {path} HTTP/1.1\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n\r\n"
+        ).encode()
+    )
+    head = await reader.readuntil(b"\r\n\r\n")
+    assert httpd.accept_key(key).encode() in head
+    return reader, writer
+
+
+async def _message(reader):
+    head = await reader.readexactly(2)
+    assert head[0] & 0x0F == httpd.TEXT
+    length = head[1]
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), "big")
+    return json.loads(await reader.readexactly(length))
+
+
+def test_state_and_command():
+    config = testing.config(POPULATION, component="switch")
+    packets = list(testing.packets(POPULATION, 100, random.Random(1)))
+
+    async def main():
+        api = Api(config)
+        address = await _serve(api)
+        controller = testing.PacketSource(packets, api=api)
+        events = [e async for e in controller.events() if e]
+        status, state = await _request(address, "GET", "/state")
+        assert status == 200
+        name = next(e["name"] for e in config if e.get("unit"))
+        status, _ = await _request(
+            address,
+            "POST",
+            "/command",
+            json.dumps(dict(name=name, method="turnoff")).encode(),
+        )
+        assert status == 202
+        status, _ = await _request(
+            address, "POST", "/command", b'{"name": "Nowhere"}'
+        )
+        assert status == 400
+        return events, json.loads(state), list(controller.executed)
+
+    events, state, executed = asyncio.run(main())
+    last = {}
+    for event in events:
+        if event.data:
+            key = event.protocol, event.model, event.sensorId
+            last.setdefault(key, {}).update(
+                {q.value: v for q, v in event.data}
+            )
+    sensors = {
+        entity["name"]: (
+            entity["protocol"],
+            entity["model"],
+            entity["sensorId"],
+        )
+        for entity in config
+        if "sensorId" in entity
+    }
+    assert {
+        name: entry["data"] for name, entry in state.items() if "data" in entry
+    } == {name: last[key] for name, key in sensors.items() if key in last}
+    ((device, method, param),) = executed
+    assert method == 2 and device["unit"]
+
+
+def test_events():
+    packets = list(testing.packets(POPULATION, 50, random.Random(2)))
+    sensor_id = decode_event(
+        next(p for p in packets if decode_event(p).sensorId)
+    ).sensorId
+
+    async def main():
+        api = Api()
+        address = await _serve(api)
+        # the writers are kept, the connections are closed with them
+        everything, writer = await _websocket(address, "/events")
+        filtered, other = await _websocket(
+            address, f"/events?sensorId={sensor_id}"
+        )
+        while len(api.clients) < 2:
+            await asyncio.sleep(0.01)
+        controller = testing.PacketSource(packets, api=api)
+        events = [e async for e in controller.events() if e]
+        accepted = [e for e in events if e.sensorId == sensor_id]
+        return (
+            events,
+            [await _message(everything) for _ in events],
+            [await _message(filtered) for _ in accepted],
+        )
+
+    collectors = list(metrics.COLLECTORS)
+    events, everything, filtered = asyncio.run(main())
+    assert metrics.COLLECTORS == collectors
+    assert everything == [json.loads(json.dumps(e.as_dict())) for e in events]
+    assert filtered == [
+        e for e in everything if e.get("sensorId") == sensor_id
+    ]
+
+
+def test_slow_client():
+    """A client not keeping up loses the oldest events, the others get
+    all of them"""
+    packets = list(testing.packets(POPULATION, 200, random.Random(3)))
+
+    async def main():
+        api = Api(queue_size=10)
+        address = await _serve(api)
+        # as if its connection would never drain
+        stalled = Client(None, api.queue_size)
+        api.clients.add(stalled)
+        reader, writer = await _websocket(address, "/events")
+        while len(api.clients) < 2:
+            await asyncio.sleep(0.01)
+        controller = testing.PacketSource(packets, api=api)
+        received = []
+        async for event in controller.events():
+            if event:
+                received.append(event)
+                # at the pace the client keeps up with
+                await asyncio.sleep(0.001)
+        messages = [await _message(reader) for _ in received]
+        return received, messages, stalled, api.stats
+
+    received, messages, stalled, stats = asyncio.run(main())
+    assert len(messages) == len(received) == stats["events"]
+    assert stalled.queue.qsize() == 10
+    assert stalled.dropped == stats["dropped"] == len(received) - 10
+
+
+def test_unmasked_frame():
+    """A client frame without mask is a protocol error"""
+
+    async def main():
+        api = Api()
+        address = await _serve(api)
+        reader, writer = await _websocket(address, "/events")
+        writer.write(bytes([0x80 | httpd.TEXT, 2]) + b"hi")
+        head = await reader.readexactly(2)
+        return head, await reader.readexactly(head[1])
+
+    head, payload = asyncio.run(asyncio.wait_for(main(), 5))
+    assert head[0] & 0x0F == httpd.CLOSE
+    assert payload == struct.pack("!H", httpd.PROTOCOL_ERROR)
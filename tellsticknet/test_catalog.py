@@ -0,0 +1,63 @@
+import asyncio
+import random
+from collections import Counter
+from functools import partial
+
+from . import emulator, metrics, testing
+from .catalog import Catalog, read
+from .protocol import decode_event, encode_packet
+
+
+def test_lru():
+    catalog = Catalog(capacity=2, log=False)
+    for sensor in (1, 2, 1, 3):
+        catalog.add(
+            decode_event(
+                encode_packet(
+                    "RawData", **emulator.fineoffset(sensor, 20.0, 40)
+                )
+            )
+        )
+    # 2 was heard from the longest time ago
+    assert [(e["sensorId"], e["count"]) for e in catalog.dump()] == [
+        (1, 2),
+        (3, 1),
+    ]
+
+
+def test_gateway(tmp_path):
+    from .mqtt import run
+
+    devices = emulator.population(6, 0, random.Random(3))
+    configured, neighbours = devices[:3], devices[3:]
+    packets = list(testing.packets(devices, 200, random.Random(3)))
+    expected = Counter()
+    for packet in packets:
+        event = decode_event(packet)
+        expected[event.protocol, event.model, event.sensorId] += 1
+    for entity in testing.config(configured):
+        del expected[entity["protocol"], entity["model"], entity["sensorId"]]
+    assert expected and len(expected) == len(neighbours)
+
+    broker = testing.Broker()
+    filename = str(tmp_path / "unknown.json")
+
+    async def main():
+        async def discover():
+            return testing.PacketSource(packets)
+
+        await run(
+            discover,
+            testing.config(configured),
+            client_factory=partial(testing.MQTTClient, broker=broker),
+            catalog=filename,
+        )
+
+    collectors = list(metrics.COLLECTORS)
+    asyncio.run(main())
+    assert metrics.COLLECTORS == collectors
+    found = {
+        (e["protocol"], e["model"], e["sensorId"]): e["count"]
+        for e in read(filename)
+    }
+    assert found == expected
@@ -0,0 +1,107 @@
+import os
+from os.path import dirname, join
+
+import pytest
+
+from . import config
+from .config import Config, read_config
+
+SAMPLE = join(dirname(dirname(__file__)), "tellsticknet-sample.conf")
+
+DOOR = (
+    "name: Door\nprotocol: arctech\nmodel: selflearning\nhouse: 1\nunit: 2\n"
+)
+
+
+@pytest.fixture
+def files(tmp_path):
+    filename = tmp_path / "tellsticknet.conf"
+    filename.write_text(DOOR)
+    return str(filename), str(tmp_path / "config.pickle")
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """Count the files parsed as YAML"""
+    count = []
+    load = config.load
+
+    def counting(data):
+        count.append(data)
+        return load(data)
+
+    monkeypatch.setattr(config, "load", counting)
+    return count
+
+
+def test_sample():
+    entities = read_config(SAMPLE, cache=None)
+    assert len(entities) == len(entities.compiled) > 0
+    kitchen = {
+        e["component"]: c
+        for e, c in zip(entities, entities.compiled)
+        if e["name"] == "Kitchen"
+    }
+    assert kitchen["light"].frames and kitchen["switch"].frames
+    assert not kitchen["binary_sensor"].frames
+
+
+def test_cached(files, parsed):
+    filename, cache = files
+    first = read_config(filename, cache)
+    second = read_config(filename, cache)
+    assert len(parsed) == 1
+    assert first == second
+    assert first.compiled == second.compiled
+
+
+def test_modified(files, parsed):
+    filename, cache = files
+    read_config(filename, cache)
+    with open(filename, "a") as f:
+        f.write("---\nname: Window\nprotocol: arctech\n")
+    assert [e["name"] for e in read_config(filename, cache)] == [
+        "Door",
+        "Window",
+    ]
+    assert len(parsed) == 2
+
+
+def test_touched(files, parsed):
+    filename, cache = files
+    read_config(filename, cache)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    read_config(filename, cache)
+    assert len(parsed) == 2
+
+
+@pytest.mark.parametrize(
+    "garbage",
+    [
+        b"garbage",
+        # unsupported protocol, ValueError
+        b"\x80\x09",
+        # int(1, 2, 3), TypeError
+        b"cbuiltins\nint\n(I1\nI2\nI3\ntR.",
+    ],
+)
+def test_corrupt_cache(files, parsed, garbage):
+    filename, cache = files
+    with open(cache, "wb") as f:
+        f.write(garbage)
+    assert [e["name"] for e in read_config(filename, cache)] == ["Door"]
+    assert [e["name"] for e in read_config(filename, cache)] == ["Door"]
+    assert len(parsed) == 1
+
+
+def test_unknown_protocol():
+    """Commands of protocols that can not be encoded are sent without
+    precompiled frames"""
+    blinds = dict(name="Blinds", component="switch", protocol="hasta")
+    assert Config([dict(blinds, house=1)]).compiled[0].frames == {}
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Config([dict(protocol="arctech")])
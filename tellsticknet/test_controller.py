@@ -0,0 +1,57 @@
+import asyncio
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from . import emulator, monitor, protocol, testing
+
+
+def test_processes():
+    """The decoder counters are kept in the parent process"""
+    packets = list(
+        testing.packets(emulator.population(6, 3), 50, random.Random(1))
+    )
+    decodes = sum(protocol.DECODES.values())
+    stats = sum(protocol.STATS.values())
+    monitor.HISTOGRAMS.clear()
+
+    async def main():
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            source = testing.PacketSource(packets, executor=executor)
+            return [e async for e in source.events()]
+
+    events = asyncio.run(main())
+    assert len(events) == len(packets)
+    assert sum(protocol.DECODES.values()) - decodes == len(packets)
+    # firmware or python decoded sensor readings
+    sensors = sum(e.is_sensor for e in events)
+    assert sum(protocol.STATS.values()) - stats == sensors > 0
+    assert monitor.histogram("decode").count == len(packets)
+
+
+class FailingSource(testing.PacketSource):
+    """Controller losing its socket after the packets"""
+
+    async def datagrams(self):
+        async for datagram in super().datagrams():
+            yield datagram
+        raise OSError("Network is down")
+
+
+def test_receiver_error():
+    """An error receiving is raised to the consumer of the pool"""
+    packets = list(
+        testing.packets(emulator.population(3, 0), 10, random.Random(1))
+    )
+    events = []
+
+    async def main():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source = FailingSource(packets, executor=executor)
+            async for event in source.events():
+                events.append(event)
+
+    with pytest.raises(OSError, match="Network is down"):
+        asyncio.run(asyncio.wait_for(main(), 5))
+    assert len(events) == len(packets)
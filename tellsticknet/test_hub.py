@@ -0,0 +1,118 @@
+import asyncio
+import random
+import socket
+
+from . import emulator, hub, testing
+from .hub import Hub, attach
+
+
+class QueueSource(testing.PacketSource):
+    """Controller yielding the packets put in the queue"""
+
+    def __init__(self, **options):
+        super().__init__([], **options)
+        self.queue = asyncio.Queue()
+
+    async def datagrams(self):
+        while True:
+            packet = await self.queue.get()
+            self.stats["datagrams"] += 1
+            yield packet, 1000.0
+
+
+def _packets(count):
+    devices = emulator.population(3, 2)
+    return list(testing.packets(devices, count, random.Random(1)))
+
+
+async def _started(path, buffer=hub.BUFFER):
+    source = QueueSource()
+    relay = Hub(source, path, buffer)
+    task = asyncio.get_event_loop().create_task(relay.run())
+    await asyncio.sleep(0.01)
+    return source, relay, task
+
+
+async def _subscribed(relay, subscriptions, subscribers):
+    while (
+        relay.stats["subscribed"] < subscriptions
+        or len(relay.subscribers) != subscribers
+    ):
+        await asyncio.sleep(0.01)
+
+
+def test_fan_out(tmp_path):
+    path = str(tmp_path / "hub.sock")
+    packets = _packets(50)
+
+    async def receive(controller):
+        return [
+            datagram
+            async for datagram, _ in _limited(controller, len(packets))
+        ]
+
+    async def main():
+        source, relay, task = await _started(path)
+        first = await attach(path)
+        second = await attach(path)
+        assert first.ip_address == source.ip_address
+        receivers = [
+            asyncio.get_event_loop().create_task(receive(c))
+            for c in (first, second)
+        ]
+        # both attached, and subscribed again when listening
+        await _subscribed(relay, 4, 2)
+        for packet in packets:
+            source.queue.put_nowait(packet)
+        received = await asyncio.wait_for(asyncio.gather(*receivers), 5)
+        task.cancel()
+        return received, relay
+
+    received, relay = asyncio.run(main())
+    assert received == [packets, packets]
+    assert relay.stats["relayed"] == len(packets)
+    assert not relay.stats["dropped"]
+
+
+async def _limited(controller, count):
+    datagrams = controller.datagrams()
+    async for datagram in datagrams:
+        yield datagram
+        count -= 1
+        if not count:
+            await datagrams.aclose()
+            return
+
+
+def test_stalled_subscriber(tmp_path):
+    """A subscriber not reading loses the oldest datagrams, without
+    holding back the others"""
+    path = str(tmp_path / "hub.sock")
+    packets = _packets(2000)
+
+    async def main():
+        source, relay, task = await _started(path, buffer=10)
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stalled.bind("")
+        stalled.sendto(hub.SUBSCRIBE, path)
+        controller = await attach(path)
+        receiver = asyncio.get_event_loop().create_task(
+            _collect(controller, len(packets))
+        )
+        await _subscribed(relay, 3, 2)
+        for packet in packets:
+            source.queue.put_nowait(packet)
+            # at the pace the receiver keeps up with
+            await asyncio.sleep(0)
+        received = await asyncio.wait_for(receiver, 5)
+        task.cancel()
+        stalled.close()
+        return received, relay
+
+    received, relay = asyncio.run(main())
+    assert received == packets
+    assert relay.stats["dropped"] > 0
+
+
+async def _collect(controller, count):
+    return [datagram async for datagram, _ in _limited(controller, count)]
@@ -0,0 +1,91 @@
+import asyncio
+import random
+from functools import partial
+
+from . import metrics, testing
+from .emulator import fineoffset
+from .outliers import OutlierFilter, filtered
+from .protocol import decode_event, encode_packet
+
+ENTITY = dict(
+    name="Freezer",
+    protocol="fineoffset",
+    model="temperaturehumidity",
+    sensorId=135,
+)
+
+# position -> garbage temperature and humidity
+GLITCHES = {10: (-204.0, 40), 20: (5.0, 127), 30: (-10.0, 40)}
+
+
+def _readings(count=50, rng=random.Random(1)):
+    """Packets of a freezer, with the glitches"""
+    temp = -20.0
+    for i in range(count):
+        temp = round(temp + rng.gauss(0, 0.2), 1)
+        values = GLITCHES.get(i, (temp, 40))
+        yield encode_packet("RawData", **fineoffset(135, *values)).decode()
+
+
+def test_glitches():
+    outliers = OutlierFilter(
+        [dict(ENTITY, limits=dict(temp=dict(max=0, delta=1)))]
+    )
+
+    async def main():
+        events = testing.PacketSource(list(_readings())).events()
+        return [e async for e in filtered(events, outliers) if e]
+
+    events = asyncio.run(main())
+    temps = [e.value("temp") for e in events]
+    humidities = [e.value("humidity") for e in events]
+    assert len(events) == 49
+    assert -204.0 not in temps and 127 not in humidities
+    # above the max of the freezer, and a spike
+    assert 5.0 not in temps and -10.0 not in temps
+    assert sorted(outliers.stats.items()) == [
+        (("humidity", "range"), 1),
+        (("temp", "range"), 2),
+        (("temp", "spike"), 1),
+    ]
+
+
+def test_capacity():
+    """The history of the sensors not heard from for the longest is
+    dropped, e.g. of neighbours changing ids with new batteries"""
+    outliers = OutlierFilter(capacity=10)
+    for sensor in range(256):
+        for temp in (20.0, 20.1, 20.2):
+            event = decode_event(
+                encode_packet("RawData", **fineoffset(sensor, temp, 40))
+            )
+            assert outliers.check(event)
+    # temperature and humidity of the last five sensors
+    assert len(outliers._history) == 10
+
+
+def test_diagnostics():
+    from .mqtt import run
+
+    broker = testing.Broker()
+    packets = list(_readings())
+
+    async def main():
+        async def discover():
+            return testing.PacketSource(packets)
+
+        await run(
+            discover,
+            [ENTITY],
+            client_factory=partial(testing.MQTTClient, broker=broker),
+            outliers=True,
+            diagnostics=True,
+        )
+
+    collectors = list(metrics.COLLECTORS)
+    asyncio.run(main())
+    assert metrics.COLLECTORS == collectors
+    (diagnostics,) = [t for t in broker.published if "diagnostics" in t]
+    assert broker.published[diagnostics] == 4
+    (temps,) = [t for t in broker.published if "temperature/state" in t]
+    assert broker.published[temps] == len(packets) - 3
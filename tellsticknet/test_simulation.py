@@ -0,0 +1,336 @@
+import asyncio
+from functools import partial
+
+from . import controller, discovery, emulator
+from .controller import COMMAND_REPEAT_DELAY, REGISTRATION_INTERVAL
+from .discovery import DISCOVERY_TIMEOUT
+from .testing import Broker, MQTTClient, Network, config, run_virtual
+
+HOST = "127.0.0.1"
+DAY = 24 * 3600
+
+
+def _simulate(main, **network):
+    network = Network(**network)
+    with network.patch(HOST, controller, discovery, emulator):
+        return run_virtual(main(network))
+
+
+async def _start(device):
+    task = asyncio.ensure_future(device.run())
+    await asyncio.sleep(0.5)
+    return task
+
+
+def test_virtual_clock():
+    async def main(network):
+        loop = asyncio.get_event_loop()
+        await asyncio.sleep(DAY)
+        return loop.time()
+
+    assert _simulate(main) == DAY
+
+
+def test_discovery_timeout():
+    async def main(network):
+        loop = asyncio.get_event_loop()
+        found = [c async for c in discovery.discover(discover_all=True)]
+        return found, loop.time()
+
+    assert _simulate(main) == ([], DISCOVERY_TIMEOUT.total_seconds())
+
+
+def test_discover_emulator(monkeypatch):
+    monkeypatch.setattr(discovery, "update_cache", lambda *args: None)
+
+    async def main(network):
+        device = emulator.Emulator()
+        task = await _start(device)
+        found = await controller.discover(discover_all=True)
+        found = [c async for c in found]
+        task.cancel()
+        return found
+
+    (found,) = _simulate(main)
+    assert found.ip_address == emulator.ADDRESS
+    assert found.mac_address == emulator.MAC.lower()
+
+
+def test_registration_and_stream():
+    """A day of packets every ten seconds, with the listener registered
+    again at every registration interval"""
+
+    async def main(network):
+        device = emulator.Emulator(rate=0.1, seed=1)
+        task = await _start(device)
+        listener = controller.Controller(emulator.ADDRESS, emulator.MAC)
+        events = 0
+        async for event in listener.events():
+            if asyncio.get_event_loop().time() > DAY + 0.5:
+                break
+            events += 1
+        task.cancel()
+        return events, device.stats
+
+    events, stats = _simulate(main, latency=0.001)
+    registrations = DAY // REGISTRATION_INTERVAL.total_seconds() + 1
+    assert stats["registrations"] == registrations
+    # the first packet is sent one interval after registering
+    assert events == DAY // 10
+    assert stats["packets"] == DAY // 10 + 1
+    assert not stats["errors"]
+
+
+def test_command_repeat():
+    async def main(network):
+        device = emulator.Emulator(sensors=0, remotes=0)
+        task = await _start(device)
+        listener = controller.Controller(emulator.ADDRESS, emulator.MAC)
+        loop = asyncio.get_event_loop()
+        then = loop.time()
+        await listener.execute(
+            dict(
+                protocol="arctech",
+                model="selflearning",
+                house=1329110,
+                unit=1,
+            ),
+            method=1,
+            repeat=3,
+        )
+        elapsed = loop.time() - then
+        await asyncio.sleep(1)
+        task.cancel()
+        return elapsed, device.stats
+
+    elapsed, stats = _simulate(main)
+    assert stats["commands"] == 3
+    assert elapsed == 2 * COMMAND_REPEAT_DELAY.total_seconds()
+
+
+def test_gateway():
+    """An hour of traffic through the MQTT gateway"""
+    from .mqtt import run
+
+    broker = Broker()
+
+    async def main(network):
+        device = emulator.Emulator(sensors=6, remotes=0, rate=1, seed=1)
+        task = await _start(device)
+
+        async def discover():
+            return controller.Controller(emulator.ADDRESS, emulator.MAC)
+
+        gateway = asyncio.ensure_future(
+            run(
+                discover,
+                config(emulator.population(6, 0)),
+                client_factory=partial(MQTTClient, broker=broker),
+            )
+        )
+        await asyncio.sleep(3600)
+        gateway.cancel()
+        task.cancel()
+
+    _simulate(main)
+    states = [t for t in broker.published if t.endswith("/state")]
+    # temperature and humidity of each sensor
+    assert len(states) == 12
+
+
+def test_reload():
+    """Only the changed entities are created, replaced or removed"""
+    from .mqtt import run
+
+    broker = Broker()
+    entities = config(emulator.population(0, 1), component="switch")
+    updated = [entities[1], dict(entities[2], icon="mdi:lamp"), entities[3]]
+
+    async def main(network):
+        # created in the running loop
+        updates = asyncio.Queue()
+
+        async def reloaded():
+            while True:
+                yield await updates.get()
+
+        device = emulator.Emulator(sensors=0, remotes=0)
+        task = await _start(device)
+
+        async def discover():
+            return controller.Controller(emulator.ADDRESS, emulator.MAC)
+
+        gateway = asyncio.ensure_future(
+            run(
+                discover,
+                entities[:3],
+                client_factory=partial(MQTTClient, broker=broker),
+                updates=reloaded(),
+            )
+        )
+        await asyncio.sleep(10)
+        updates.put_nowait(updated)
+        await asyncio.sleep(10)
+        gateway.cancel()
+        task.cancel()
+        (client,) = broker._clients
+        return client.subscriptions
+
+    subscriptions = _simulate(main)
+
+    def topics(name, suffix):
+        name = name.replace(" ", "_")
+        return [
+            t for t in broker.published if name in t and t.endswith(suffix)
+        ]
+
+    (removed,) = topics("arctech_1_1", "/config")
+    assert removed not in broker.retained
+    assert not [t for t in subscriptions if "arctech_1_1" in t]
+    # unchanged
+    (unchanged,) = topics("arctech_1_2", "/config")
+    assert broker.published[unchanged] == 1
+    # replaced, published again on the same topic without being cleared
+    (replaced,) = topics("arctech_1_3", "/config")
+    assert broker.published[replaced] == 2
+    assert b"mdi:lamp" in broker.retained[replaced]
+    # created
+    (created,) = topics("arctech_1_4", "/config")
+    assert created in broker.retained
+    assert len(subscriptions) == 3
+
+
+def test_reload_sensor():
+    """The discovery of a changed sensor is not cleared"""
+    from .mqtt import run
+
+    broker = Broker()
+    (entity,) = config(emulator.population(1, 0))
+    # the same name as another component
+    door = dict(
+        name=entity["name"],
+        component="binary_sensor",
+        protocol="arctech",
+        model="selflearning",
+        house=1,
+        unit=1,
+    )
+
+    async def main(network):
+        # created in the running loop
+        updates = asyncio.Queue()
+
+        async def reloaded():
+            while True:
+                yield await updates.get()
+
+        device = emulator.Emulator(sensors=1, remotes=0, rate=0.1, seed=1)
+        task = await _start(device)
+
+        async def discover():
+            return controller.Controller(emulator.ADDRESS, emulator.MAC)
+
+        gateway = asyncio.ensure_future(
+            run(
+                discover,
+                [entity, door],
+                client_factory=partial(MQTTClient, broker=broker),
+                updates=reloaded(),
+            )
+        )
+        await asyncio.sleep(60)
+        task.cancel()
+        configs = [t for t in broker.published if t.endswith("/config")]
+        before = [broker.published[t] for t in configs]
+        updates.put_nowait(
+            [
+                dict(entity, limits=dict(temp=dict(max=40))),
+                dict(door, icon="mdi:door"),
+            ]
+        )
+        await asyncio.sleep(10)
+        gateway.cancel()
+        return configs, before
+
+    configs, before = _simulate(main)
+    # temperature and humidity, published again without being cleared
+    assert len(configs) == 2
+    assert [broker.published[t] for t in configs] == [n + 1 for n in before]
+    assert all(t in broker.retained for t in configs)
+
+
+def test_warm_start(tmp_path):
+    """The states of the last run are republished when starting"""
+    from .mqtt import run
+
+    snapshot = str(tmp_path / "state.json")
+    entities = config(emulator.population(2, 1))
+
+    def gateway(broker, **options):
+        async def main(network):
+            device = emulator.Emulator(seed=1, **options)
+            task = await _start(device)
+
+            async def discover():
+                return controller.Controller(emulator.ADDRESS, emulator.MAC)
+
+            gateway = asyncio.ensure_future(
+                run(
+                    discover,
+                    entities,
+                    client_factory=partial(MQTTClient, broker=broker),
+                    snapshot=snapshot,
+                )
+            )
+            await asyncio.sleep(600)
+            gateway.cancel()
+            task.cancel()
+
+        _simulate(main)
+        return {t for t in broker.published if t.endswith("/state")}
+
+    before = gateway(Broker(), sensors=2, remotes=1, rate=1)
+    assert before
+    # nothing is received after the restart
+    after = gateway(Broker(), sensors=0, remotes=0)
+    assert after == before
+
+
+def test_aggregating_gateway():
+    """The gateway publishes one state per sensor and minute"""
+    from .mqtt import run
+
+    broker = Broker()
+
+    async def main(network):
+        device = emulator.Emulator(sensors=2, remotes=0, rate=1, seed=1)
+        task = await _start(device)
+
+        async def discover():
+            return controller.Controller(emulator.ADDRESS, emulator.MAC)
+
+        gateway = asyncio.ensure_future(
+            run(
+                discover,
+                config(emulator.population(2, 0)),
+                client_factory=partial(MQTTClient, broker=broker),
+                aggregate=60,
+            )
+        )
+        await asyncio.sleep(3600)
+        gateway.cancel()
+        task.cancel()
+
+    _simulate(main)
+    states = [t for t in broker.published if t.endswith("/state")]
+    assert len(states) == 4
+    for topic in states:
+        # a minute may be missing at the start and the end
+        assert 58 <= broker.published[topic] <= 60
+        aggregate = topic.replace("/state", "/aggregate")
+        assert broker.published[aggregate] == broker.published[topic]
+    assert all(
+        b"json_attributes_topic" in payload
+        for topic, payload in broker.retained.items()
+        if topic.endswith("/config")
+    )
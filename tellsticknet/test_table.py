@@ -0,0 +1,67 @@
+import asyncio
+import random
+import threading
+
+import pytest
+
+from . import emulator, table as table_module, testing
+from .table import SEQUENCE, Reader, Table, WriterStuck, event_values
+
+
+def test_consistent_reads(tmp_path):
+    """Readers never see the value of one write with the time of another"""
+    filename = str(tmp_path / "table")
+    done = threading.Event()
+
+    with Table(filename) as table:
+        table.set("key", 0, 1)
+
+        def write():
+            for i in range(1, 200000):
+                table.set("key", i, i + 1)
+            done.set()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        reads = 0
+        with Reader(filename) as reader:
+            while not done.is_set():
+                value, timestamp = reader.get("key")
+                assert timestamp == value + 1
+                reads += 1
+        writer.join()
+    assert reads
+
+
+def test_stuck_writer(tmp_path, monkeypatch):
+    """A slot left half written is an error, not an unknown key"""
+    monkeypatch.setattr(table_module, "STUCK", 0.01)
+    filename = str(tmp_path / "table")
+    with Table(filename) as table:
+        table.set("key", 1, 2)
+        # as if the writer died while writing
+        SEQUENCE.pack_into(table._mm, table_module._offset(0), 3)
+        with Reader(filename) as reader:
+            assert reader.get("unknown") is None
+            with pytest.raises(WriterStuck):
+                reader.get("key")
+
+
+def test_controller(tmp_path):
+    filename = str(tmp_path / "table")
+    devices = emulator.population(3, 2)
+    rng = random.Random(1)
+    packets = list(testing.packets(devices, 100, rng))
+
+    async def main():
+        with Table(filename) as table:
+            controller = testing.PacketSource(packets, table=table)
+            return [e async for e in controller.events() if e]
+
+    events = asyncio.run(main())
+    expected = {}
+    for event in events:
+        for key, value in event_values(event):
+            expected[key] = (value, event.timestamp)
+    with Reader(filename) as reader:
+        assert reader.items() == expected
@@ -0,0 +1,443 @@
+"""
+stand-ins for the controller and the MQTT broker, for benchmarks, soak
+tests and simulations running without network or hardware
+"""
+
+import asyncio
+import logging
+import random
+import selectors
+import socket
+from collections import Counter, deque
+from contextlib import contextmanager
+import itertools
+from time import time
+from types import SimpleNamespace
+
+from .controller import Controller
+from .emulator import Remote
+from .protocol import decode_event, encode_packet
+from .util import DROPS, SO_RXQ_OVFL, SO_TIMESTAMPNS, TIMESPECS
+
+_LOGGER = logging.getLogger(__name__)
+
+MAC = "ACCA54000001"
+
+
+def packets(devices, count, rng=random):
+    """
+    Generate count RawData packets from randomly chosen simulated devices
+
+    >>> from .protocol import decode_packet
+    >>> from .emulator import population
+    >>> all(decode_packet(p) for p in packets(population(3, 3), 100))
+    True
+    """
+    for _ in range(count):
+        device = rng.choice(devices)
+        yield encode_packet("RawData", **device.frame()).decode("ascii")
+
+
+def config(devices, component="binary_sensor"):
+    """
+    Entities for the MQTT gateway, matching the simulated devices,
+    with the remotes as the given component
+
+    >>> from .emulator import population
+    >>> [e["name"] for e in config(population(1, 1))]
+    ['fineoffset 0', 'arctech 1 1', 'arctech 1 2', 'arctech 1 3', \
+'arctech 1 4']
+    """
+    entities = []
+    for device in devices:
+        if isinstance(device, Remote):
+            for unit in device.UNITS:
+                event = decode_event(
+                    encode_packet("RawData", **device.frame(unit, "turnon"))
+                )
+                entities.append(
+                    dict(
+                        name=f"{event.protocol} {event.house} {event.unit}",
+                        component=component,
+                        protocol=event.protocol,
+                        model=event.model,
+                        house=event.house,
+                        unit=event.unit,
+                    )
+                )
+        else:
+            event = decode_event(encode_packet("RawData", **device.frame()))
+            entities.append(
+                dict(
+                    name=f"{event.protocol} {event.sensorId}",
+                    protocol=event.protocol,
+                    model=event.model,
+                    sensorId=event.sensorId,
+                )
+            )
+    return entities
+
+
+class PacketSource(Controller):
+    """Controller yielding the given packets instead of receiving them,
+    the last commands are recorded in executed
+
+    The events are not decoded until a field is accessed
+
+    >>> from .emulator import population
+    >>> source = PacketSource(list(packets(population(3, 0), 20)))
+    >>> async def decoded():
+    ...     events = [e async for e in source.events()]
+    ...     return sum(e.raw is None for e in events)
+    >>> asyncio.run(decoded())
+    0
+    """
+
+    def __init__(self, packets, ip="127.0.0.1", mac=MAC, **options):
+        super().__init__(ip, mac, **options)
+        self._packets = packets
+        self.executed = deque(maxlen=100)
+
+    async def datagrams(self):
+        for packet in self._packets:
+            self.stats["datagrams"] += 1
+            yield packet, time()
+            # let the consumers run
+            await asyncio.sleep(0)
+
+    async def _execute(self, device, method, param, frame=None):
+        self.executed.append((device, method, param))
+
+
+class Broker:
+    """In-process stand-in for an MQTT broker"""
+
+    def __init__(self):
+        self.retained = {}
+        # messages published per topic
+        self.published = Counter()
+        self._clients = []
+
+    def deliver(self, topic, payload):
+        """Publish to the clients subscribed to the topic"""
+        for client in self._clients:
+            if topic in client.subscriptions:
+                client.messages.put_nowait(
+                    SimpleNamespace(
+                        publish_packet=SimpleNamespace(
+                            variable_header=SimpleNamespace(topic_name=topic),
+                            payload=SimpleNamespace(
+                                data=payload.encode("utf-8")
+                            ),
+                        )
+                    )
+                )
+
+
+class MQTTClient:
+    """Stand-in for hbmqtt.client.MQTTClient, connected to a Broker"""
+
+    def __init__(self, client_id=None, broker=None):
+        self.client_id = client_id
+        self.broker = broker or Broker()
+        self.subscriptions = set()
+        self.messages = asyncio.Queue()
+        self._connected_state = asyncio.Event()
+
+    async def connect(self, uri=None, cleansession=None):
+        self.broker._clients.append(self)
+        self._connected_state.set()
+
+    async def disconnect(self):
+        self.broker._clients.remove(self)
+        self._connected_state.clear()
+
+    async def publish(self, topic, message, qos=None, retain=False):
+        self.broker.published[topic] += 1
+        if retain and message:
+            self.broker.retained[topic] = message
+        elif retain:
+            self.broker.retained.pop(topic, None)
+        self.broker.deliver(topic, message.decode("utf-8"))
+
+    async def subscribe(self, topics):
+        self.subscriptions.update(topic for topic, _ in topics)
+
+    async def unsubscribe(self, topics):
+        self.subscriptions.difference_update(topics)
+
+    async def deliver_message(self, timeout=None):
+        return await asyncio.wait_for(self.messages.get(), timeout)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop with a virtual clock, jumping ahead to the next timer
+    instead of waiting for it. Sockets of a fake Network are polled by the
+    loop, so timers, timeouts and datagrams run deterministically, and days
+    of simulated time run in seconds. Blocking code and threads still run
+    in real time."""
+
+    def __init__(self, start=0.0):
+        self._clock = start
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        return self._clock
+
+    def advance(self, seconds):
+        self._clock += seconds
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """Selector of the VirtualClockLoop, fake sockets are always writable
+    and readable when a datagram is queued"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._real = selectors.DefaultSelector()
+        self._fake = {}
+
+    def register(self, fileobj, events, data=None):
+        if not isinstance(fileobj, FakeSocket):
+            return self._real.register(fileobj, events, data)
+        if fileobj in self._fake:
+            raise KeyError(f"{fileobj} is already registered")
+        key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+        self._fake[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        if not isinstance(fileobj, FakeSocket):
+            return self._real.unregister(fileobj)
+        return self._fake.pop(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def get_key(self, fileobj):
+        if not isinstance(fileobj, FakeSocket):
+            return self._real.get_key(fileobj)
+        return self._fake[fileobj]
+
+    def get_map(self):
+        return self._real.get_map()
+
+    def _ready(self):
+        ready = []
+        for sock, key in self._fake.items():
+            events = key.events & selectors.EVENT_WRITE
+            if sock._queue:
+                events |= key.events & selectors.EVENT_READ
+            if events:
+                ready.append((key, events))
+        return ready
+
+    def select(self, timeout=None):
+        ready = self._ready() + self._real.select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            # nothing scheduled, wait for other threads
+            return self._real.select(None)
+        self._loop.advance(timeout)
+        return []
+
+    def close(self):
+        self._real.close()
+
+
+def run_virtual(main, start=0.0):
+    """asyncio.run in virtual time"""
+    loop = VirtualClockLoop(start)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class FakeSocket:
+    """UDP socket of a fake Network"""
+
+    _filenos = itertools.count(1 << 20)
+
+    def __init__(self, network, host):
+        self._network = network
+        self._host = host
+        self._fileno = next(FakeSocket._filenos)
+        self._options = {}
+        self._queue = deque()
+        self._dropped = 0
+        self.address = None
+
+    def __repr__(self):
+        return f"FakeSocket({self.address})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self):
+        return self._fileno
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, level, option, value):
+        self._options[level, option] = value
+
+    def getsockopt(self, level, option):
+        return self._options.get((level, option), Network.RCVBUF)
+
+    def bind(self, address):
+        ip, port = address
+        self.address = (ip or self._host, port or self._network._ephemeral())
+        self._network._bind(self, ip, self.address[1])
+
+    def close(self):
+        self._network._unbind(self)
+
+    def sendto(self, data, address):
+        if not self.address:
+            self.bind(("", 0))
+        self._network._send(self.address, bytes(data), address)
+        return len(data)
+
+    def _deliver(self, data, source):
+        if len(self._queue) >= self._network.capacity:
+            self._dropped += 1
+        else:
+            received = asyncio.get_event_loop().time()
+            self._queue.append((data, source, received))
+
+    def recvfrom(self, size):
+        data, source, _ = self._receive()
+        return data[:size], source
+
+    def _receive(self):
+        if not self._queue:
+            raise BlockingIOError
+        return self._queue.popleft()
+
+    def recvmsg(self, size, ancsize=0):
+        data, source, received = self._receive()
+        ancdata = []
+        if ancsize and self._options.get((socket.SOL_SOCKET, SO_TIMESTAMPNS)):
+            # receive timestamps in the time of the event loop, as a
+            # 64 bit timespec
+            sec, nsec = divmod(int(received * 1e9), 10**9)
+            ancdata.append(
+                (
+                    socket.SOL_SOCKET,
+                    SO_TIMESTAMPNS,
+                    TIMESPECS[16].pack(sec, nsec),
+                )
+            )
+        if ancsize and self._options.get((socket.SOL_SOCKET, SO_RXQ_OVFL)):
+            ancdata.append(
+                (socket.SOL_SOCKET, SO_RXQ_OVFL, DROPS.pack(self._dropped))
+            )
+        return data[:size], ancdata, 0, source
+
+
+class Network:
+    """Fake UDP network, delivering datagrams between FakeSockets with a
+    latency and loss rate, in the time of the event loop
+
+    Sockets bound to the specific address are preferred to the ones bound
+    to all addresses. Broadcasts are delivered to all sockets on the port.
+    At most capacity datagrams are queued per socket, the rest are dropped
+    and counted as with SO_RXQ_OVFL."""
+
+    RCVBUF = 212992
+
+    def __init__(self, latency=0.0, loss=0.0, capacity=1000, rng=random):
+        self.latency = latency
+        self.loss = loss
+        self.capacity = capacity
+        self._rng = rng
+        self._bound = {}  # (ip, port) -> sockets, most recently bound last
+        self._ports = itertools.count(50000)
+        # sent, delivered, lost, unreachable
+        self.stats = Counter()
+
+    def _ephemeral(self):
+        return next(self._ports)
+
+    def _bind(self, sock, ip, port):
+        self._bound.setdefault((ip or "", port), []).append(sock)
+
+    def _unbind(self, sock):
+        for sockets in self._bound.values():
+            if sock in sockets:
+                sockets.remove(sock)
+
+    def _recipients(self, ip, port):
+        if ip == "<broadcast>" or ip.endswith(".255"):
+            return [
+                s for (_, p), l in self._bound.items() if p == port for s in l
+            ]
+        sockets = self._bound.get((ip, port)) or self._bound.get(("", port))
+        return sockets[-1:] if sockets else []
+
+    def _send(self, source, data, address):
+        ip, port = address
+        try:
+            socket.inet_aton(ip)
+        except OSError:
+            if ip != "<broadcast>":
+                raise socket.gaierror(f"Unknown host {ip}")
+        self.stats["sent"] += 1
+        recipients = self._recipients(ip, port)
+        if not recipients:
+            self.stats["unreachable"] += 1
+        for sock in recipients:
+            if self.loss and self._rng.random() < self.loss:
+                self.stats["lost"] += 1
+                continue
+            self.stats["delivered"] += 1
+            if self.latency:
+                asyncio.get_event_loop().call_later(
+                    self.latency, sock._deliver, data, source
+                )
+            else:
+                sock._deliver(data, source)
+
+    def socket(self, host):
+        """Return a function creating sockets on the host, replacing
+        socket.socket"""
+
+        def factory(family=socket.AF_INET, type=socket.SOCK_DGRAM, *args):
+            return FakeSocket(self, host)
+
+        return factory
+
+    @contextmanager
+    def patch(self, host, *modules):
+        """Let the modules, e.g. controller and discovery, create their
+        sockets on this network, from the host address"""
+        proxy = SimpleNamespace(
+            **{k: v for k, v in vars(socket).items() if not k.startswith("__")}
+        )
+        proxy.socket = self.socket(host)
+        saved = [module.socket for module in modules]
+        for module in modules:
+            module.socket = proxy
+        try:
+            yield self
+        finally:
+            for module, original in zip(modules, saved):
+                module.socket = original
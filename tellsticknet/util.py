@@ -1,5 +1,9 @@
 import asyncio
 import logging
+import socket
+import struct
+from sys import platform
+from time import time
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -57,3 +61,145 @@ async def sock_recvfrom(sock, size):
             _LOGGER.debug("No data available on socket yet")
             blocking.clear()
             loop.add_reader(sock, blocking_cb)
+
+
+async def sock_recvmsg(sock, size, ancsize=0):
+    """async UDP helper, returns (data, ancdata, flags, address)"""
+    loop = asyncio.get_event_loop()
+    blocking = asyncio.Event()
+    blocking.set()
+
+    def blocking_cb():
+        _LOGGER.debug("Data available on socket")
+        loop.remove_reader(sock)
+        blocking.set()
+
+    while True:
+        await blocking.wait()
+        try:
+            _LOGGER.debug("Reading from %s", sock)
+            res = sock.recvmsg(size, ancsize)
+            _LOGGER.debug("Got data from sock %s: %s", sock, res)
+            return res
+        except BlockingIOError:
+            _LOGGER.debug("No data available on socket yet")
+            blocking.clear()
+            loop.add_reader(sock, blocking_cb)
+
+
+# max number of datagrams read from the socket per wakeup
+MAX_BATCH = 64
+
+
+async def sock_recvmsgs(sock, size, ancsize=0):
+    """async UDP helper, wait for data and return all datagrams ready
+    as a list of (data, ancdata, flags, address)"""
+    batch = [await sock_recvmsg(sock, size, ancsize)]
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(sock.recvmsg(size, ancsize))
+        except OSError:
+            # nothing more to read, or an error reported on the next read
+            break
+    return batch
+
+
+# Linux values, not exported by the socket module
+SO_TIMESTAMP = getattr(socket, "SO_TIMESTAMP", 29)
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+
+# struct timespec / struct timeval, by the size of the payload: 32 bit
+# fields, or 64 bit on 64 bit platforms and with a 64 bit time_t on 32 bit
+# platforms (tv_nsec is padded to 64 bits)
+TIMESPECS = {
+    timespec.size: timespec
+    for timespec in (struct.Struct("@ii"), struct.Struct("@qq"))
+}
+# number of datagrams dropped, for SO_RXQ_OVFL
+DROPS = struct.Struct("@I")
+
+ANCILLARY_SIZE = (
+    socket.CMSG_SPACE(max(TIMESPECS)) + socket.CMSG_SPACE(DROPS.size)
+    if platform == "linux"
+    else 0
+)
+
+
+def enable_timestamps(sock):
+    """Ask the kernel for receive timestamps on the socket,
+    returns the option enabled or None if not supported"""
+    if platform != "linux":
+        return None
+    for option in (SO_TIMESTAMPNS, SO_TIMESTAMP):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, 1)
+            return option
+        except OSError:
+            continue
+    return None
+
+
+def set_receive_buffer(sock, size):
+    """Set SO_RCVBUF, returns the size actually used by the kernel"""
+    if size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(size))
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def enable_drop_counter(sock):
+    """Ask the kernel to report the number of dropped datagrams
+    returns False if not supported"""
+    if platform != "linux":
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        return True
+    except OSError:
+        return False
+
+
+def dropped_count(ancdata):
+    """
+    Return the number of datagrams dropped by the kernel since the socket
+    was created, or None if not reported
+
+    >>> dropped_count([(socket.SOL_SOCKET, SO_RXQ_OVFL, DROPS.pack(17))])
+    17
+    >>> dropped_count([])
+    """
+    for level, kind, data in ancdata:
+        if (
+            level == socket.SOL_SOCKET
+            and kind == SO_RXQ_OVFL
+            and len(data) >= DROPS.size
+        ):
+            return DROPS.unpack_from(data)[0]
+    return None
+
+
+def kernel_timestamp(ancdata):
+    """
+    Return the kernel receive timestamp from the ancillary data,
+    or the current time if there is none
+
+    >>> kernel_timestamp([(socket.SOL_SOCKET, SO_TIMESTAMPNS, \
+TIMESPECS[16].pack(1459502928, 500000000))])
+    1459502928.5
+    >>> kernel_timestamp([(socket.SOL_SOCKET, SO_TIMESTAMP, \
+TIMESPECS[16].pack(1459502928, 250000))])
+    1459502928.25
+    >>> kernel_timestamp([(socket.SOL_SOCKET, SO_TIMESTAMPNS, \
+TIMESPECS[8].pack(1459502928, 500000000))])
+    1459502928.5
+    """
+    for level, kind, data in ancdata:
+        if level != socket.SOL_SOCKET or len(data) not in TIMESPECS:
+            continue
+        if kind == SO_TIMESTAMPNS:
+            sec, nsec = TIMESPECS[len(data)].unpack(data)
+            return sec + nsec / 1e9
+        if kind == SO_TIMESTAMP:
+            sec, usec = TIMESPECS[len(data)].unpack(data)
+            return sec + usec / 1e6
+    return time()